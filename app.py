@@ -1,9 +1,6 @@
 import os
 from flask import Flask, redirect, url_for, session, request, render_template
-from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-import requests  # For Microsoft Graph API
 
 # Microsoft OAuth2 config (fill these from Azure Portal)
 MS_SCOPES = [
@@ -25,9 +22,9 @@ except Exception:
 
 import datetime
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from bson import ObjectId
 import bcrypt
+import hmac
 import re
 from werkzeug.utils import secure_filename
 
@@ -39,26 +36,151 @@ app = Flask(__name__)
 app.debug = os.environ.get('FLASK_DEBUG') == '1'
 app.secret_key = os.environ.get('FLASK_SECRET_KEY')
 
-# MongoDB connection
-MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
-client = MongoClient(MONGO_URI)
-db = client.calstack
+# MongoDB connection, recreated per worker process by init_db()
+import mongo
+
+def init_db():
+    """
+    (Re)create the Mongo client and collection handles for this process.
+    gunicorn calls this after fork (see gunicorn.conf.py).
+    """
+    global client, db, users_col, teams_col, polls_col, availability_col
+    client = mongo.create_client()
+    db = client.calstack
+    users_col = db.users
+    teams_col = db.teams
+    polls_col = db.polls
+    availability_col = db.availability
+
+init_db()
 
 from flask import jsonify, request
-from datetime import datetime, timedelta, time as dt_time
+from datetime import datetime, timedelta
 import pytz
 
-def slot_overlaps(slot_start, slot_end, busy_times):
-    for busy in busy_times:
-        busy_start = busy['start']
-        busy_end = busy['end']
-        if slot_start < busy_end and slot_end > busy_start:
-            return True
-    return False
+from scheduling import (
+    SearchSpec, parse_busy, serialize_busy, merge_intervals, to_utc,
+    find_slots, rank_by_attendance, busy_histogram, MAX_HORIZON_DAYS, DEFAULT_HORIZON_DAYS,
+    GRANULARITIES
+)
+from slot_cache import SlotCache, search_key
+import metrics
+import calendar_sync
+import google_client
+import graph_client
+import calendar_push
+import jobs
+import outbox
+import token_store
+
+# Slot search results, keyed on the team's availability version
+slot_cache = SlotCache(
+    max_entries=int(os.environ.get('SLOT_CACHE_SIZE', 1024)),
+    ttl_seconds=int(os.environ.get('SLOT_CACHE_TTL', 300))
+)
+
+def get_availability_version(team_id):
+    team = teams_col.find_one({'_id': ObjectId(team_id)}, {'availability_version': 1})
+    return team.get('availability_version', 0) if team else 0
+
+def bump_availability_version(query):
+    """Invalidate cached slot searches for the teams matching query."""
+    teams_col.update_many(query, {'$inc': {'availability_version': 1}})
+
+def record_search(team_id):
+    """
+    Stamp the team's last_search_at so the re-sync scheduler refreshes its
+    members first. Written at most once every few minutes per team.
+    """
+    now = datetime.now(pytz.UTC)
+    teams_col.update_one(
+        {'_id': ObjectId(team_id), '$or': [
+            {'last_search_at': {'$exists': False}},
+            {'last_search_at': {'$lt': now - timedelta(minutes=5)}}
+        ]},
+        {'$set': {'last_search_at': now}}
+    )
+
+def cached_search(kind, team_id, participants, spec, search, cacheable=True):
+    """Return search() from the slot cache, running and storing it on a miss."""
+    record_search(team_id)
+    if not cacheable:
+        return search()
+    key = search_key(kind, team_id, participants, spec, get_availability_version(team_id))
+    result = slot_cache.get(key)
+    if result is None:
+        result = search()
+        slot_cache.set(key, result)
+    return result
+
+def parse_search_range(data, default_step):
+    """Read horizon_days and granularity (minutes between starts) from a slot request."""
+    horizon_days = int(data.get('horizon_days', DEFAULT_HORIZON_DAYS))
+    if not 1 <= horizon_days <= MAX_HORIZON_DAYS:
+        raise ValueError(f"horizon_days must be between 1 and {MAX_HORIZON_DAYS}")
+    granularity = data.get('granularity')
+    if granularity is None:
+        return horizon_days, default_step
+    granularity = int(granularity)
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(map(str, GRANULARITIES))}")
+    return horizon_days, granularity
+
+def team_members(team_id, emails=None):
+    """
+    The team's members, or those of emails that are members. Availability
+    is stored once per user, so reads for a team go through its members.
+    """
+    team = teams_col.find_one({'_id': ObjectId(team_id)}, {'members': 1})
+    members = team.get('members', []) if team else []
+    if emails is None:
+        return members
+    allowed = set(members)
+    return [email for email in emails if email in allowed]
+
+def load_busy_by_member(team_id, participants):
+    """Load the busy intervals of participants in the team with a single query."""
+    members = team_members(team_id, participants)
+    avail_docs = availability_col.find({'user_email': {'$in': members}}, {'user_email': 1, 'busy': 1})
+    return {doc['user_email']: parse_busy(doc.get('busy', [])) for doc in avail_docs}
+
+def coverage_end(team_id, participants):
+    """
+    End of the window every synced participant's calendar was fetched for,
+    or None if nobody's is limited (uploaded calendars). Slot searches stop
+    there: past it members would only look free because nothing was fetched.
+    Coverage that already lapsed (e.g. a revoked token that was never
+    re-synced) is ignored, otherwise one such member would leave the whole
+    team with no slots at all.
+    """
+    members = team_members(team_id, participants)
+    doc = availability_col.find_one(
+        {'user_email': {'$in': members}, 'covered_until': {'$gt': datetime.now(pytz.UTC)}},
+        {'covered_until': 1}, sort=[('covered_until', 1)]
+    )
+    return to_utc(doc['covered_until']) if doc else None
+
+def load_busy_in_window(members, window_start=None, window_end=None):
+    """
+    Load members' busy intervals with one aggregation. Intervals outside
+    [window_start, window_end) are dropped by Mongo before they are sent.
+    """
+    busy_field = '$busy'
+    conditions = []
+    if window_start:
+        conditions.append({'$gt': ['$$b.end', window_start]})
+    if window_end:
+        conditions.append({'$lt': ['$$b.start', window_end]})
+    if conditions:
+        busy_field = {'$filter': {'input': '$busy', 'as': 'b', 'cond': {'$and': conditions}}}
+    avail_docs = availability_col.aggregate([
+        {'$match': {'user_email': {'$in': members}}},
+        {'$project': {'_id': 0, 'user_email': 1, 'busy': busy_field}}
+    ])
+    return {doc['user_email']: parse_busy(doc.get('busy') or []) for doc in avail_docs}
 
 @app.route('/api/propose_slots', methods=['POST'])
 def propose_slots():
-    import random
     data = request.get_json()
     participants = data['participants']  # list of emails
     days_js = data.get('days_of_week', list(range(7)))
@@ -77,74 +199,40 @@ def propose_slots():
     algorithm = data.get('algorithm', 'next')
     num_slots = int(data.get('num_slots', 5))
     avoid_work_hours = bool(data.get('avoid_work_hours', False))
-
-    all_slots = []
-    for day_offset in range(7):
-        day = now + timedelta(days=day_offset)
-        if day.weekday() not in days_of_week:
-            continue
-        day_start = tz.localize(datetime.combine(day.date(), dt_time(hour=start_hour)))
-        day_end = tz.localize(datetime.combine(day.date(), dt_time(hour=end_hour)))
-        slot_start = day_start
-        while slot_start + timedelta(minutes=duration) <= day_end:
-            slot_end = slot_start + timedelta(minutes=duration)
-            # Work hours filter: skip 9am-5pm Mon-Fri if avoid_work_hours
-            if avoid_work_hours and day.weekday() < 5:
-                if slot_start.hour < 17:
-                    slot_start += timedelta(minutes=duration)
-                    continue
-            conflict = False
-            for email in participants:
-                avail_doc = db.availability.find_one({'user_email': email, 'team_id': team_id})
-                busy_times = []
-                if avail_doc and 'busy' in avail_doc:
-                    for busy in avail_doc['busy']:
-                        busy_start = datetime.fromisoformat(busy['start'])
-                        if busy_start.tzinfo is None:
-                            busy_start = tz.localize(busy_start)
-                        busy_end = datetime.fromisoformat(busy['end'])
-                        if busy_end.tzinfo is None:
-                            busy_end = tz.localize(busy_end)
-                        busy_times.append({'start': busy_start, 'end': busy_end})
-                if slot_overlaps(slot_start, slot_end, busy_times):
-                    conflict = True
-                    break
-            if not conflict:
-                all_slots.append({
-                    'start': slot_start.isoformat(),
-                    'end': slot_end.isoformat(),
-                    'day': day.date().isoformat()
-                })
-            slot_start += timedelta(minutes=duration)
-    # Algorithm selection
-    slots = []
-    if algorithm == 'split':
-        # Distribute slots across days
-        slots_by_day = {}
-        for slot in all_slots:
-            slots_by_day.setdefault(slot['day'], []).append(slot)
-        days = sorted(slots_by_day.keys())
-        i = 0
-        while len(slots) < num_slots and any(slots_by_day.values()):
-            for day in days:
-                if slots_by_day[day]:
-                    slots.append(slots_by_day[day].pop(0))
-                    if len(slots) >= num_slots:
-                        break
-    elif algorithm == 'random':
-        slots = random.sample(all_slots, min(num_slots, len(all_slots))) if all_slots else []
-    else:  # 'next' (default)
-        slots = all_slots[:num_slots]
-    # Remove 'day' key before returning
-    for slot in slots:
-        slot.pop('day', None)
+    try:
+        horizon_days, granularity = parse_search_range(data, duration)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    spec = SearchSpec(
+        tz=tz,
+        now=now,
+        duration=duration,
+        start_hour=start_hour,
+        end_hour=end_hour,
+        days_of_week=days_of_week,
+        step=granularity,
+        horizon_days=horizon_days,
+        until=coverage_end(team_id, participants),
+        # Work hours filter: skip starts before 5pm Mon-Fri if avoid_work_hours
+        avoid_hours=(0, 17) if avoid_work_hours else None,
+        algorithm=algorithm,
+        limit=num_slots
+    )
+    found = cached_search(
+        'propose', team_id, participants, spec,
+        lambda: find_slots(load_busy_by_member(team_id, participants), spec),
+        cacheable=algorithm != 'random'
+    )
+    slots = [{
+        'start': start.isoformat(),
+        'end': end.isoformat()
+    } for start, end in found]
     return jsonify({'slots': slots})
 
-# Collections
-users_col = db.users
-teams_col = db.teams
-polls_col = db.polls
-availability_col = db.availability
+if os.environ.get('ENSURE_INDEXES') == '1':
+    from db_indexes import ensure_indexes, print_report
+    print_report(ensure_indexes(db))
 
 from bson import ObjectId
 
@@ -263,10 +351,7 @@ def parse_ics_file(ics_content, user_timezone='UTC'):
                 start_utc = start_dt.astimezone(pytz.UTC)
                 end_utc = end_dt.astimezone(pytz.UTC)
 
-                busy_times.append({
-                    'start': start_utc.isoformat().replace('+00:00', 'Z'),
-                    'end': end_utc.isoformat().replace('+00:00', 'Z')
-                })
+                busy_times.append({'start': start_utc, 'end': end_utc})
 
         return True, busy_times
 
@@ -275,23 +360,37 @@ def parse_ics_file(ics_content, user_timezone='UTC'):
 
 def sync_manual_user_availability(email):
     """Sync availability for manual users using their ICS data"""
-    user = users_col.find_one({'email': email, 'auth_method': 'manual'})
-    if not user or not user.get('ics_calendar_data'):
-        return
-
-    # Use stored ICS data as busy times
-    busy_times = user.get('ics_calendar_data', [])
-
-    # Update availability for all user's teams
-    user_teams = teams_col.find({"members": email})
-    for team in user_teams:
-        availability_col.update_one(
-            {"team_id": str(team['_id']), "user_email": email},
-            {"$set": {"busy": busy_times}},
-            upsert=True
-        )
+    count = calendar_sync.sync_user(db, email, 'manual')
+    if count is not None:
+        print(f"Synced manual availability for {email}: {count} busy periods")
 
-    print(f"Synced manual availability for {email}: {len(busy_times)} busy periods")
+def session_provider(email):
+    """
+    Calendar provider the user logged in with. Sessions from before the
+    token store carry the tokens themselves; those are moved to the store.
+    Their expiry is unknown, so they are stored as expired and the first
+    worker pass (or get()) refreshes them.
+    """
+    for key, provider in (('ms_credentials', 'outlook'), ('credentials', 'google')):
+        if session.get(key):
+            token_store.save(db, email, provider, session.pop(key), expires_at=datetime.now(pytz.UTC))
+            session['provider'] = provider
+    return session.get('provider')
+
+def queue_user_sync(email):
+    """
+    Sync email's calendar. Uploaded ICS data is stored straight away;
+    Google and Outlook calendars are synced by the background worker
+    using the user's stored credentials.
+    """
+    user = users_col.find_one({'email': email}, {'auth_method': 1})
+    if user and user.get('auth_method') == 'manual':
+        calendar_sync.sync_user(db, email, 'manual')
+        return None
+    provider = session_provider(email)
+    if provider:
+        return jobs.enqueue_sync(db, email, provider)
+    return None
 
 @app.route('/api/team/<team_id>/polls', methods=['GET'])
 def get_team_polls(team_id):
@@ -304,10 +403,6 @@ def get_team_polls(team_id):
         poll['_id'] = str(poll['_id'])
     return jsonify({'polls': polls})
 
-import base64
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Attachment, FileContent, FileName, FileType, Disposition
-
 def generate_ics(meeting, team_name="Your Team", user_tz="UTC"):
     from datetime import datetime
     import pytz
@@ -331,54 +426,71 @@ def generate_ics(meeting, team_name="Your Team", user_tz="UTC"):
     ics = f"""BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//ChronoConqueror//Calstack//EN\nCALSCALE:GREGORIAN\nMETHOD:REQUEST\nBEGIN:VEVENT\nDTSTART;TZID={user_tz}:{start_dt.strftime('%Y%m%dT%H%M%S')}\nDTEND;TZID={user_tz}:{end_dt.strftime('%Y%m%dT%H%M%S')}\nDTSTAMP:{dtstamp}\nUID:{uid}\nSUMMARY:{summary}\nDESCRIPTION:Scheduled via Calstack\nEND:VEVENT\nEND:VCALENDAR\n"""
     return ics
 
-def send_meeting_invites(meeting, participants, team_name="Your Team"):
-    import os
-    import pytz
-    from sendgrid.helpers.mail import Content
-    from datetime import datetime
-    sg_api_key = os.environ.get('SENDGRID_API_KEY')
-    if not sg_api_key:
-        print("SendGrid API key not set!")
-        return
+def meeting_invite_content(meeting, team_name, user_tz):
+    """Plain text and calendar invite for a meeting, in user_tz"""
     slot = meeting['slot']
+    try:
+        tz = pytz.timezone(user_tz)
+    except Exception:
+        tz = pytz.UTC
+    # Parse UTC times and convert to local
+    start_utc = datetime.fromisoformat(slot['start'].replace('Z', '+00:00'))
+    end_utc = datetime.fromisoformat(slot['end'].replace('Z', '+00:00'))
+    # Format with timezone name
+    start_str = start_utc.astimezone(tz).strftime('%Y-%m-%d %I:%M %p (%Z)')
+    end_str = end_utc.astimezone(tz).strftime('%Y-%m-%d %I:%M %p (%Z)')
+    body = (
+        f"A new meeting has been scheduled for your team.\n\n"
+        f"Start: {start_str}\n"
+        f"End: {end_str}\n\n"
+        f"This invite should appear in your calendar."
+    )
+    # The calendar invite goes inline as alternative content, not just an attachment
+    return [
+        {'type': 'text/plain', 'value': body},
+        {'type': 'text/calendar', 'value': generate_ics(meeting, team_name, user_tz=user_tz)}
+    ]
+
+def queue_meeting_invites(meeting, participants, team_name="Your Team"):
+    """
+    Queue a calendar invite email for each participant, in their own
+    timezone. Participants sharing a timezone get the same message, which
+    the worker sends as one SendGrid request (see outbox.py).
+    """
+    timezones = {
+        user['email']: user.get('timezone', 'UTC')
+        for user in users_col.find({'email': {'$in': participants}}, {'email': 1, 'timezone': 1})
+    }
     subject = f"New Meeting Scheduled for {team_name}"
+    contents = {}
+    messages = []
     for email in participants:
-        # Fetch user timezone from MongoDB
-        user_doc = users_col.find_one({'email': email})
-        user_tz = user_doc.get('timezone', 'UTC') if user_doc else 'UTC'
-        ics_content = generate_ics(meeting, team_name, user_tz=user_tz)
-        try:
-            tz = pytz.timezone(user_tz)
-        except Exception:
-            tz = pytz.UTC
-        # Parse UTC times and convert to local
-        start_utc = datetime.fromisoformat(slot['start'].replace('Z', '+00:00'))
-        end_utc = datetime.fromisoformat(slot['end'].replace('Z', '+00:00'))
-        start_local = start_utc.astimezone(tz)
-        end_local = end_utc.astimezone(tz)
-        # Format with timezone name
-        start_str = start_local.strftime('%Y-%m-%d %I:%M %p (%Z)')
-        end_str = end_local.strftime('%Y-%m-%d %I:%M %p (%Z)')
-        body = (
-            f"A new meeting has been scheduled for your team.\n\n"
-            f"Start: {start_str}\n"
-            f"End: {end_str}\n\n"
-            f"This invite should appear in your calendar."
-        )
-        message = Mail(
-            from_email=Email('scheduler@chronoconqueror.com', team_name),
-            to_emails=To(email),
-            subject=subject,
-            plain_text_content=body
-        )
-        # Add calendar invite as an alternative content (inline, not just attachment)
-        message.add_content(Content("text/calendar", ics_content))
-        try:
-            sg = SendGridAPIClient(sg_api_key)
-            response = sg.send(message)
-            print(f"Email sent to {email}: {response.status_code}")
-        except Exception as e:
-            print(f"Error sending email to {email}: {e}")
+        user_tz = timezones.get(email, 'UTC')
+        if user_tz not in contents:
+            contents[user_tz] = meeting_invite_content(meeting, team_name, user_tz)
+        messages.append(outbox.message(
+            email, subject, contents[user_tz], from_name=team_name,
+            kind='meeting_invite', key=f"meeting:{meeting['_id']}:{email}"
+        ))
+    return outbox.enqueue(db, messages)
+
+def queue_team_invites(team_id, team_name, invite_code, inviter, emails):
+    """Queue emails inviting addresses to join a team; each address gets at most one a day"""
+    join_url = f"{request.host_url.rstrip('/')}/team/join?code={invite_code}"
+    subject = f"You're invited to join {team_name} on Calstack!"
+    html_content = f"""
+    <p>{inviter} has invited you to join the team <b>{team_name}</b> on Calstack.</p>
+    <p>Click the link below to join the team (after logging in):</p>
+    <p><a href='{join_url}'>{join_url}</a></p>
+    <p>Or use this invite code: <b>{invite_code}</b></p>
+    <br><p>Best,<br>The Calstack Team</p>
+    """
+    content = [{'type': 'text/html', 'value': html_content}]
+    day = datetime.now(pytz.UTC).strftime('%Y-%m-%d')
+    return outbox.enqueue(db, [
+        outbox.message(email, subject, content, kind='team_invite', key=f"invite:{team_id}:{email.lower()}:{day}")
+        for email in emails
+    ])
 
 @app.route('/api/team/<team_id>/polls/<poll_id>/vote', methods=['POST'])
 def vote_poll(team_id, poll_id):
@@ -416,13 +528,11 @@ def vote_poll(team_id, poll_id):
             }
             db.meetings.insert_one(meeting)
             polls_col.update_one({'_id': ObjectId(poll_id)}, {'$set': {'status': 'closed', 'result': {'start': chosen_slot[0], 'end': chosen_slot[1]}}})
-            # Send calendar invites
+            # Calendar invites are sent by the worker
             team = teams_col.find_one({'_id': ObjectId(team_id)})
             team_name = team.get('name', 'Your Team') if team else 'Your Team'
-            send_meeting_invites(meeting, poll['participants'], team_name)
+            queue_meeting_invites(meeting, poll['participants'], team_name)
     return jsonify({'success': True})
-polls_col = db.polls
-availability_col = db.availability
 
 @app.route('/api/team/<team_id>/leave', methods=['POST'])
 def leave_team(team_id):
@@ -432,6 +542,8 @@ def leave_team(team_id):
         return jsonify({'error': 'Not a member of this team'}), 403
     # Remove user from team
     teams_col.update_one({'_id': ObjectId(team_id)}, {'$pull': {'members': user_email}})
+    # Searches cached for this team may include the member who left
+    bump_availability_version({'_id': ObjectId(team_id)})
     team = teams_col.find_one({'_id': ObjectId(team_id)})
     if not team['members']:
         # Delete team, polls, meetings if no members remain
@@ -460,15 +572,68 @@ GOOGLE_CLIENT_SECRETS_FILE = "client_secret.json"
 SCOPES = [
     'https://www.googleapis.com/auth/calendar.events.freebusy',
     'https://www.googleapis.com/auth/calendar.settings.readonly',
+    calendar_sync.GOOGLE_CALENDAR_LIST_SCOPE,
     'openid',
     'https://www.googleapis.com/auth/userinfo.email',
     'https://www.googleapis.com/auth/userinfo.profile'
 ]
+if calendar_sync.INCREMENTAL_SYNC or calendar_push.PUSH_ENABLED:
+    # events.list with sync tokens and events.watch channels
+    from incremental_sync import GOOGLE_EVENTS_SCOPE
+    SCOPES.append(GOOGLE_EVENTS_SCOPE)
 
 @app.route('/')
 def index():
     return render_template("login.html")
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Per-worker counters in Prometheus text format"""
+    metrics.set_gauge('slot_cache_entries', len(slot_cache))
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# --- Calendar Push Notifications ---
+
+@app.route('/webhooks/google', methods=['POST'])
+def google_calendar_webhook():
+    """Google Calendar watch channel notification"""
+    # Google confirms a new channel with a 'sync' message; nothing changed yet
+    if request.headers.get('X-Goog-Resource-State') == 'sync':
+        return '', 200
+    queued = calendar_push.handle_notification(
+        db, 'google',
+        request.headers.get('X-Goog-Channel-ID'),
+        request.headers.get('X-Goog-Channel-Token')
+    )
+    return ('', 200) if queued else ('', 403)
+
+@app.route('/webhooks/outlook', methods=['POST'])
+def outlook_calendar_webhook():
+    """Microsoft Graph subscription notifications"""
+    # Graph validates the URL when a subscription is created by expecting the token back
+    validation_token = request.args.get('validationToken')
+    if validation_token:
+        return validation_token, 200, {'Content-Type': 'text/plain'}
+    data = request.get_json(silent=True) or {}
+    for notification in data.get('value', []):
+        calendar_push.handle_notification(
+            db, 'outlook', notification.get('subscriptionId'), notification.get('clientState')
+        )
+    return '', 202
+
+@app.route('/webhooks/sendgrid', methods=['POST'])
+def sendgrid_event_webhook():
+    """SendGrid event webhook: delivery status of outbox emails"""
+    # Configure the webhook URL in SendGrid as /webhooks/sendgrid?token=<SENDGRID_WEBHOOK_TOKEN>
+    expected = os.environ.get('SENDGRID_WEBHOOK_TOKEN')
+    if not expected:
+        return '', 404
+    if not hmac.compare_digest(request.args.get('token', ''), expected):
+        return '', 403
+    events = request.get_json(silent=True)
+    outbox.record_events(db, events if isinstance(events, list) else [])
+    return '', 200
+
 @app.route('/home')
 def home():
     user_email = session.get('email')
@@ -504,85 +669,12 @@ def create_team():
         members = [user_email]  # Only creator is a member at first
         team = {"name": team_name, "members": members, "code": code}
         result = teams_col.insert_one(team)
-        # Send invites to invited_emails using the same logic as invite_members endpoint
+        # Invites to invited_emails are sent by the worker
         if invited_emails:
-            from sendgrid import SendGridAPIClient
-            from sendgrid.helpers.mail import Mail, Email, To
-            import os
-            sg_api_key = os.environ.get('SENDGRID_API_KEY')
-            if sg_api_key:
-                team_name = team_name
-                invite_code = code
-                join_url = f"{request.host_url.rstrip('/')}/team/join?code={invite_code}"
-                for email in invited_emails:
-                    subject = f"You're invited to join {team_name} on Calstack!"
-                    html_content = f"""
-                    <p>{user_email} has invited you to join the team <b>{team_name}</b> on Calstack.</p>
-                    <p>Click the link below to join the team (after logging in):</p>
-                    <p><a href='{join_url}'>{join_url}</a></p>
-                    <p>Or use this invite code: <b>{invite_code}</b></p>
-                    <br><p>Best,<br>The Calstack Team</p>
-                    """
-                    message = Mail(
-                        from_email=Email('scheduler@chronoconqueror.com', 'Calstack'),
-                        to_emails=To(email),
-                        subject=subject,
-                        html_content=html_content
-                    )
-                    try:
-                        sg = SendGridAPIClient(sg_api_key)
-                        sg.send(message)
-                    except Exception as e:
-                        print(f"Error sending invite to {email}: {e}")
-        # Sync creator's availability for the new team
-        creds_dict = session.get('credentials')
-        # Sync availability for the creator
-        user = users_col.find_one({'email': user_email})
-        auth_method = user.get('auth_method') if user else None
-
-        if auth_method == 'manual':
-            # Sync manual user availability using ICS data
-            if user and user.get('ics_calendar_data'):
-                busy_times = user.get('ics_calendar_data', [])
-                availability_col.update_one(
-                    {"team_id": str(result.inserted_id), "user_email": user_email},
-                    {"$set": {"busy": busy_times}},
-                    upsert=True
-                )
-                print(f"Synced manual user availability for team creation: {len(busy_times)} events")
-        else:
-            # OAuth user - use existing Google Calendar sync
-            creds_dict = session.get('credentials')
-            if creds_dict:
-                creds = Credentials(
-                    creds_dict['token'],
-                    refresh_token=creds_dict.get('refresh_token'),
-                    token_uri=creds_dict['token_uri'],
-                    client_id=creds_dict['client_id'],
-                    client_secret=creds_dict['client_secret'],
-                    scopes=creds_dict['scopes']
-                )
-                # Only sync for this team
-                from googleapiclient.discovery import build as g_build
-                service = g_build('calendar', 'v3', credentials=creds)
-                import datetime
-                now = datetime.datetime.utcnow()
-                seven_days_later = now + datetime.timedelta(days=7)
-                time_min = now.isoformat() + 'Z'
-                time_max = seven_days_later.isoformat() + 'Z'
-                freebusy_query = {
-                    "timeMin": time_min,
-                    "timeMax": time_max,
-                    "timeZone": "UTC",
-                    "items": [{"id": "primary"}]
-                }
-                freebusy_result = service.freebusy().query(body=freebusy_query).execute()
-                busy = freebusy_result['calendars']['primary'].get('busy', [])
-                availability_col.update_one(
-                    {"team_id": str(result.inserted_id), "user_email": user_email},
-                    {"$set": {"busy": busy}},
-                    upsert=True
-                )
+            queue_team_invites(str(result.inserted_id), team_name, code, user_email, invited_emails)
+        # Availability is stored per user; only sync if the creator has none yet
+        if not availability_col.find_one({"user_email": user_email}, {"_id": 1}):
+            queue_user_sync(user_email)
         return redirect(url_for('team_page', team_id=str(result.inserted_id)))
     return render_template("create_team.html")
 
@@ -599,48 +691,11 @@ def join_team():
         if team:
             if user_email not in team['members']:
                 teams_col.update_one({"_id": team['_id']}, {"$addToSet": {"members": user_email}})
-            # Sync this user's availability for this team only
-            user = users_col.find_one({'email': user_email})
-            auth_method = user.get('auth_method') if user else None
-
-            if auth_method == 'manual':
-                # Sync manual user availability using ICS data
-                if user and user.get('ics_calendar_data'):
-                    busy_times = user.get('ics_calendar_data', [])
-                    availability_col.update_one(
-                        {"team_id": str(team['_id']), "user_email": user_email},
-                        {"$set": {"busy": busy_times}},
-                        upsert=True
-                    )
-                    print(f"Synced manual user availability for team join: {len(busy_times)} events")
-            else:
-                # OAuth user - use existing Google Calendar sync
-                creds_dict = session.get('credentials')
-                if creds_dict:
-                    from google.oauth2.credentials import Credentials
-                    creds = Credentials(**creds_dict)
-                    # Fetch and upsert availability for this team
-                    from googleapiclient.discovery import build as g_build
-                    service = g_build('calendar', 'v3', credentials=creds)
-                    import datetime
-                    now = datetime.datetime.utcnow()
-                    seven_days_later = now + datetime.timedelta(days=7)
-                    time_min = now.isoformat() + 'Z'
-                    time_max = seven_days_later.isoformat() + 'Z'
-                    freebusy_query = {
-                        "timeMin": time_min,
-                        "timeMax": time_max,
-                        "timeZone": "UTC",
-                        "items": [{"id": "primary"}]
-                    }
-                    freebusy_result = service.freebusy().query(body=freebusy_query).execute()
-                    print("Freebusy result:", freebusy_result)
-                    busy = freebusy_result['calendars']['primary'].get('busy', [])
-                    availability_col.update_one(
-                        {"team_id": str(team['_id']), "user_email": user_email},
-                        {"$set": {"busy": busy}},
-                        upsert=True
-                    )
+            # Availability is stored per user; only sync if this user has none yet
+            if not availability_col.find_one({"user_email": user_email}, {"_id": 1}):
+                queue_user_sync(user_email)
+            # Membership changed, drop cached searches for this team
+            bump_availability_version({"_id": team['_id']})
             return redirect(url_for('team_page', team_id=str(team['_id'])))
         else:
             error = "Team code not found."
@@ -659,12 +714,57 @@ def team_page(team_id):
     # Get all members
     members = team.get('members', [])
     # Get current user's availability
-    avail_doc = availability_col.find_one({"team_id": team_id, "user_email": user_email})
-    busy = avail_doc['busy'] if avail_doc else []
+    avail_doc = availability_col.find_one({"user_email": user_email})
+    busy = serialize_busy(avail_doc['busy']) if avail_doc else []
     # Fetch user's timezone from users_col
     user_doc = users_col.find_one({'email': user_email})
     user_timezone = user_doc.get('timezone', 'UTC') if user_doc else 'UTC'
-    return render_template("team_page.html", team=team, user_email=user_email, members=members, busy=busy, user_timezone=user_timezone)
+    # Members whose calendar sync is still queued or running
+    syncing = sorted(jobs.pending_syncs(db, members))
+    return render_template("team_page.html", team=team, user_email=user_email, members=members, busy=busy,
+                           user_timezone=user_timezone, syncing=syncing)
+
+@app.route('/team/<team_id>/sync_status')
+def get_team_sync_status(team_id):
+    """Members of the team whose calendar sync has not finished yet"""
+    user_email = session.get('email')
+    if not user_email:
+        return redirect(url_for('index'))
+    team = teams_col.find_one({"_id": ObjectId(team_id)}, {'members': 1})
+    if not team or user_email not in team.get('members', []):
+        return jsonify({"error": "Access denied"}), 403
+    return jsonify({'syncing': sorted(jobs.pending_syncs(db, team.get('members', [])))})
+
+@app.route('/api/team/<team_id>/refresh', methods=['POST'])
+def refresh_team(team_id):
+    """
+    Queue a calendar sync for every Google/Outlook member of the team. The
+    worker reads same-tenant Outlook members in batched getSchedule calls.
+    Members without stored credentials (never logged in since tokens moved
+    server-side, or revoked) can't be synced and are returned as skipped.
+    """
+    user_email = session.get('email')
+    team = teams_col.find_one({"_id": ObjectId(team_id)}, {'members': 1})
+    if not team or user_email not in team.get('members', []):
+        return jsonify({"error": "Access denied"}), 403
+    members = team.get('members', [])
+    queued = 1 if queue_user_sync(user_email) else 0
+    pending = jobs.pending_syncs(db, members)
+    docs = list(db.availability.find(
+        {'user_email': {'$in': members}, 'provider': {'$in': ['google', 'outlook']}},
+        {'user_email': 1, 'provider': 1}
+    ))
+    with_tokens = token_store.users_with_tokens(db, [doc['user_email'] for doc in docs])
+    skipped = []
+    for doc in docs:
+        if doc['user_email'] == user_email or doc['user_email'] in pending:
+            continue
+        if doc['user_email'] not in with_tokens:
+            skipped.append(doc['user_email'])
+            continue
+        jobs.enqueue_sync(db, doc['user_email'], doc['provider'])
+        queued += 1
+    return jsonify({'queued': queued, 'skipped': sorted(skipped)})
 
 @app.route('/team/<team_id>/availability/<email>')
 def get_member_availability(team_id, email):
@@ -682,8 +782,8 @@ def get_member_availability(team_id, email):
     if email not in team.get('members', []):
         return jsonify({"error": "User not found in team"}), 404
 
-    avail_doc = availability_col.find_one({"team_id": team_id, "user_email": email})
-    busy = avail_doc['busy'] if avail_doc else []
+    avail_doc = availability_col.find_one({"user_email": email})
+    busy = serialize_busy(avail_doc['busy']) if avail_doc else []
     return {"busy": busy}
 
 @app.route('/team/<team_id>/availability/overlay')
@@ -698,25 +798,63 @@ def get_team_overlay(team_id):
     if not team or user_email not in team.get('members', []):
         return jsonify({"error": "Access denied"}), 403
 
-    # Get all team members' availability
+    # Optional visible window, e.g. ?from=2024-01-01T00:00:00Z&to=2024-01-08T00:00:00Z
+    try:
+        window_start = to_utc(request.args['from']) if request.args.get('from') else None
+        window_end = to_utc(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({"error": "Invalid from/to timestamp"}), 400
+
+    busy_by_member = load_busy_in_window(team.get('members', []), window_start, window_end)
+
+    # Union of everyone's busy time as disjoint ranges, bounded by distinct busy regions
+    busy = merge_intervals(
+        interval for intervals in busy_by_member.values() for interval in intervals
+    )
+    return {"busy": serialize_busy({'start': start, 'end': end} for start, end in busy)}
+
+@app.route('/team/<team_id>/availability/heatmap')
+def get_team_heatmap(team_id):
+    # Security: Require authentication and team membership
+    user_email = session.get('email')
+    if not user_email:
+        return redirect(url_for('index'))
+
+    team = teams_col.find_one({"_id": ObjectId(team_id)})
+    if not team or user_email not in team.get('members', []):
+        return jsonify({"error": "Access denied"}), 403
+
+    # Window defaults to the week starting today in the user's timezone
+    user_doc = users_col.find_one({'email': user_email})
+    try:
+        user_tz = pytz.timezone(user_doc.get('timezone', 'UTC') if user_doc else 'UTC')
+    except pytz.UnknownTimeZoneError:
+        user_tz = pytz.UTC
+    try:
+        if request.args.get('from'):
+            window_start = to_utc(request.args['from'])
+        else:
+            window_start = to_utc(datetime.now(user_tz).replace(hour=0, minute=0, second=0, microsecond=0))
+        if request.args.get('to'):
+            window_end = to_utc(request.args['to'])
+        else:
+            window_end = window_start + timedelta(days=7)
+        bucket_minutes = int(request.args.get('bucket', 15))
+    except ValueError:
+        return jsonify({"error": "Invalid from/to/bucket parameter"}), 400
+    if bucket_minutes not in GRANULARITIES:
+        return jsonify({"error": f"bucket must be one of {', '.join(map(str, GRANULARITIES))}"}), 400
+    if not window_start < window_end <= window_start + timedelta(days=MAX_HORIZON_DAYS):
+        return jsonify({"error": f"Window must be positive and at most {MAX_HORIZON_DAYS} days"}), 400
+
     members = team.get('members', [])
-    all_busy_slots = []
-    
-    for member_email in members:
-        avail_doc = availability_col.find_one({"team_id": team_id, "user_email": member_email})
-        if avail_doc and avail_doc.get('busy'):
-            all_busy_slots.extend(avail_doc['busy'])
-    
-    # Remove duplicates by converting to set of (start, end) tuples and back
-    unique_busy_slots = []
-    seen_slots = set()
-    for slot in all_busy_slots:
-        slot_key = (slot['start'], slot['end'])
-        if slot_key not in seen_slots:
-            seen_slots.add(slot_key)
-            unique_busy_slots.append(slot)
-    
-    return {"busy": unique_busy_slots}
+    busy_by_member = load_busy_in_window(members, window_start, window_end)
+    return {
+        "from": window_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "bucket_minutes": bucket_minutes,
+        "members": len(members),
+        "counts": busy_histogram(busy_by_member, window_start, window_end, bucket_minutes)
+    }
 
 from flask import request, jsonify
 @app.route('/team/<team_id>/suggest_slots', methods=['GET', 'POST'])
@@ -758,87 +896,62 @@ def suggest_slots(team_id):
     end_hour = int(hours_to.split(':')[0])
     avoid_work_hours = bool(data.get('avoid_work_hours', False))
     algorithm = data.get('algorithm', 'next')  # 'next', 'split', or 'random'
-    # Get all busy intervals for selected participants
-    avail_docs = availability_col.find({"team_id": team_id, "user_email": {"$in": participants}})
-    member_busy = {doc['user_email']: doc.get('busy', []) for doc in avail_docs}
-    # Build list of busy intervals per member as tuples (start, end) in UTC
-    busy_map = {}
-    utc = datetime.timezone.utc
-    for user, busy_list in member_busy.items():
-        busy_map[user] = [(
-            datetime.datetime.fromisoformat(b['start'].replace('Z','+00:00')).astimezone(utc),
-            datetime.datetime.fromisoformat(b['end'].replace('Z','+00:00')).astimezone(utc)
-        ) for b in busy_list]
-    # Define candidate slots: next 7 days, blocks of chosen duration, filtered by days/hours
-    # Generate slots in user's timezone, then convert to UTC for storage/comparison
-    now_user_tz = datetime.datetime.now(user_timezone).replace(minute=0, second=0, microsecond=0)
-    slots = []
-    for day in range(7):
-        d_user_tz = now_user_tz + datetime.timedelta(days=day)
-        weekday = d_user_tz.weekday() # 0=Mon,6=Sun
-        if weekday in days_py:
-            # Allow slots from start_hour to end_hour in user's timezone
-            for h in range(start_hour, end_hour):
-                # Skip work hours (8:00-17:00) on weekdays if avoid_work_hours is enabled
-                if avoid_work_hours and weekday < 5:  # Monday-Friday (0-4)
-                    if 8 <= h < 17:  # 8:00 AM - 4:59 PM (17:00 is 5:00 PM)
-                        continue
-                
-                slot_start_user_tz = d_user_tz.replace(hour=h, minute=0)
-                slot_end_user_tz = slot_start_user_tz + datetime.timedelta(minutes=slot_minutes)
-                # Convert to UTC for comparison with busy times
-                slot_start_utc = slot_start_user_tz.astimezone(datetime.timezone.utc)
-                slot_end_utc = slot_end_user_tz.astimezone(datetime.timezone.utc)
-                slots.append((slot_start_utc, slot_end_utc))
-    # Filter slots: must be free for all selected participants
-    def slot_is_free(slot):
-        for user in participants:
-            for b_start, b_end in busy_map.get(user, []):
-                # Overlap if slot_start < b_end and slot_end > b_start
-                if slot[0] < b_end and slot[1] > b_start:
-                    return False
-        return True
-    free_slots = [s for s in slots if slot_is_free(s)]
-    
+    # 'all' requires every participant to be free, 'best_attendance' ranks by how many are
+    mode = data.get('mode', 'all')
+    try:
+        horizon_days, granularity = parse_search_range(data, 60)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Candidate slots: on the hour for the next 7 days unless requested otherwise,
+    # generated in the user's timezone
+    spec = SearchSpec(
+        tz=user_timezone,
+        now=datetime.datetime.now(user_timezone),
+        duration=slot_minutes,
+        start_hour=start_hour,
+        end_hour=end_hour,
+        days_of_week=days_py,
+        step=granularity,
+        horizon_days=horizon_days,
+        until=coverage_end(team_id, participants),
+        # Skip work hours (8:00-17:00) on weekdays if avoid_work_hours is enabled
+        avoid_hours=(8, 17) if avoid_work_hours else None,
+        fit_window=False,
+        algorithm=algorithm,
+        limit=max_slots
+    )
+    if mode == 'best_attendance':
+        ranked = cached_search(
+            'attendance', team_id, participants, spec,
+            lambda: rank_by_attendance(load_busy_by_member(team_id, participants), spec, max_slots)
+        )
+        return jsonify({
+            "success": bool(ranked),
+            "slots": [{
+                "start": start.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "end": end.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "available": len(participants) - len(conflicts),
+                "conflicts": conflicts
+            } for start, end, conflicts in ranked]
+        })
+
+    selected_slots = cached_search(
+        'suggest', team_id, participants, spec,
+        lambda: find_slots(load_busy_by_member(team_id, participants), spec),
+        cacheable=algorithm != 'random'
+    )
+
     # Check if no available times found
-    if not free_slots:
+    if not selected_slots:
         return jsonify({
             "success": False,
             "error": "No available times found for the selected participants and time preferences."
         })
-    
-    # Apply algorithm selection
-    import random
-    selected_slots = []
-    
-    if algorithm == 'split':
-        # Distribute slots across different days
-        slots_by_day = {}
-        for slot_start, slot_end in free_slots:
-            day_key = slot_start.strftime('%Y-%m-%d')
-            if day_key not in slots_by_day:
-                slots_by_day[day_key] = []
-            slots_by_day[day_key].append((slot_start, slot_end))
-        
-        # Round-robin selection across days
-        days = sorted(slots_by_day.keys())
-        while len(selected_slots) < max_slots and any(slots_by_day.values()):
-            for day in days:
-                if slots_by_day[day] and len(selected_slots) < max_slots:
-                    selected_slots.append(slots_by_day[day].pop(0))
-    
-    elif algorithm == 'random':
-        # Random selection from available slots
-        selected_slots = random.sample(free_slots, min(max_slots, len(free_slots))) if free_slots else []
-    
-    else:  # 'next' (default)
-        # Chronological order (earliest first)
-        selected_slots = free_slots[:max_slots]
-    
+
     # Format selected slots for response
     suggested = [{
-        "start": s[0].strftime('%Y-%m-%dT%H:%M:%SZ'),
-        "end": s[1].strftime('%Y-%m-%dT%H:%M:%SZ')
+        "start": s[0].astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "end": s[1].astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     } for s in selected_slots]
     
     return jsonify({
@@ -857,38 +970,10 @@ def invite_members(team_id):
     emails = data.get('emails', [])
     if not emails or not isinstance(emails, list):
         return jsonify({'error': 'No emails provided'}), 400
-    import os
-    from sendgrid import SendGridAPIClient
-    from sendgrid.helpers.mail import Mail, Email, To, Content
-    sg_api_key = os.environ.get('SENDGRID_API_KEY')
-    if not sg_api_key:
+    if not os.environ.get('SENDGRID_API_KEY'):
         return jsonify({'error': 'Email service not configured'}), 500
-    team_name = team.get('name', 'Your Team')
-    invite_code = team.get('code')
-    join_url = f"{request.host_url.rstrip('/')}/team/join?code={invite_code}"
-    sent = 0
-    for email in emails:
-        subject = f"You're invited to join {team_name} on Calstack!"
-        html_content = f"""
-        <p>{user_email} has invited you to join the team <b>{team_name}</b> on Calstack.</p>
-        <p>Click the link below to join the team (after logging in):</p>
-        <p><a href='{join_url}'>{join_url}</a></p>
-        <p>Or use this invite code: <b>{invite_code}</b></p>
-        <br><p>Best,<br>The Calstack Team</p>
-        """
-        message = Mail(
-            from_email=Email('scheduler@chronoconqueror.com', 'Calstack'),
-            to_emails=To(email),
-            subject=subject,
-            html_content=html_content
-        )
-        try:
-            sg = SendGridAPIClient(sg_api_key)
-            sg.send(message)
-            sent += 1
-        except Exception as e:
-            print(f"Error sending invite to {email}: {e}")
-    return jsonify({'success': True, 'sent': sent})
+    queued = queue_team_invites(team_id, team.get('name', 'Your Team'), team.get('code'), user_email, emails)
+    return jsonify({'success': True, 'queued': queued})
 
 # --- Poll and Meeting Endpoints ---
 from bson import ObjectId as BsonObjectId
@@ -1021,6 +1106,20 @@ def login_outlook():
 
 
 
+def ms_tenant_id(id_token):
+    """Tenant ('tid' claim) of a Microsoft ID token, or None."""
+    import base64
+    import json
+    if not id_token:
+        return None
+    # Received straight from the token endpoint over TLS, so the signature is not checked
+    try:
+        payload = id_token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (IndexError, ValueError):
+        return None
+    return claims.get('tid')
+
 @app.route('/oauth2callback/outlook')
 def oauth2callback_outlook():
     # Handle Microsoft OAuth2 callback
@@ -1041,16 +1140,19 @@ def oauth2callback_outlook():
         'grant_type': 'authorization_code',
         'client_secret': ms_client_secret
     }
-    resp = requests.post(token_url, data=data)
+    with metrics.timer('login_step_seconds', provider='outlook', step='token'):
+        resp = graph_client.post(token_url, 'token', budget=graph_client.INTERACTIVE_BUDGET, data=data)
     if resp.status_code != 200:
         return f"Token exchange failed: {resp.text}", 400
     token_data = resp.json()
     access_token = token_data.get('access_token')
-    refresh_token = token_data.get('refresh_token')
     if not access_token:
         return "No access token received", 400
-    # Get user email
-    user_resp = requests.get('https://graph.microsoft.com/v1.0/me', headers={'Authorization': f'Bearer {access_token}'})
+    # Get user email and mailbox settings (for the timezone) in one Graph batch request
+    with metrics.timer('login_step_seconds', provider='outlook', step='profile_and_mailbox'):
+        user_resp, tz_resp = graph_client.batch(
+            access_token, ['/me', '/me/mailboxSettings'], 'login', budget=graph_client.INTERACTIVE_BUDGET
+        )
     if user_resp.status_code != 200:
         return "Failed to fetch user info", 400
     ms_profile = user_resp.json()
@@ -1058,20 +1160,12 @@ def oauth2callback_outlook():
     if not email:
         return "Could not retrieve email from Microsoft profile.", 400
     session['email'] = email
-    session['ms_credentials'] = {
-        'access_token': access_token,
-        'refresh_token': refresh_token,
-        'scopes': MS_SCOPES
-    }
-    # Fetch mailbox settings to get timezone
-    try:
-        print(f"[DEBUG] access_token: {access_token[:5]}...{access_token[-5:]}")
-        tz_resp = requests.get('https://graph.microsoft.com/v1.0/me/mailboxSettings', headers={'Authorization': f'Bearer {access_token}'})
-        print(f"[DEBUG] tz_resp.status_code: {tz_resp.status_code}")
-        print(f"[DEBUG] tz_resp.text: {tz_resp.text}")
-    except Exception as e:
-        print(f"[DEBUG] Exception during mailboxSettings fetch: {e}")
-        tz_resp = None
+    session['provider'] = 'outlook'
+    # Tokens stay server-side, where background syncs can refresh them
+    token_store.save(db, email, 'outlook', *token_store.outlook_credentials(token_data, MS_SCOPES))
+    print(f"[DEBUG] access_token: {access_token[:5]}...{access_token[-5:]}")
+    print(f"[DEBUG] tz_resp.status_code: {tz_resp.status_code}")
+    print(f"[DEBUG] tz_resp.text: {tz_resp.text}")
     user_tz = 'UTC'
     if tz_resp and tz_resp.status_code == 200:
         try:
@@ -1135,88 +1229,18 @@ def oauth2callback_outlook():
     else:
         print(f"[DEBUG] tz_resp.status_code: {tz_resp.status_code}")
         print(f"[DEBUG] tz_resp.text: {tz_resp.text}")
-    # Upsert user with timezone
-    users_col.update_one({'email': email}, {'$set': {'name': email.split('@')[0], 'timezone': user_tz}}, upsert=True)
+    # Upsert user with timezone and organisation (for batched team syncs)
+    user_fields = {'name': email.split('@')[0], 'timezone': user_tz}
+    tenant_id = ms_tenant_id(token_data.get('id_token'))
+    if tenant_id:
+        user_fields['ms_tenant_id'] = tenant_id
+    users_col.update_one({'email': email}, {'$set': user_fields}, upsert=True)
     print(f"[DEBUG] Outlook login: {email} timezone set to {user_tz}")
-    # Sync Outlook availability
-    sync_user_availability(email, None, provider='outlook')
+    # Sync Outlook availability in the background
+    jobs.enqueue_sync(db, email, 'outlook')
     return redirect(url_for('home'))
 
 
-def sync_user_availability(email, creds, provider='google'):
-    """
-    Fetch user's Calendar busy times for next 7 days and upsert for all their teams.
-    Supports both Google and Outlook providers.
-    """
-    print(f"Syncing availability for {email} (provider={provider})")
-    busy = []
-    import datetime
-    now = datetime.datetime.utcnow()
-    seven_days_later = now + datetime.timedelta(days=7)
-    time_min = now.isoformat() + 'Z'
-    time_max = seven_days_later.isoformat() + 'Z'
-    if provider == 'google':
-        from googleapiclient.discovery import build as g_build
-        service = g_build('calendar', 'v3', credentials=creds)
-        freebusy_query = {
-            "timeMin": time_min,
-            "timeMax": time_max,
-            "timeZone": "UTC",
-            "items": [{"id": "primary"}]
-        }
-        freebusy_result = service.freebusy().query(body=freebusy_query).execute()
-        busy = freebusy_result['calendars']['primary'].get('busy', [])
-    elif provider == 'outlook':
-        # Get access token from session
-        ms_creds = session.get('ms_credentials')
-        if not ms_creds:
-            print('No Outlook credentials in session')
-            return
-        access_token = ms_creds.get('access_token')
-        headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
-        # Use getSchedule for free/busy info
-        # See: https://learn.microsoft.com/en-us/graph/api/calendar-getschedule
-        graph_url = 'https://graph.microsoft.com/v1.0/me/calendar/getSchedule'
-        body = {
-            "schedules": [email],
-            "startTime": {
-                "dateTime": now.strftime('%Y-%m-%dT%H:%M:%S'),
-                "timeZone": "UTC"
-            },
-            "endTime": {
-                "dateTime": seven_days_later.strftime('%Y-%m-%dT%H:%M:%S'),
-                "timeZone": "UTC"
-            },
-            "availabilityViewInterval": 60
-        }
-        resp = requests.post(graph_url, headers=headers, json=body)
-        if resp.status_code != 200:
-            print('Failed to fetch Outlook free/busy:', resp.text)
-            busy = []
-        else:
-            data = resp.json()
-            # Parse busy times to match Google format: [{start, end}]
-            busy = []
-            if data.get('value'):
-                for sched in data['value']:
-                    for b in sched.get('scheduleItems', []):
-                        if b['status'] == 'busy':
-                            busy.append({
-                                'start': b['start']['dateTime'],
-                                'end': b['end']['dateTime']
-                            })
-    print("Busy times:", busy)
-    # Upsert for each team
-    user_teams = teams_col.find({"members": email})
-    for team in user_teams:
-        print("Upserting availability for", email, "for team", team['name'])
-        availability_col.update_one(
-            {"team_id": str(team['_id']), "user_email": email},
-            {"$set": {"busy": busy}},
-            upsert=True
-        )
-
-
 @app.route('/oauth2callback')
 def oauth2callback():
     flow = Flow.from_client_secrets_file(
@@ -1224,22 +1248,33 @@ def oauth2callback():
         scopes=SCOPES,
         redirect_uri=os.environ.get('OAUTH2_REDIRECT_URI')
     )
-    flow.fetch_token(authorization_response=request.url)
+    with metrics.timer('login_step_seconds', provider='google', step='token'):
+        flow.fetch_token(authorization_response=request.url)
 
     creds = flow.credentials
-    session['credentials'] = {
-        'token': creds.token,
-        'refresh_token': creds.refresh_token,
-        'token_uri': creds.token_uri,
-        'client_id': creds.client_id,
-        'client_secret': creds.client_secret,
-        'scopes': creds.scopes
-    }
 
-    # Fetch user's email
-    from googleapiclient.discovery import build as g_build
-    people_service = g_build('people', 'v1', credentials=creds)
-    profile = people_service.people().get(resourceName='people/me', personFields='emailAddresses').execute()
+    def fetch_profile():
+        with metrics.timer('login_step_seconds', provider='google', step='profile'):
+            people_service = google_client.service('people', 'v1')
+            return google_client.execute(
+                people_service.people().get(resourceName='people/me', personFields='emailAddresses'), creds
+            )
+
+    def fetch_timezone():
+        # Fetch user's timezone from Google Calendar API (with fallback)
+        with metrics.timer('login_step_seconds', provider='google', step='timezone'):
+            try:
+                calendar_service = google_client.service('calendar', 'v3')
+                tz_settings = google_client.execute(calendar_service.settings().get(setting='timezone'), creds)
+                print(f"[DEBUG] Successfully fetched timezone: {tz_settings.get('value', 'UTC')}")
+                return tz_settings.get('value', 'UTC')
+            except Exception as e:
+                print(f"[DEBUG] Could not fetch timezone (using UTC): {e}")
+                return 'UTC'
+
+    # Profile and timezone come from different APIs, which share no batch
+    # endpoint, so the two calls run on threads instead
+    profile, user_tz = calendar_sync.gather([fetch_profile, fetch_timezone])
     print("Profile:", profile)
     email = None
     if 'emailAddresses' in profile:
@@ -1249,24 +1284,23 @@ def oauth2callback():
     if not email:
         return "Could not retrieve email from Google profile.", 400
     session['email'] = email
-
-    # Fetch user's timezone from Google Calendar API (with fallback)
-    user_tz = 'UTC'  # Default fallback
-    try:
-        calendar_service = g_build('calendar', 'v3', credentials=creds)
-        tz_settings = calendar_service.settings().get(setting='timezone').execute()
-        user_tz = tz_settings.get('value', 'UTC')
-        print(f"[DEBUG] Successfully fetched timezone: {user_tz}")
-    except Exception as e:
-        print(f"[DEBUG] Could not fetch timezone (using UTC): {e}")
-        user_tz = 'UTC'
+    session['provider'] = 'google'
+    # Tokens stay server-side, where background syncs can refresh them
+    token_store.save(db, email, 'google', {
+        'token': creds.token,
+        'refresh_token': creds.refresh_token,
+        'token_uri': creds.token_uri,
+        'client_id': creds.client_id,
+        'client_secret': creds.client_secret,
+        'scopes': creds.scopes
+    }, creds.expiry.replace(tzinfo=pytz.UTC) if creds.expiry else None)
 
     # Upsert user with timezone
     users_col.update_one({'email': email}, {'$set': {'name': email.split('@')[0], 'timezone': user_tz}}, upsert=True)
     print(f"[DEBUG] Google login: {email} timezone set to {user_tz}")
 
-    # Sync availability for all teams
-    sync_user_availability(email, creds)
+    # Sync availability for all teams in the background
+    jobs.enqueue_sync(db, email, 'google')
 
     return redirect(url_for('home'))
 
@@ -1380,5 +1414,49 @@ def logout():
     session.clear()
     return redirect(url_for('index'))
 
+# --- Maintenance Commands ---
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create any missing MongoDB indexes"""
+    from db_indexes import ensure_indexes, print_report
+    print_report(ensure_indexes(db))
+
+@app.cli.command('migrate-busy')
+def migrate_busy_command():
+    """Convert stored busy intervals to UTC BSON datetimes"""
+    from migrations import migrate_busy_storage
+    counts = migrate_busy_storage(db)
+    for collection, migrated in counts.items():
+        print(f"{collection}: migrated {migrated} documents")
+
+@app.cli.command('migrate-availability')
+def migrate_availability_command():
+    """Collapse per-team availability copies into one document per user"""
+    from migrations import migrate_availability_per_user
+    from db_indexes import ensure_indexes, print_report
+    counts = migrate_availability_per_user(db)
+    print(f"availability: {counts['users']} users, removed {counts['removed']} per-team documents")
+    print_report(ensure_indexes(db))
+
+@app.cli.command('migrate-tokens')
+def migrate_tokens_command():
+    """Move OAuth credentials kept with push channels into the token store"""
+    from migrations import migrate_channel_credentials
+    counts = migrate_channel_credentials(db)
+    print(f"oauth_tokens: moved {counts['moved']} credentials, cleared {counts['cleared']} channels")
+
+@app.cli.command('migrate-channels')
+def migrate_channels_command():
+    """Allow a push channel per calendar instead of per user"""
+    from migrations import migrate_channel_calendars
+    from db_indexes import ensure_indexes, print_report
+    counts = migrate_channel_calendars(db)
+    print(f"calendar_channels: {counts['channels']} channels on the default calendar")
+    print_report(ensure_indexes(db))
+
 if __name__ == '__main__':
+    token_store.check_key()
+    from db_indexes import ensure_indexes, print_report
+    print_report(ensure_indexes(db))
     app.run(host="0.0.0.0", port=5002, debug=True)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for Google API client construction.
+
+Compares building a service with googleapiclient.discovery.build() for
+every request (as the OAuth callback used to) with the cached services in
+google_client. Only request construction is timed; nothing is sent.
+Run from the project root:
+
+    python benchmarks/bench_google_client.py --number 50
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+import google_client
+
+APIS = [('calendar', 'v3'), ('people', 'v1')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Google API service construction")
+    parser.add_argument("--number", type=int, default=20, help="requests per timing run")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    creds = Credentials(token='benchmark')
+
+    def request(service, api):
+        if api == 'people':
+            return service.people().get(resourceName='people/me', personFields='emailAddresses')
+        return service.settings().get(setting='timezone')
+
+    print(f"{'api':>12} {'build ms':>10} {'cached ms':>10} {'speedup':>8}")
+    for api, version in APIS:
+        def uncached():
+            service = build(api, version, credentials=creds, static_discovery=True, cache_discovery=False)
+            return request(service, api)
+
+        def cached():
+            google_client.authorized_http(creds)
+            return request(google_client.service(api, version), api)
+
+        # Build the shared service outside the timed runs
+        cached()
+        runs = dict(number=args.number, repeat=args.repeat)
+        build_ms = min(timeit.repeat(uncached, **runs)) / args.number * 1000
+        cached_ms = min(timeit.repeat(cached, **runs)) / args.number * 1000
+        print(f"{api + '/' + version:>12} {build_ms:>10.3f} {cached_ms:>10.3f} {build_ms / cached_ms:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the scheduling engine.
+
+Compares filtering every candidate (free_slots) with the gap walk
+find_slots uses (candidate_slots with busy data) on synthetic teams.
+Run from the project root:
+
+    python benchmarks/bench_scheduling.py --members 50 100 200 --intervals 20 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduling import SearchSpec, candidate_slots, free_slots, merge_intervals
+
+
+def make_team(members, intervals, origin, rng):
+    """Random busy data: intervals per member spread over the next week"""
+    team = {}
+    for member in range(members):
+        busy = []
+        for _ in range(intervals):
+            start = origin + timedelta(minutes=rng.randrange(0, 7 * 24 * 60, 5))
+            busy.append((start, start + timedelta(minutes=rng.choice([15, 30, 60, 90]))))
+        team[f'user{member}@example.com'] = sorted(busy)
+    return team
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Calstack slot search engines")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--intervals", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--step", type=int, default=15, help="minutes between candidate starts")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    origin = datetime(2024, 1, 1, tzinfo=pytz.UTC)
+    spec = SearchSpec(
+        tz=pytz.UTC, now=origin, duration=30, start_hour=8, end_hour=20,
+        days_of_week=list(range(7)), step=args.step
+    )
+    candidates = list(candidate_slots(spec))
+
+    print(f"{'members':>8} {'intervals':>10} {'sweep ms':>10} {'gaps ms':>10}")
+    for members in args.members:
+        for intervals in args.intervals:
+            team = make_team(members, intervals, origin, rng)
+
+            def sweep():
+                busy = merge_intervals(i for busy in team.values() for i in busy)
+                return list(free_slots(candidates, busy))
+
+            def gaps():
+                busy = merge_intervals(i for busy in team.values() for i in busy)
+                return list(candidate_slots(spec, busy))
+
+            assert sweep() == gaps()
+            sweep_ms = min(timeit.repeat(sweep, number=1, repeat=args.repeat)) * 1000
+            gaps_ms = min(timeit.repeat(gaps, number=1, repeat=args.repeat)) * 1000
+            print(f"{members:>8} {intervals:>10} {sweep_ms:>10.2f} {gaps_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
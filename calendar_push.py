@@ -0,0 +1,286 @@
+"""
+Push notifications for calendar changes.
+
+After a user's calendars are synced, the worker registers a push channel
+for each of them: a Google Calendar events `watch` channel or a Microsoft
+Graph subscription on the calendar's events. That is the default
+calendar plus the other calendars the sync read, which calendar_sync
+records in users.secondary_calendars. The provider then calls
+/webhooks/google or /webhooks/outlook when a calendar changes, and
+handle_notification() marks the user's availability dirty and queues a
+sync for just that user.
+
+Channels expire (Google after the requested TTL, Graph event
+subscriptions after at most ~3 days), so the worker calls
+renew_channels() periodically and renews those expiring within
+CHANNEL_RENEW_HOURS.
+
+Enabled by setting CALENDAR_WEBHOOK_URL to the app's public https base
+URL. Google channels need the calendar.events.readonly scope.
+
+A notifier is any object with
+    subscribe(email, credentials, address, token, calendar_id) -> fields
+    renew(channel, credentials, address) -> fields
+    unsubscribe(channel, credentials)
+where fields holds at least 'channel_id' and 'expires_at', and
+calendar_id None means the default calendar. Channel documents in
+`calendar_channels` hold user_email, provider, calendar_id, channel_id,
+resource_id (Google), token and expires_at; the user's credentials come
+from the token store.
+"""
+import hmac
+import os
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import google_client
+import graph_client
+import metrics
+import token_store
+from calendar_sync import google_credentials
+from scheduling import to_utc
+
+WEBHOOK_URL = os.environ.get('CALENDAR_WEBHOOK_URL', '').rstrip('/')
+PUSH_ENABLED = bool(WEBHOOK_URL)
+CHANNEL_TTL_HOURS = int(os.environ.get('CHANNEL_TTL_HOURS', 7 * 24))
+CHANNEL_RENEW_HOURS = int(os.environ.get('CHANNEL_RENEW_HOURS', 12))
+# How long one worker holds a channel while renewing it
+RENEW_LEASE = timedelta(minutes=5)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def webhook_address(provider):
+    return f"{WEBHOOK_URL}/webhooks/{provider}"
+
+
+def needs_renewal(channel, now):
+    return to_utc(channel['expires_at']) < now + timedelta(hours=CHANNEL_RENEW_HOURS)
+
+
+def check_token(channel, token):
+    """Notifications carry the secret the channel was created with."""
+    return bool(channel) and hmac.compare_digest(channel['token'], token or '')
+
+
+def open_channel(notifier, email, provider, credentials, calendar_id=None):
+    """Subscribe to one of email's calendars; returns the channel document fields."""
+    token = secrets.token_urlsafe(24)
+    fields = notifier.subscribe(email, credentials, webhook_address(provider), token, calendar_id)
+    return dict(fields, user_email=email, provider=provider, calendar_id=calendar_id, token=token)
+
+
+def push_calendars(db, email, provider):
+    """Calendars of email's that get a channel: None (the default one) and the other synced ones."""
+    user = db.users.find_one({'email': email}, {'secondary_calendars': 1}) or {}
+    return [None] + (user.get('secondary_calendars') or {}).get(provider, [])
+
+
+# --- Channel lifecycle ---
+
+def ensure_channels(db, email, provider, credentials, notifiers=None, now=None):
+    """
+    Make sure each of email's synced calendars has a live push channel;
+    missing or expiring ones are replaced, and channels of calendars no
+    longer synced are stopped. A calendar that can't be watched (e.g.
+    one shared with free/busy access only) doesn't hold up the others.
+    """
+    notifier = (notifiers or NOTIFIERS)[provider]
+    now = now or _now()
+    calendar_ids = push_calendars(db, email, provider)
+    for calendar_id in calendar_ids:
+        try:
+            ensure_channel(db, notifier, email, provider, calendar_id, credentials, now)
+        except Exception as e:
+            print(f"Could not open {provider} push channel for {email} calendar {calendar_id or 'default'}: {e}")
+    for channel in db.calendar_channels.find(
+        {'user_email': email, 'provider': provider, 'calendar_id': {'$nin': calendar_ids}}
+    ):
+        db.calendar_channels.delete_one({'_id': channel['_id']})
+        try:
+            notifier.unsubscribe(channel, credentials)
+        except Exception as e:
+            print(f"Could not stop {provider} channel for {email}: {e}")
+
+
+def ensure_channel(db, notifier, email, provider, calendar_id, credentials, now):
+    """Open a channel for one calendar unless a live one exists."""
+    query = {'user_email': email, 'provider': provider, 'calendar_id': calendar_id}
+    channel = db.calendar_channels.find_one(query)
+    if channel and not needs_renewal(channel, now):
+        return
+    fields = open_channel(notifier, email, provider, credentials, calendar_id)
+    db.calendar_channels.update_one(
+        query, {'$set': dict(fields, created_at=now), '$unset': {'credentials': ''}}, upsert=True
+    )
+    if channel:
+        try:
+            notifier.unsubscribe(channel, credentials)
+        except Exception as e:
+            print(f"Could not stop old {provider} channel for {email}: {e}")
+    metrics.inc('calendar_channels_opened_total', provider=provider)
+
+
+def renew_channels(db, notifiers=None, now=None):
+    """
+    Renew every channel expiring within CHANNEL_RENEW_HOURS. Each channel
+    is leased first so concurrent workers don't renew it twice; a failed
+    renewal is retried once the lease lapses. Channels of users without
+    stored credentials are dropped. Returns how many were renewed.
+    """
+    notifiers = notifiers or NOTIFIERS
+    now = now or _now()
+    renewed = 0
+    while True:
+        channel = db.calendar_channels.find_one_and_update(
+            {
+                'expires_at': {'$lt': now + timedelta(hours=CHANNEL_RENEW_HOURS)},
+                '$or': [{'renew_lease': {'$exists': False}}, {'renew_lease': {'$lt': now}}]
+            },
+            {'$set': {'renew_lease': now + RENEW_LEASE}}
+        )
+        if channel is None:
+            return renewed
+        provider = channel['provider']
+        try:
+            credentials = token_store.get(db, channel['user_email'], provider)
+            if credentials is None:
+                # Access was revoked; the channel lapses and a new one opens on the next login
+                db.calendar_channels.delete_one({'_id': channel['_id']})
+                metrics.inc('calendar_channel_renewals_total', provider=provider, result='dropped')
+                continue
+            fields = notifiers[provider].renew(channel, credentials, webhook_address(provider))
+        except Exception as e:
+            print(f"Could not renew {provider} channel for {channel['user_email']}: {e}")
+            metrics.inc('calendar_channel_renewals_total', provider=provider, result='failed')
+            continue
+        db.calendar_channels.update_one(
+            {'_id': channel['_id']},
+            {'$set': fields, '$unset': {'renew_lease': '', 'credentials': ''}}
+        )
+        metrics.inc('calendar_channel_renewals_total', provider=provider, result='renewed')
+        renewed += 1
+
+
+# --- Notifications ---
+
+def mark_dirty(db, email, now=None):
+    """Flag email's availability as out of date until the next sync finishes."""
+    db.availability.update_one({'user_email': email}, {'$min': {'dirty_since': now or _now()}})
+
+
+def clear_dirty(db, email, synced_from):
+    """Clear the flag unless a newer notification arrived after the sync started."""
+    db.availability.update_one(
+        {'user_email': email, 'dirty_since': {'$lte': synced_from}},
+        {'$unset': {'dirty_since': ''}}
+    )
+
+
+def handle_notification(db, provider, channel_id, token):
+    """
+    Queue a sync for the user behind channel_id. Returns False when the
+    channel is unknown or the token does not match.
+    """
+    import jobs
+    channel = db.calendar_channels.find_one({'provider': provider, 'channel_id': channel_id})
+    if not check_token(channel, token):
+        metrics.inc('calendar_notifications_total', provider=provider, result='rejected')
+        return False
+    mark_dirty(db, channel['user_email'])
+    jobs.enqueue_sync(db, channel['user_email'], provider)
+    metrics.inc('calendar_notifications_total', provider=provider, result='queued')
+    return True
+
+
+# --- Provider notifiers ---
+
+class GoogleNotifier:
+    """Google Calendar events.watch channels; renewing opens a new channel."""
+
+    def subscribe(self, email, credentials, address, token, calendar_id=None):
+        channel_id = str(uuid.uuid4())
+        request = google_client.service('calendar', 'v3').events().watch(calendarId=calendar_id or 'primary', body={
+            'id': channel_id,
+            'type': 'web_hook',
+            'address': address,
+            'token': token,
+            'params': {'ttl': str(CHANNEL_TTL_HOURS * 3600)}
+        })
+        result = google_client.execute(request, google_credentials(credentials))
+        expires_at = datetime.fromtimestamp(int(result['expiration']) / 1000, timezone.utc)
+        return {'channel_id': channel_id, 'resource_id': result['resourceId'], 'expires_at': expires_at}
+
+    def renew(self, channel, credentials, address):
+        fields = self.subscribe(
+            channel['user_email'], credentials, address, channel['token'], channel.get('calendar_id')
+        )
+        try:
+            self.unsubscribe(channel, credentials)
+        except Exception as e:
+            print(f"Could not stop old google channel for {channel['user_email']}: {e}")
+        return fields
+
+    def unsubscribe(self, channel, credentials):
+        request = google_client.service('calendar', 'v3').channels().stop(body={
+            'id': channel['channel_id'],
+            'resourceId': channel['resource_id']
+        })
+        google_client.execute(request, google_credentials(credentials))
+
+
+class OutlookNotifier:
+    """Microsoft Graph subscriptions on a calendar's events, renewed in place."""
+    SUBSCRIPTIONS_URL = '/subscriptions'
+    # Graph caps subscriptions on events at 4230 minutes
+    MAX_TTL = timedelta(minutes=4200)
+
+    def _expiry(self):
+        return _now() + min(self.MAX_TTL, timedelta(hours=CHANNEL_TTL_HOURS))
+
+    def subscribe(self, email, credentials, address, token, calendar_id=None):
+        expires_at = self._expiry()
+        headers = graph_client.auth_headers(credentials['access_token'])
+        resp = graph_client.post(self.SUBSCRIPTIONS_URL, 'subscriptions.create', headers=headers, json={
+            'changeType': 'created,updated,deleted',
+            'notificationUrl': address,
+            'resource': f'me/calendars/{calendar_id}/events' if calendar_id else 'me/events',
+            'expirationDateTime': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'clientState': token
+        })
+        if resp.status_code != 201:
+            raise RuntimeError(f"Graph subscription failed ({resp.status_code}): {resp.text}")
+        return {'channel_id': resp.json()['id'], 'expires_at': expires_at}
+
+    def renew(self, channel, credentials, address):
+        expires_at = self._expiry()
+        resp = graph_client.patch(
+            f"{self.SUBSCRIPTIONS_URL}/{channel['channel_id']}",
+            'subscriptions.renew',
+            headers=graph_client.auth_headers(credentials['access_token']),
+            json={'expirationDateTime': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        )
+        if resp.status_code == 404:
+            # Already expired and removed by Graph
+            return self.subscribe(
+                channel['user_email'], credentials, address, channel['token'], channel.get('calendar_id')
+            )
+        if resp.status_code != 200:
+            raise RuntimeError(f"Graph subscription renewal failed ({resp.status_code}): {resp.text}")
+        return {'expires_at': expires_at}
+
+    def unsubscribe(self, channel, credentials):
+        graph_client.delete(
+            f"{self.SUBSCRIPTIONS_URL}/{channel['channel_id']}",
+            'subscriptions.delete',
+            headers=graph_client.auth_headers(credentials['access_token'])
+        )
+
+
+NOTIFIERS = {
+    'google': GoogleNotifier(),
+    'outlook': OutlookNotifier(),
+}
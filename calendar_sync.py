@@ -0,0 +1,401 @@
+"""
+Calendar provider sync for Calstack.
+
+Fetches a user's busy times from Google Calendar, Microsoft Graph or
+their uploaded ICS data and stores them in the user's availability
+document, which every team they belong to reads. Nothing here
+depends on Flask or the session, so the web app and the background
+worker (worker.py) share it. With INCREMENTAL_SYNC=1 Google and
+Outlook calendars are synced from event changes instead (see
+incremental_sync.py).
+
+Full syncs cover all of a user's calendars: every selected Google
+calendar (queried together in freebusy requests of up to
+FREEBUSY_MAX_ITEMS calendars) and every calendar in the user's Outlook
+mailbox. Requests for one user run concurrently on up to
+CALENDAR_FETCH_WORKERS threads and their busy periods are merged.
+
+Outlook users of one organisation (tenant) whose only calendar is the
+default one can also be synced together: sync_outlook_schedules() reads
+up to GRAPH_SCHEDULES_PER_CALL mailboxes per getSchedule call with one
+colleague's token.
+"""
+import datetime
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import google_client
+import graph_client
+import metrics
+import token_store
+from scheduling import DEFAULT_HORIZON_DAYS, merge_intervals, normalize_busy, parse_busy
+
+# Days fetched per sync: the default slot search horizon plus a day, so a
+# default search stays covered between re-syncs (see scheduler.py)
+SYNC_DAYS = int(os.environ.get('SYNC_DAYS', DEFAULT_HORIZON_DAYS + 1))
+INCREMENTAL_SYNC = os.environ.get('INCREMENTAL_SYNC') == '1'
+CALENDAR_FETCH_WORKERS = int(os.environ.get('CALENDAR_FETCH_WORKERS', 4))
+# Google's limit on calendars per freebusy query
+FREEBUSY_MAX_ITEMS = 50
+GOOGLE_CALENDAR_LIST_SCOPE = 'https://www.googleapis.com/auth/calendar.calendarlist.readonly'
+# Mailboxes per Graph getSchedule call
+GRAPH_SCHEDULES_PER_CALL = 20
+# Personal Microsoft accounts all share this tenant but not their schedules
+MS_CONSUMER_TENANT = '9188040d-6c67-4c5b-b112-36a304b66dad'
+
+
+class SyncError(Exception):
+    """A provider could not be read; the sync job is retried."""
+
+
+def sync_window(days=SYNC_DAYS):
+    """(now, now + days) as naive UTC datetimes."""
+    now = datetime.datetime.utcnow()
+    return now, now + datetime.timedelta(days=days)
+
+
+def google_credentials(creds_dict):
+    """Build google Credentials from the dict kept in the session."""
+    from google.oauth2.credentials import Credentials
+    return Credentials(
+        creds_dict['token'],
+        refresh_token=creds_dict.get('refresh_token'),
+        token_uri=creds_dict['token_uri'],
+        client_id=creds_dict['client_id'],
+        client_secret=creds_dict['client_secret'],
+        scopes=creds_dict['scopes']
+    )
+
+
+def gather(calls):
+    """Run zero-argument calls concurrently on a bounded pool; results in order."""
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    with ThreadPoolExecutor(max_workers=min(CALENDAR_FETCH_WORKERS, len(calls))) as pool:
+        futures = [pool.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+
+def merge_busy(busy_lists):
+    """Merge busy lists of several calendars into one sorted list without overlaps."""
+    intervals = merge_intervals(interval for busy in busy_lists for interval in parse_busy(busy))
+    return [{'start': start, 'end': end} for start, end in intervals]
+
+
+def google_calendar_ids(creds):
+    """
+    IDs of the Google calendars the user has selected. Grants made before
+    the calendar list scope was requested only cover the primary calendar.
+    """
+    from googleapiclient.errors import HttpError
+    service = google_client.service('calendar', 'v3')
+    ids = []
+    page_token = None
+    try:
+        while True:
+            result = google_client.execute(service.calendarList().list(
+                minAccessRole='freeBusyReader',
+                pageToken=page_token,
+                fields='items(id,primary,selected),nextPageToken'
+            ), creds)
+            ids.extend(c['id'] for c in result.get('items', []) if c.get('selected') or c.get('primary'))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return ids or ['primary']
+    except HttpError as e:
+        if e.resp.status != 403:
+            raise
+        return ['primary']
+
+
+def fetch_google_busy(creds, time_min, time_max, calendar_ids=None):
+    """
+    Busy periods of the given Google calendars (default: primary) between
+    time_min and time_max, one freebusy request per FREEBUSY_MAX_ITEMS
+    calendars.
+    """
+    calendar_ids = calendar_ids or ['primary']
+    service = google_client.service('calendar', 'v3')
+
+    def query(chunk):
+        freebusy_query = {
+            "timeMin": time_min.isoformat() + 'Z',
+            "timeMax": time_max.isoformat() + 'Z',
+            "timeZone": "UTC",
+            "items": [{"id": calendar_id} for calendar_id in chunk]
+        }
+        freebusy_result = google_client.execute(service.freebusy().query(body=freebusy_query), creds)
+        busy = []
+        for calendar_id in chunk:
+            calendar = freebusy_result['calendars'].get(calendar_id, {})
+            if calendar.get('errors'):
+                # e.g. a subscribed calendar that no longer exists
+                print(f"Skipping Google calendar {calendar_id}: {calendar['errors']}")
+                continue
+            busy.extend(calendar.get('busy', []))
+        return busy
+
+    chunks = [calendar_ids[i:i + FREEBUSY_MAX_ITEMS] for i in range(0, len(calendar_ids), FREEBUSY_MAX_ITEMS)]
+    return merge_busy(gather([lambda chunk=chunk: query(chunk) for chunk in chunks]))
+
+
+def parse_graph_schedule(data):
+    """Busy items of a Graph getSchedule response in Google's [{start, end}] format."""
+    busy = []
+    for sched in data.get('value') or []:
+        for b in sched.get('scheduleItems', []):
+            if b['status'] == 'busy':
+                busy.append({
+                    'start': b['start']['dateTime'],
+                    'end': b['end']['dateTime']
+                })
+    return busy
+
+
+def parse_graph_schedules(data):
+    """
+    Busy items per mailbox of a getSchedule response, as {email: busy}
+    with lower-cased emails. Mailboxes Graph returned an error for are
+    left out.
+    """
+    schedules = {}
+    for sched in data.get('value') or []:
+        if sched.get('error'):
+            continue
+        schedules[sched['scheduleId'].lower()] = parse_graph_schedule({'value': [sched]})
+    return schedules
+
+
+def get_schedule(access_token, emails, time_min, time_max):
+    """Raw Microsoft Graph getSchedule response for emails between time_min and time_max."""
+    # See: https://learn.microsoft.com/en-us/graph/api/calendar-getschedule
+    body = {
+        "schedules": list(emails),
+        "startTime": {
+            "dateTime": time_min.strftime('%Y-%m-%dT%H:%M:%S'),
+            "timeZone": "UTC"
+        },
+        "endTime": {
+            "dateTime": time_max.strftime('%Y-%m-%dT%H:%M:%S'),
+            "timeZone": "UTC"
+        },
+        "availabilityViewInterval": 60
+    }
+    resp = graph_client.post(
+        '/me/calendar/getSchedule', 'getSchedule', headers=graph_client.auth_headers(access_token), json=body
+    )
+    if resp.status_code != 200:
+        raise SyncError(f"Failed to fetch Outlook free/busy ({resp.status_code}): {resp.text}")
+    return resp.json()
+
+
+def fetch_outlook_busy(access_token, email, time_min, time_max):
+    """Busy periods from Microsoft Graph getSchedule between time_min and time_max."""
+    return parse_graph_schedule(get_schedule(access_token, [email], time_min, time_max))
+
+
+def fetch_outlook_schedules(access_token, emails, time_min, time_max):
+    """
+    {email: busy} for many mailboxes of one tenant, GRAPH_SCHEDULES_PER_CALL
+    per getSchedule call, with the calls made concurrently.
+    """
+    chunks = [emails[i:i + GRAPH_SCHEDULES_PER_CALL] for i in range(0, len(emails), GRAPH_SCHEDULES_PER_CALL)]
+    schedules = {}
+    for data in gather([lambda chunk=chunk: get_schedule(access_token, chunk, time_min, time_max) for chunk in chunks]):
+        schedules.update(parse_graph_schedules(data))
+    return schedules
+
+
+def outlook_calendar_ids(access_token, email):
+    """IDs of the user's own Outlook calendars other than the default one."""
+    resp = graph_client.get(
+        '/me/calendars', 'calendars',
+        headers=graph_client.auth_headers(access_token),
+        params={'$select': 'id,isDefaultCalendar,owner', '$top': 100}
+    )
+    if resp.status_code != 200:
+        raise SyncError(f"Failed to list Outlook calendars ({resp.status_code}): {resp.text}")
+    return [
+        c['id'] for c in resp.json().get('value', [])
+        if not c.get('isDefaultCalendar')
+        # Calendars shared with the user belong to someone else's schedule
+        and (c.get('owner') or {}).get('address', '').lower() == email.lower()
+    ]
+
+
+def fetch_outlook_calendar_busy(access_token, calendar_id, time_min, time_max):
+    """Busy events of one Outlook calendar between time_min and time_max, via calendarView."""
+    headers = dict(graph_client.auth_headers(access_token), Prefer='outlook.timezone="UTC"')
+    url = f"/me/calendars/{calendar_id}/calendarView"
+    params = {
+        'startDateTime': time_min.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'endDateTime': time_max.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        '$select': 'start,end,showAs,isCancelled',
+        '$top': 200
+    }
+    busy = []
+    while url:
+        resp = graph_client.get(url, 'calendarView', headers=headers, params=params)
+        if resp.status_code != 200:
+            raise SyncError(f"Failed to fetch Outlook calendar ({resp.status_code}): {resp.text}")
+        data = resp.json()
+        busy.extend(
+            {'start': e['start']['dateTime'], 'end': e['end']['dateTime']}
+            for e in data.get('value', [])
+            # Same rule as getSchedule: only events shown as busy
+            if e.get('showAs') == 'busy' and not e.get('isCancelled')
+        )
+        url, params = data.get('@odata.nextLink'), None
+    return busy
+
+
+def fetch_outlook_calendars_busy(access_token, email, time_min, time_max, calendar_ids):
+    """
+    Busy periods of all of the user's Outlook calendars: getSchedule for
+    the default calendar and calendarView for the other calendar_ids,
+    concurrently.
+    """
+    calls = [lambda: fetch_outlook_busy(access_token, email, time_min, time_max)]
+    calls.extend(
+        lambda calendar_id=calendar_id: fetch_outlook_calendar_busy(access_token, calendar_id, time_min, time_max)
+        for calendar_id in calendar_ids
+    )
+    return merge_busy(gather(calls))
+
+
+def busy_hash(busy):
+    """Content hash of a normalize_busy() list, stored to detect unchanged syncs."""
+    digest = hashlib.sha256()
+    for b in busy:
+        digest.update(f"{b['start'].isoformat()}/{b['end'].isoformat()};".encode())
+    return digest.hexdigest()
+
+
+def store_busy(db, email, busy, provider=None, covered_until=None):
+    """
+    Upsert email's availability document (one per user, shared by all
+    their teams) and bump the availability version of their teams.
+    When the busy list is unchanged only the sync stamps (synced_at,
+    covered_until) are written and cached searches stay valid.
+    Returns the number of busy periods.
+    """
+    busy = normalize_busy(busy)
+    content_hash = busy_hash(busy)
+    stamps = {
+        "provider": provider,
+        "synced_at": datetime.datetime.now(datetime.timezone.utc),
+        # End of the fetched window; the scheduler re-syncs before it runs out
+        "covered_until": covered_until
+    }
+    current = db.availability.find_one({"user_email": email}, {"busy_hash": 1})
+    if current and current.get('busy_hash') == content_hash:
+        db.availability.update_one({"_id": current['_id']}, {"$set": stamps})
+        metrics.inc('availability_syncs_total', result='unchanged')
+        return len(busy)
+    db.availability.update_one(
+        {"user_email": email},
+        {
+            "$set": dict(stamps, busy=busy, busy_hash=content_hash, updated_at=stamps['synced_at']),
+            "$inc": {"version": 1}
+        },
+        upsert=True
+    )
+    db.teams.update_many({"members": email}, {"$inc": {"availability_version": 1}})
+    metrics.inc('availability_syncs_total', result='changed')
+    return len(busy)
+
+
+def schedule_peers(db, email):
+    """
+    Other Outlook users in email's tenant that getSchedule fully covers,
+    i.e. whose last sync found no calendars besides the default one.
+    """
+    user = db.users.find_one({'email': email}, {'ms_tenant_id': 1})
+    tenant = user.get('ms_tenant_id') if user else None
+    if not tenant or tenant == MS_CONSUMER_TENANT:
+        return []
+    return db.users.distinct('email', {
+        'ms_tenant_id': tenant,
+        'ms_secondary_calendars': 0,
+        'email': {'$ne': email}
+    })
+
+
+def sync_outlook_schedules(db, emails, access_token):
+    """
+    Sync same-tenant Outlook users from batched getSchedule calls made
+    with one colleague's access_token. Returns the emails synced; those
+    Graph could not read need a sync of their own.
+    """
+    time_min, time_max = sync_window()
+    schedules = fetch_outlook_schedules(access_token, list(emails), time_min, time_max)
+    covered_until = time_max.replace(tzinfo=datetime.timezone.utc)
+    synced = []
+    for email in emails:
+        busy = schedules.get(email.lower())
+        if busy is not None:
+            store_busy(db, email, busy, 'outlook', covered_until)
+            synced.append(email)
+    return synced
+
+
+def record_secondary_calendars(db, email, provider, calendar_ids):
+    """Remember the synced calendars besides the default one; each gets a push channel."""
+    db.users.update_one(
+        {'email': email, f'secondary_calendars.{provider}': {'$ne': calendar_ids}},
+        {'$set': {f'secondary_calendars.{provider}': calendar_ids}}
+    )
+
+
+def sync_user(db, email, provider, credentials=None):
+    """
+    Fetch email's busy times for the next SYNC_DAYS days and store them.
+    provider is 'google', 'outlook' or 'manual' (stored ICS data).
+    credentials defaults to the user's credentials in the token store:
+    Google's credentials dict or Outlook's {'access_token', ...}.
+    Returns the number of busy periods stored, or None if there was
+    nothing to sync.
+    """
+    time_min, time_max = sync_window()
+    if provider == 'manual':
+        user = db.users.find_one({'email': email, 'auth_method': 'manual'}, {'ics_calendar_data': 1})
+        if not user or not user.get('ics_calendar_data'):
+            return None
+        # Uploaded calendars don't go stale; the user uploads a new file
+        return store_busy(db, email, user['ics_calendar_data'], provider)
+    credentials = credentials or token_store.get(db, email, provider)
+    if not credentials:
+        raise SyncError(f"No {provider} credentials for {email}")
+    elif provider == 'google':
+        creds = google_credentials(credentials)
+        calendar_ids = google_calendar_ids(creds)
+        # The primary calendar's id is the account's address
+        secondary = [c for c in calendar_ids if c.lower() not in ('primary', email.lower())]
+        record_secondary_calendars(db, email, provider, secondary)
+        # Incremental cursors only follow the primary calendar
+        if INCREMENTAL_SYNC and not secondary:
+            import incremental_sync
+            try:
+                return incremental_sync.sync_events(db, email, incremental_sync.GoogleEvents(creds))
+            except PermissionError as e:
+                # Granted before the events scope was requested; free/busy still works
+                print(f"Incremental sync not permitted for {email}, using free/busy: {e}")
+        busy = fetch_google_busy(creds, time_min, time_max, calendar_ids)
+    elif provider == 'outlook':
+        access_token = credentials['access_token']
+        calendar_ids = outlook_calendar_ids(access_token, email)
+        # Users with just a default calendar can be synced in tenant batches (schedule_peers)
+        db.users.update_one(
+            {'email': email, 'ms_secondary_calendars': {'$ne': len(calendar_ids)}},
+            {'$set': {'ms_secondary_calendars': len(calendar_ids)}}
+        )
+        record_secondary_calendars(db, email, provider, calendar_ids)
+        # Incremental cursors only follow the default calendar
+        if INCREMENTAL_SYNC and not calendar_ids:
+            import incremental_sync
+            return incremental_sync.sync_events(db, email, incremental_sync.OutlookEvents(access_token))
+        busy = fetch_outlook_calendars_busy(access_token, email, time_min, time_max, calendar_ids)
+    else:
+        raise SyncError(f"Unknown calendar provider {provider}")
+    return store_busy(db, email, busy, provider, time_max.replace(tzinfo=datetime.timezone.utc))
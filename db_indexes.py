@@ -0,0 +1,132 @@
+"""
+Index provisioning for Calstack collections.
+
+ensure_indexes() is idempotent: it only creates indexes that are missing
+and reports what it did. It runs from the Flask CLI
+(`flask --app app ensure-indexes`), from `python app.py`, from the
+gunicorn master on start (see gunicorn.conf.py) and at import time when
+ENSURE_INDEXES=1.
+"""
+from pymongo import ASCENDING
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+# collection -> [(index name, keys, options)]
+INDEXES = {
+    'users': [
+        ('email_unique', [('email', ASCENDING)], {'unique': True}),
+        # Outlook colleagues synced in one getSchedule batch (calendar_sync.schedule_peers)
+        ('ms_tenant', [('ms_tenant_id', ASCENDING), ('ms_secondary_calendars', ASCENDING)],
+         {'partialFilterExpression': {'ms_tenant_id': {'$exists': True}}}),
+    ],
+    'teams': [
+        ('code_unique', [('code', ASCENDING)], {'unique': True}),
+        ('members', [('members', ASCENDING)], {}),
+        ('last_search_at', [('last_search_at', ASCENDING)], {}),
+    ],
+    'availability': [
+        # One document per user since migrate-availability
+        ('user_email_unique', [('user_email', ASCENDING)], {'unique': True}),
+        # The scheduler's stale query
+        ('synced_at', [('synced_at', ASCENDING)], {}),
+        ('covered_until', [('covered_until', ASCENDING)], {}),
+    ],
+    'polls': [
+        ('team_status', [('team_id', ASCENDING), ('status', ASCENDING)], {}),
+    ],
+    'meetings': [
+        ('team_id', [('team_id', ASCENDING)], {}),
+    ],
+    'sync_state': [
+        ('user_email_unique', [('user_email', ASCENDING)], {'unique': True}),
+    ],
+    'oauth_tokens': [
+        ('user_provider_unique', [('user_email', ASCENDING), ('provider', ASCENDING)], {'unique': True}),
+        ('expires_at', [('expires_at', ASCENDING)], {}),
+    ],
+    'email_outbox': [
+        ('idempotency_key_unique', [('idempotency_key', ASCENDING)], {'unique': True}),
+        ('status_run_at', [('status', ASCENDING), ('run_at', ASCENDING)], {}),
+        ('status_group_run_at', [('status', ASCENDING), ('group_key', ASCENDING), ('run_at', ASCENDING)], {}),
+        ('batch', [('batch', ASCENDING)], {}),
+        # Sent and failed emails are removed 30 days after they finish
+        ('finished_ttl', [('finished_at', ASCENDING)], {'expireAfterSeconds': 30 * 24 * 3600}),
+    ],
+    'calendar_channels': [
+        # One channel per synced calendar since migrate-channels
+        ('user_provider_calendar_unique',
+         [('user_email', ASCENDING), ('provider', ASCENDING), ('calendar_id', ASCENDING)], {'unique': True}),
+        ('provider_channel', [('provider', ASCENDING), ('channel_id', ASCENDING)], {}),
+        ('expires_at', [('expires_at', ASCENDING)], {}),
+    ],
+    'jobs': [
+        # At most one queued sync per user; enqueue_sync() merges into it
+        ('queued_unique', [('type', ASCENDING), ('email', ASCENDING)],
+         {'unique': True, 'partialFilterExpression': {'status': 'queued'}}),
+        ('status_run_at', [('status', ASCENDING), ('run_at', ASCENDING)], {}),
+        ('provider_started', [('provider', ASCENDING), ('started_at', ASCENDING)], {}),
+        # Finished jobs are kept for a week
+        ('finished_ttl', [('finished_at', ASCENDING)], {'expireAfterSeconds': 7 * 24 * 3600}),
+    ],
+}
+
+
+def ensure_indexes(db, indexes=None):
+    """
+    Create every missing index. An index counts as present when one with
+    the same key pattern, uniqueness and partial filter exists, whatever
+    its name. One with the same key but other options is reported as
+    failed (creating ours would clash with it); drop it to rebuild.
+    Returns {'created': [...], 'existing': [...], 'failed': [(name, error)]}
+    with names in 'collection.index' form. If MongoDB can't be reached the
+    remaining collections are not tried.
+    """
+    report = {'created': [], 'existing': [], 'failed': []}
+    for collection_name, specs in (indexes or INDEXES).items():
+        collection = db[collection_name]
+        try:
+            existing = {}
+            for existing_name, info in collection.index_information().items():
+                key = tuple((field, direction) for field, direction in info['key'])
+                existing.setdefault(key, []).append((existing_name, info))
+        except ConnectionFailure as e:
+            report['failed'].append((collection_name, str(e)))
+            return report
+        except PyMongoError as e:
+            report['failed'].append((collection_name, str(e)))
+            continue
+        for name, keys, options in specs:
+            full_name = f"{collection_name}.{name}"
+            same_key = existing.get(tuple(keys), [])
+            if any(same_options(info, options) for _, info in same_key):
+                report['existing'].append(full_name)
+                continue
+            if same_key:
+                report['failed'].append((full_name, f"index {same_key[0][0]} has the same key with other options"))
+                continue
+            try:
+                collection.create_index(keys, name=name, **options)
+                report['created'].append(full_name)
+            except ConnectionFailure as e:
+                report['failed'].append((full_name, str(e)))
+                return report
+            except PyMongoError as e:
+                # e.g. duplicate values blocking a unique index; report, don't crash startup
+                report['failed'].append((full_name, str(e)))
+    return report
+
+
+def same_options(info, options):
+    """Whether an existing index (index_information() entry) enforces what options ask for."""
+    return (
+        bool(info.get('unique')) == bool(options.get('unique'))
+        and dict(info.get('partialFilterExpression') or {}) == (options.get('partialFilterExpression') or {})
+    )
+
+
+def print_report(report):
+    for name in report['created']:
+        print(f"Created missing index {name}")
+    for name, error in report['failed']:
+        print(f"Could not create index {name}: {error}")
+    if not report['created'] and not report['failed']:
+        print(f"All {len(report['existing'])} indexes present")
@@ -0,0 +1,62 @@
+"""
+Google API client layer for Calstack.
+
+googleapiclient.discovery.build() loads and parses the API's discovery
+document on every call. Here each (API, version) service is built once
+per process from the discovery documents bundled with
+google-api-python-client, with no credentials attached. Credentials are
+bound per call instead, by executing requests over an AuthorizedHttp:
+
+    service = google_client.service('calendar', 'v3')
+    google_client.execute(service.freebusy().query(body=query), creds)
+
+Service objects hold no sockets, so building them before a fork is
+fine. Each execute() gets its own AuthorizedHttp, so threads never share
+an httplib2 connection.
+"""
+import os
+import threading
+
+import metrics
+
+HTTP_TIMEOUT = int(os.environ.get('GOOGLE_HTTP_TIMEOUT', 30))
+
+_services = {}
+_lock = threading.Lock()
+
+
+def service(api, version):
+    """The shared, credential-less service object for api/version."""
+    key = (api, version)
+    built = _services.get(key)
+    if built is None:
+        with _lock:
+            built = _services.get(key)
+            if built is None:
+                built = _build(api, version)
+                _services[key] = built
+    return built
+
+
+def _build(api, version):
+    import httplib2
+    from googleapiclient.discovery import build
+    # static_discovery reads the document shipped with the library; no HTTP fetch
+    return build(
+        api, version,
+        http=httplib2.Http(timeout=HTTP_TIMEOUT),
+        static_discovery=True,
+        cache_discovery=False
+    )
+
+
+def authorized_http(creds):
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    return AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+
+
+def execute(request, creds, name=None):
+    """Execute an API request with creds, timing it as google_request_seconds{call=name}."""
+    with metrics.timer('google_request_seconds', call=name or request.methodId):
+        return request.execute(http=authorized_http(creds))
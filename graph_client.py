@@ -0,0 +1,185 @@
+"""
+Microsoft Graph and Microsoft identity HTTP client for Calstack.
+
+All Graph and token endpoint calls go through one requests.Session per
+process, so connections are kept alive and reused instead of opening a
+new TCP+TLS connection per call. A session created before a fork is not
+reused by the child; each worker process opens its own.
+
+Requests time out after GRAPH_TIMEOUT seconds. Throttled (429) and
+unavailable (503) responses are retried up to GRAPH_MAX_RETRIES times,
+waiting as long as the Retry-After header asks (capped at
+GRAPH_RETRY_MAX_WAIT) or backing off exponentially when it is absent.
+A call, attempts and waits included, never takes longer than its budget:
+GRAPH_RETRY_BUDGET seconds in workers, and INTERACTIVE_BUDGET for calls
+made while a user waits (OAuth callbacks), which must finish well within
+gunicorn's worker timeout.
+Each call is timed as graph_request_seconds{call=name}. batch() sends
+several GETs in one JSON batch request and retries the ones Graph
+throttled inside it the same way.
+
+    resp = graph_client.get('/me', 'me', headers=graph_client.auth_headers(token))
+"""
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+TIMEOUT = int(os.environ.get('GRAPH_TIMEOUT', 30))
+MAX_RETRIES = int(os.environ.get('GRAPH_MAX_RETRIES', 3))
+RETRY_MAX_WAIT = int(os.environ.get('GRAPH_RETRY_MAX_WAIT', 30))
+POOL_SIZE = int(os.environ.get('GRAPH_POOL_SIZE', 10))
+RETRY_BUDGET = int(os.environ.get('GRAPH_RETRY_BUDGET', 120))
+INTERACTIVE_BUDGET = int(os.environ.get('GRAPH_INTERACTIVE_BUDGET', 15))
+RETRY_STATUSES = (429, 503)
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+
+
+def session():
+    """The process's shared session, created on first use after a fork."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _new_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def _new_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    new = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    new.mount('https://', adapter)
+    return new
+
+
+def auth_headers(access_token):
+    return {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+
+
+def retry_after(resp, attempt, now=None):
+    """Seconds to wait before retrying resp, from Retry-After or exponential backoff."""
+    header = resp.headers.get('Retry-After')
+    wait = None
+    if header:
+        try:
+            wait = float(header)
+        except ValueError:
+            try:
+                wait = parsedate_to_datetime(header).timestamp() - (now or time.time())
+            except (TypeError, ValueError):
+                wait = None
+    if wait is None:
+        wait = 2 ** attempt + random.uniform(0, 1)
+    return min(max(wait, 0), RETRY_MAX_WAIT)
+
+
+def request(method, url, name, budget=None, **kwargs):
+    """
+    Send a request, retrying 429/503 responses. url may be a full URL or a
+    Graph path such as '/me'. budget is the most seconds the call may take
+    (RETRY_BUDGET by default): each attempt's timeout is cut to what is
+    left, and a retry whose wait would overrun it is not made. Returns the
+    last response; callers check its status code as they would with
+    requests.
+    """
+    if url.startswith('/'):
+        url = GRAPH_URL + url
+    timeout = kwargs.pop('timeout', TIMEOUT)
+    deadline = time.monotonic() + (RETRY_BUDGET if budget is None else budget)
+    attempt = 0
+    while True:
+        remaining = max(deadline - time.monotonic(), 1)
+        with metrics.timer('graph_request_seconds', call=name):
+            resp = session().request(method, url, timeout=min(timeout, remaining), **kwargs)
+        if resp.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+            return resp
+        wait = retry_after(resp, attempt)
+        if time.monotonic() + wait >= deadline:
+            return resp
+        metrics.inc('graph_retries_total', call=name, status=resp.status_code)
+        time.sleep(wait)
+        attempt += 1
+
+
+def get(url, name, **kwargs):
+    return request('GET', url, name, **kwargs)
+
+
+def post(url, name, **kwargs):
+    return request('POST', url, name, **kwargs)
+
+
+def patch(url, name, **kwargs):
+    return request('PATCH', url, name, **kwargs)
+
+
+def delete(url, name, **kwargs):
+    return request('DELETE', url, name, **kwargs)
+
+
+class BatchResponse:
+    """One response of a JSON batch, read like a requests response."""
+
+    def __init__(self, status_code, body, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    @property
+    def text(self):
+        return self.body if isinstance(self.body, str) else json.dumps(self.body)
+
+
+def batch(access_token, urls, name, budget=None):
+    """
+    GET up to 20 Graph paths in one $batch request. Returns a
+    BatchResponse per url, in order; if the batch itself fails, each
+    carries the batch's status. Paths Graph throttled (429/503) inside
+    the batch are sent again in a smaller batch, after the longest of
+    their Retry-After waits, within the same retry limit and budget as
+    request().
+    """
+    deadline = time.monotonic() + (RETRY_BUDGET if budget is None else budget)
+    responses = [None] * len(urls)
+    pending = list(range(len(urls)))
+    attempt = 0
+    while True:
+        requests = [{'id': str(i), 'method': 'GET', 'url': urls[i]} for i in pending]
+        resp = post('/$batch', name, budget=max(deadline - time.monotonic(), 1),
+                    headers=auth_headers(access_token), json={'requests': requests})
+        if resp.status_code != 200:
+            for i in pending:
+                responses[i] = BatchResponse(resp.status_code, resp.text)
+            return responses
+        results = {item['id']: item for item in resp.json().get('responses', [])}
+        for i in pending:
+            item = results.get(str(i))
+            if item is None:
+                responses[i] = BatchResponse(502, 'missing from batch response')
+            else:
+                responses[i] = BatchResponse(item['status'], item.get('body'), item.get('headers'))
+        throttled = [i for i in pending if responses[i].status_code in RETRY_STATUSES]
+        if not throttled or attempt >= MAX_RETRIES:
+            return responses
+        wait = max(retry_after(responses[i], attempt) for i in throttled)
+        if time.monotonic() + wait >= deadline:
+            return responses
+        for i in throttled:
+            metrics.inc('graph_retries_total', call=name, status=responses[i].status_code)
+        time.sleep(wait)
+        pending = throttled
+        attempt += 1
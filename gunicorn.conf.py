@@ -0,0 +1,58 @@
+"""
+Gunicorn configuration for Calstack.
+
+gunicorn picks this file up automatically from the working directory
+(or pass --config gunicorn.conf.py). Every setting can be overridden
+through the environment.
+
+The default worker class is gthread: OAuth callbacks and syncs wait on
+Google/Microsoft, and threads let a worker keep serving other requests
+meanwhile. The MongoDB client is recreated in each worker after fork.
+"""
+import os
+import sys
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+# How long startup index creation waits for MongoDB before giving up
+ENSURE_INDEXES_TIMEOUT_MS = int(os.environ.get('ENSURE_INDEXES_TIMEOUT_MS', 3000))
+
+
+def on_starting(server):
+    """
+    Create missing indexes once, from the master, with a short-lived client.
+    An unreachable MongoDB only delays binding by ENSURE_INDEXES_TIMEOUT_MS.
+    Refuses to start without a usable TOKEN_ENCRYPTION_KEY, since every
+    Google/Outlook login stores tokens with it.
+    """
+    # Load .env first: token_store reads the key on import and forked
+    # workers inherit the module the master imported here
+    from dotenv import load_dotenv
+    load_dotenv()
+    import token_store
+    token_store.check_key()
+    if os.environ.get('ENSURE_INDEXES_ON_START', '1') != '1':
+        return
+    import mongo
+    from db_indexes import ensure_indexes, print_report
+    client = mongo.create_client(serverSelectionTimeoutMS=ENSURE_INDEXES_TIMEOUT_MS)
+    try:
+        print_report(ensure_indexes(client.calstack))
+    finally:
+        client.close()
+
+
+def post_fork(server, worker):
+    """With preload_app the app was imported in the master; give this worker its own client."""
+    app_module = sys.modules.get('app')
+    if app_module is not None:
+        app_module.init_db()
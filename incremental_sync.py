@@ -0,0 +1,234 @@
+"""
+Incremental calendar sync for Calstack.
+
+A full sync asks the provider for every busy period in the next
+SYNC_DAYS days. An incremental sync keeps a per-user cursor instead
+(Google events syncToken, Microsoft Graph calendarView deltaLink) and
+only fetches the events changed since the last sync. The user's events
+in the cursor's window are kept in the `sync_state` collection, patched
+with each batch of changes, and the busy list is rebuilt from them.
+
+The cursor covers a fixed window of CURSOR_WINDOW_DAYS days. Once it
+no longer reaches SYNC_DAYS ahead, or the provider expires it, the next
+sync lists the window again from scratch.
+
+The cursor follows only the default calendar (Google 'primary',
+Graph /me/calendarView), so calendar_sync.sync_user keeps using full
+multi-calendar syncs for users who also have secondary calendars.
+
+Enabled with INCREMENTAL_SYNC=1. Google needs the
+calendar.events.readonly scope for this, which app.py requests when the
+setting is on; users who granted only the free/busy scope fall back to
+full syncs.
+
+A provider is any object with a `name` and
+`changes(cursor, window_start=None, window_end=None)` returning
+(changes, next_cursor). With no cursor it lists every event in the
+window. Each change is {'id', 'busy'} plus 'start'/'end' (aware UTC)
+when busy; deleted, cancelled, declined and free events have busy False.
+"""
+import datetime
+import os
+
+import pytz
+
+import google_client
+import graph_client
+from calendar_sync import SYNC_DAYS, SyncError, store_busy
+from scheduling import to_utc
+
+CURSOR_WINDOW_DAYS = int(os.environ.get('SYNC_CURSOR_WINDOW_DAYS', SYNC_DAYS + 7))
+
+GOOGLE_EVENTS_SCOPE = 'https://www.googleapis.com/auth/calendar.events.readonly'
+
+
+class CursorExpired(Exception):
+    """The provider no longer accepts the cursor; list the window again."""
+
+
+def apply_changes(events, changes):
+    """Patch events ({id: (start, end)}) in place with a batch of changes."""
+    for change in changes:
+        if change['busy']:
+            events[change['id']] = (change['start'], change['end'])
+        else:
+            events.pop(change['id'], None)
+
+
+def busy_in_window(events, window_start, window_end):
+    """Busy periods, as {start, end} dicts, of events overlapping the window."""
+    return [
+        {'start': start, 'end': end}
+        for start, end in events.values()
+        if start < window_end and end > window_start
+    ]
+
+
+def pull_changes(provider, state, now):
+    """
+    Bring a user's sync state up to date with the provider.
+    state is None or {'provider', 'cursor', 'window_end', 'events'} as
+    stored in `sync_state`; events is a list of {id, start, end}.
+    Returns the new state; 'full' tells whether the window was listed
+    from scratch.
+    """
+    horizon = now + datetime.timedelta(days=SYNC_DAYS)
+    incremental = bool(
+        state and state['provider'] == provider.name and state.get('cursor')
+        and to_utc(state['window_end']) >= horizon
+    )
+    if incremental:
+        events = {e['id']: (to_utc(e['start']), to_utc(e['end'])) for e in state['events']}
+        window_end = to_utc(state['window_end'])
+        try:
+            changes, cursor = provider.changes(state['cursor'])
+        except CursorExpired:
+            incremental = False
+        else:
+            apply_changes(events, changes)
+    if not incremental:
+        window_end = now + datetime.timedelta(days=CURSOR_WINDOW_DAYS)
+        changes, cursor = provider.changes(None, now, window_end)
+        events = {}
+        apply_changes(events, changes)
+    return {
+        'provider': provider.name,
+        'cursor': cursor,
+        'window_end': window_end,
+        # Events that ended are never needed again
+        'events': [
+            {'id': event_id, 'start': start, 'end': end}
+            for event_id, (start, end) in sorted(events.items(), key=lambda item: item[1])
+            if end > now
+        ],
+        'full': not incremental
+    }
+
+
+def sync_events(db, email, provider, now=None):
+    """
+    Incrementally sync email's calendar from provider and store the busy
+    list for the next SYNC_DAYS days. Returns the number of busy periods.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    state = db.sync_state.find_one({'user_email': email})
+    new_state = pull_changes(provider, state, now)
+    full = new_state.pop('full')
+    db.sync_state.update_one(
+        {'user_email': email},
+        {'$set': dict(new_state, synced_at=now)},
+        upsert=True
+    )
+    print(f"{'Full' if full else 'Incremental'} {provider.name} sync for {email}: {len(new_state['events'])} events")
+    events = {e['id']: (e['start'], e['end']) for e in new_state['events']}
+    horizon = now + datetime.timedelta(days=SYNC_DAYS)
+    return store_busy(db, email, busy_in_window(events, now, horizon), provider.name, horizon)
+
+
+# --- Providers ---
+
+def _google_time(value, tz_name):
+    """Aware UTC start/end of a Google event; all-day dates are midnight in the calendar's zone."""
+    if 'dateTime' in value:
+        return to_utc(value['dateTime'])
+    tz = pytz.timezone(value.get('timeZone') or tz_name or 'UTC')
+    day = datetime.datetime.strptime(value['date'], '%Y-%m-%d')
+    return tz.localize(day).astimezone(pytz.UTC)
+
+
+def google_change(item, tz_name=None):
+    """Convert a Google events.list item into a change, busy the way freebusy counts it."""
+    declined = any(
+        attendee.get('self') and attendee.get('responseStatus') == 'declined'
+        for attendee in item.get('attendees', [])
+    )
+    if item.get('status') == 'cancelled' or item.get('transparency') == 'transparent' or declined:
+        return {'id': item['id'], 'busy': False}
+    return {
+        'id': item['id'],
+        'busy': True,
+        'start': _google_time(item['start'], tz_name),
+        'end': _google_time(item['end'], tz_name)
+    }
+
+
+class GoogleEvents:
+    """Primary Google calendar events, cursor = events.list nextSyncToken."""
+    name = 'google'
+
+    def __init__(self, creds):
+        self.creds = creds
+
+    def changes(self, cursor, window_start=None, window_end=None):
+        from googleapiclient.errors import HttpError
+        service = google_client.service('calendar', 'v3')
+        params = {'calendarId': 'primary', 'singleEvents': True, 'maxResults': 2500}
+        if cursor:
+            params['syncToken'] = cursor
+        else:
+            params['timeMin'] = window_start.isoformat()
+            params['timeMax'] = window_end.isoformat()
+        changes = []
+        page_token = None
+        while True:
+            try:
+                result = google_client.execute(service.events().list(pageToken=page_token, **params), self.creds)
+            except HttpError as e:
+                if e.resp.status == 410:
+                    raise CursorExpired(str(e))
+                if e.resp.status == 403:
+                    raise PermissionError(str(e))
+                raise
+            changes.extend(google_change(item, result.get('timeZone')) for item in result.get('items', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return changes, result.get('nextSyncToken')
+
+
+def outlook_change(item):
+    """Convert a Graph calendarView/delta item into a change; only 'busy' counts, as with getSchedule."""
+    if '@removed' in item or item.get('isCancelled') or item.get('showAs') != 'busy':
+        return {'id': item['id'], 'busy': False}
+    return {
+        'id': item['id'],
+        'busy': True,
+        'start': to_utc(item['start']['dateTime']),
+        'end': to_utc(item['end']['dateTime'])
+    }
+
+
+class OutlookEvents:
+    """Outlook calendar view events, cursor = calendarView/delta deltaLink."""
+    name = 'outlook'
+    DELTA_URL = '/me/calendarView/delta'
+
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+    def changes(self, cursor, window_start=None, window_end=None):
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            # Event times in UTC, so dateTime values need no time zone lookup
+            'Prefer': 'outlook.timezone="UTC", odata.maxpagesize=200'
+        }
+        url = cursor
+        params = None
+        if not cursor:
+            url = self.DELTA_URL
+            params = {
+                'startDateTime': window_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'endDateTime': window_end.strftime('%Y-%m-%dT%H:%M:%SZ')
+            }
+        changes = []
+        while True:
+            resp = graph_client.get(url, 'calendarView.delta', headers=headers, params=params)
+            if resp.status_code == 410:
+                raise CursorExpired(resp.text)
+            if resp.status_code != 200:
+                raise SyncError(f"Failed to fetch Outlook calendar changes ({resp.status_code}): {resp.text}")
+            data = resp.json()
+            changes.extend(outlook_change(item) for item in data.get('value', []))
+            if '@odata.nextLink' in data:
+                url, params = data['@odata.nextLink'], None
+                continue
+            return changes, data.get('@odata.deltaLink')
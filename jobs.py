@@ -0,0 +1,205 @@
+"""
+Background jobs for Calstack, stored in the Mongo `jobs` collection.
+
+Routes queue work with enqueue_sync() and return at once; worker.py
+claims due jobs, runs them and records the outcome. Each user has at
+most one queued sync job; enqueueing again merges into it. Failed jobs
+are retried with exponential backoff until MAX_ATTEMPTS. Workers
+only claim a provider's jobs while it is under its PROVIDER_LIMITS.
+
+A job document holds:
+    type, email, provider, status (queued/running/done/failed), attempts,
+    run_at, created_at, started_at, finished_at, worker, last_error
+Workers read the user's credentials from the token store (token_store.py).
+Jobs queued before it may still carry credentials, which are removed once
+the job is finished.
+"""
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import metrics
+
+SYNC_AVAILABILITY = 'sync_availability'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+RETRY_BASE_SECONDS = int(os.environ.get('JOB_RETRY_BASE_SECONDS', 30))
+RETRY_MAX_SECONDS = int(os.environ.get('JOB_RETRY_MAX_SECONDS', 1800))
+# A job still running after this long is assumed lost with its worker
+STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 600))
+
+# provider -> (jobs running at once, jobs started per minute), across all workers
+PROVIDER_LIMITS = {
+    provider: (
+        int(os.environ.get(f'SYNC_MAX_RUNNING_{provider.upper()}', 10)),
+        int(os.environ.get(f'SYNC_MAX_PER_MINUTE_{provider.upper()}', 120))
+    )
+    for provider in ('google', 'outlook')
+}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before attempt attempts + 1: doubling from the base, capped, jittered."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def enqueue_sync(db, email, provider, delay=0):
+    """
+    Queue an availability sync for email, due in delay seconds. An
+    already queued sync for the user absorbs this one: the newest
+    provider is kept and the earlier due time wins.
+    Returns the job id.
+    """
+    now = _now()
+    run_at = now + timedelta(seconds=delay)
+    query = {'type': SYNC_AVAILABILITY, 'email': email, 'status': QUEUED}
+    # Retry when the queued job is claimed between our read and write,
+    # or another request inserts one first
+    for _ in range(3):
+        existing = db.jobs.find_one(query, {'_id': 1})
+        if existing:
+            update = {'$set': {'provider': provider, 'updated_at': now}, '$min': {'run_at': run_at}}
+            if db.jobs.update_one({'_id': existing['_id'], 'status': QUEUED}, update).matched_count:
+                metrics.inc('jobs_deduplicated_total', type=SYNC_AVAILABILITY)
+                return existing['_id']
+            continue
+        try:
+            job_id = db.jobs.insert_one({
+                'type': SYNC_AVAILABILITY,
+                'email': email,
+                'provider': provider,
+                'status': QUEUED,
+                'attempts': 0,
+                'run_at': run_at,
+                'created_at': now,
+                'updated_at': now
+            }).inserted_id
+        except DuplicateKeyError:
+            continue
+        metrics.inc('jobs_enqueued_total', type=SYNC_AVAILABILITY)
+        return job_id
+    raise RuntimeError(f"Could not queue availability sync for {email}")
+
+
+def saturated_providers(db, now, limits=None):
+    """
+    Providers at their concurrency or per-minute limit. Counts are read
+    before claiming, so concurrent workers may overshoot by a job or two.
+    """
+    saturated = []
+    for provider, (max_running, max_per_minute) in (limits or PROVIDER_LIMITS).items():
+        running = db.jobs.count_documents({'provider': provider, 'status': RUNNING})
+        started = db.jobs.count_documents({
+            'provider': provider,
+            'started_at': {'$gte': now - timedelta(minutes=1)}
+        })
+        if running >= max_running or started >= max_per_minute:
+            saturated.append(provider)
+    return saturated
+
+
+def claim_next(db, worker_id):
+    """Atomically mark the oldest due job running and return it, or None."""
+    now = _now()
+    query = {'status': QUEUED, 'run_at': {'$lte': now}}
+    saturated = saturated_providers(db, now)
+    if saturated:
+        query['provider'] = {'$nin': saturated}
+    return db.jobs.find_one_and_update(
+        query,
+        {
+            '$set': {'status': RUNNING, 'started_at': now, 'worker': worker_id},
+            '$inc': {'attempts': 1}
+        },
+        sort=[('run_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def claim_peers(db, job, emails, limit):
+    """
+    Claim up to limit queued first-attempt syncs for emails (same provider
+    as job) so job's worker runs them together with job. Due times are
+    ignored: a batch costs no more calls than job alone. Retries are left
+    to run on their own.
+    """
+    now = _now()
+    claimed = []
+    while emails and len(claimed) < limit:
+        peer = db.jobs.find_one_and_update(
+            {
+                'type': SYNC_AVAILABILITY,
+                'status': QUEUED,
+                'provider': job['provider'],
+                'attempts': 0,
+                'email': {'$in': list(emails)}
+            },
+            {
+                '$set': {'status': RUNNING, 'started_at': now, 'worker': job['worker'], 'batch': job['_id']},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('run_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if peer is None:
+            break
+        claimed.append(peer)
+    return claimed
+
+
+def complete(db, job):
+    db.jobs.update_one(
+        {'_id': job['_id']},
+        {'$set': {'status': DONE, 'finished_at': _now()}, '$unset': {'credentials': ''}}
+    )
+
+
+def fail(db, job, error):
+    """Record a failed attempt; requeue with backoff or give up after MAX_ATTEMPTS."""
+    now = _now()
+    if job['attempts'] < MAX_ATTEMPTS:
+        try:
+            db.jobs.update_one({'_id': job['_id']}, {'$set': {
+                'status': QUEUED,
+                'run_at': now + timedelta(seconds=retry_delay(job['attempts'])),
+                'last_error': error
+            }})
+            return
+        except DuplicateKeyError:
+            # A newer sync for this user was queued meanwhile and replaces this one
+            error = f"superseded by a newer sync ({error})"
+    db.jobs.update_one(
+        {'_id': job['_id']},
+        {'$set': {'status': FAILED, 'finished_at': now, 'last_error': error}, '$unset': {'credentials': ''}}
+    )
+
+
+def requeue_stale(db):
+    """Fail (and so retry) jobs left running by a worker that died. Returns how many."""
+    cutoff = _now() - timedelta(seconds=STALE_SECONDS)
+    stale = list(db.jobs.find({'status': RUNNING, 'started_at': {'$lt': cutoff}}))
+    for job in stale:
+        fail(db, job, f"worker {job.get('worker')} did not finish the job")
+    return len(stale)
+
+
+def pending_syncs(db, emails):
+    """The subset of emails with an availability sync queued or running."""
+    return set(db.jobs.distinct('email', {
+        'type': SYNC_AVAILABILITY,
+        'email': {'$in': list(emails)},
+        'status': {'$in': [QUEUED, RUNNING]}
+    }))
@@ -0,0 +1,68 @@
+"""
+In-process metrics for Calstack.
+
+Counters and timings are kept per worker process and exposed in the
+Prometheus text format by the /metrics endpoint.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to its current value."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """Record one timing as <name>_count and <name>_sum."""
+    with _lock:
+        _counters[_key(f"{name}_count", labels)] += 1
+        _counters[_key(f"{name}_sum", labels)] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the body of a with-block with observe()."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def value(name, **labels):
+    """Current value of a counter or gauge, 0 if never set."""
+    with _lock:
+        key = _key(name, labels)
+        return _gauges.get(key, _counters.get(key, 0))
+
+
+def render():
+    """Render all metrics in the Prometheus text exposition format."""
+    with _lock:
+        samples = sorted(list(_counters.items()) + list(_gauges.items()))
+    lines = []
+    for (name, labels), sample in samples:
+        if labels:
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"calstack_{name}{{{label_text}}} {sample:g}")
+        else:
+            lines.append(f"calstack_{name} {sample:g}")
+    return '\n'.join(lines) + '\n'
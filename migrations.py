@@ -0,0 +1,112 @@
+"""
+One-off data migrations for Calstack.
+
+Run them through the Flask CLI, e.g. `flask --app app migrate-busy`.
+Every migration is idempotent and only touches documents that still
+need it.
+"""
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+import token_store
+from scheduling import normalize_busy
+
+
+def migrate_busy_storage(db, batch_size=500):
+    """
+    Convert busy intervals stored as ISO strings (Google '...Z', naive
+    Outlook dateTime values, ICS uploads) into sorted UTC BSON datetimes,
+    in availability.busy and users.ics_calendar_data.
+    Returns the number of migrated documents per collection.
+    """
+    counts = {}
+    for collection, field in ((db.availability, 'busy'), (db.users, 'ics_calendar_data')):
+        migrated = 0
+        ops = []
+        for doc in collection.find({f'{field}.start': {'$type': 'string'}}, {field: 1}):
+            ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {field: normalize_busy(doc[field])}}))
+            if len(ops) >= batch_size:
+                migrated += collection.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            migrated += collection.bulk_write(ops, ordered=False).modified_count
+        counts[collection.name] = migrated
+    return counts
+
+
+def migrate_availability_per_user(db, batch_size=500):
+    """
+    Collapse per-team availability copies ({team_id, user_email, busy})
+    into one document per user, keeping the freshest busy data. Copies
+    synced since the per-user code was deployed carry updated_at and win
+    over older ones, including an older per-user document; among legacy
+    copies without it the most recently created wins (a full sync rewrote
+    every copy, create/join only the new team's copy).
+    Drops the old (team_id, user_email) index so the unique user_email
+    index can be built. Returns {'users': n, 'removed': n}.
+    """
+    now = datetime.now(timezone.utc)
+    per_team = {'team_id': {'$exists': True}}
+    fields = ('busy', 'busy_hash', 'provider', 'synced_at', 'covered_until', 'updated_at')
+    seen = set()
+    ops = []
+    docs = db.availability.find(per_team, {field: 1 for field in fields + ('user_email',)})
+    for doc in docs.sort([('updated_at', -1), ('_id', -1)]):
+        if doc['user_email'] in seen:
+            continue
+        seen.add(doc['user_email'])
+        per_user = {'user_email': doc['user_email'], 'team_id': {'$exists': False}}
+        data = {field: doc[field] for field in fields if doc.get(field) is not None}
+        data['busy'] = normalize_busy(doc.get('busy') or [])
+        ops.append(UpdateOne(per_user, {'$setOnInsert': dict({'updated_at': now}, **data, version=1)}, upsert=True))
+        if doc.get('updated_at'):
+            # Replace a per-user document written before this copy's last sync
+            ops.append(UpdateOne(
+                dict(per_user, updated_at={'$lt': doc['updated_at']}),
+                {'$set': data, '$inc': {'version': 1}}
+            ))
+        if len(ops) >= batch_size:
+            db.availability.bulk_write(ops)
+            ops = []
+    if ops:
+        db.availability.bulk_write(ops)
+    removed = db.availability.delete_many(per_team).deleted_count
+    if 'team_user_unique' in db.availability.index_information():
+        db.availability.drop_index('team_user_unique')
+    return {'users': len(seen), 'removed': removed}
+
+
+def migrate_channel_calendars(db):
+    """
+    Let users have a push channel per calendar: existing channels are on
+    the default calendar (calendar_id None), and the old one-channel-per-
+    user index is dropped so the per-calendar index can be built.
+    Returns {'channels': n}.
+    """
+    updated = db.calendar_channels.update_many(
+        {'calendar_id': {'$exists': False}}, {'$set': {'calendar_id': None}}
+    ).modified_count
+    if 'user_provider_unique' in db.calendar_channels.index_information():
+        db.calendar_channels.drop_index('user_provider_unique')
+    return {'channels': updated}
+
+
+def migrate_channel_credentials(db):
+    """
+    Move credentials kept with push channels into the token store, unless
+    the user already has stored credentials for that provider, and remove
+    them from the channels. They are stored as expired, so workers refresh
+    them before use. Returns {'moved': n, 'cleared': n}.
+    """
+    now = datetime.now(timezone.utc)
+    moved = 0
+    for channel in db.calendar_channels.find({'credentials': {'$ne': None}}):
+        email, provider = channel['user_email'], channel['provider']
+        if not db.oauth_tokens.find_one({'user_email': email, 'provider': provider}, {'_id': 1}):
+            token_store.save(db, email, provider, channel['credentials'], expires_at=now)
+            moved += 1
+    cleared = db.calendar_channels.update_many(
+        {'credentials': {'$exists': True}}, {'$unset': {'credentials': ''}}
+    ).modified_count
+    return {'moved': moved, 'cleared': cleared}
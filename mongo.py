@@ -0,0 +1,44 @@
+"""
+MongoDB client settings for Calstack.
+
+MongoClient is not fork-safe, so every process (gunicorn worker, sync
+worker, CLI command) creates its own client through create_client().
+Pool and timeout settings come from the environment; unset variables
+keep PyMongo's defaults.
+"""
+import os
+
+from pymongo import MongoClient
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+
+# environment variable -> MongoClient option
+CLIENT_OPTION_ENV = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+}
+
+
+def client_options():
+    """MongoClient keyword arguments from the environment."""
+    options = {
+        # Busy intervals are stored as BSON dates and compared as aware UTC datetimes
+        'tz_aware': True,
+        # Don't open sockets or monitor threads until first use, so a client
+        # created in a parent process is never shared with forked children
+        'connect': False,
+    }
+    for env_name, option in CLIENT_OPTION_ENV.items():
+        if os.environ.get(env_name):
+            options[option] = int(os.environ[env_name])
+    return options
+
+
+def create_client(uri=None, **overrides):
+    """A new client; overrides replace options from the environment."""
+    return MongoClient(uri or MONGO_URI, **dict(client_options(), **overrides))
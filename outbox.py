@@ -0,0 +1,252 @@
+"""
+Email outbox for Calstack, stored in the Mongo `email_outbox` collection.
+
+Routes only insert messages with enqueue(); worker.py sends them with
+send_due(). Queued messages with the same sender, subject and content
+(e.g. every invite to one team, or meeting invites for participants in
+one timezone) go out together as one SendGrid request, one
+personalization per recipient. Failed requests are retried with
+exponential backoff until OUTBOX_MAX_ATTEMPTS. A batch SendGrid rejects
+outright is split so one bad address does not hold back the rest.
+
+Each message has an idempotency key (unique index): enqueueing the same
+key twice sends once. Messages left 'sending' by a worker that died are
+requeued, so delivery is at least once.
+
+A message document holds:
+    kind, to, from_name, subject, content, group_key, idempotency_key,
+    status (queued/sending/sent/failed), attempts, run_at, created_at,
+    started_at, finished_at, batch, sg_message_id, last_error, and once
+    SendGrid reports it (/webhooks/sendgrid), delivery and delivery_at
+"""
+import hashlib
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+import metrics
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+FROM_EMAIL = 'scheduler@chronoconqueror.com'
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_RETRY_BASE_SECONDS = int(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', 30))
+OUTBOX_RETRY_MAX_SECONDS = int(os.environ.get('OUTBOX_RETRY_MAX_SECONDS', 3600))
+# SendGrid accepts up to 1000 personalizations per request
+OUTBOX_BATCH_SIZE = min(int(os.environ.get('OUTBOX_BATCH_SIZE', 500)), 1000)
+# A batch still sending after this long is assumed lost with its worker
+OUTBOX_STALE_SECONDS = 300
+# SendGrid event types recorded as a message's delivery status
+DELIVERY_EVENTS = ('delivered', 'deferred', 'bounce', 'dropped', 'spamreport')
+
+_client = None
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before attempt attempts + 1: doubling from the base, capped, jittered."""
+    delay = min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def group_key(from_name, subject, content):
+    """Messages with equal keys can share one SendGrid request."""
+    return hashlib.sha256(json.dumps([from_name, subject, content]).encode()).hexdigest()
+
+
+def message(to, subject, content, from_name='Calstack', kind='email', key=None):
+    """
+    An outbox document for one recipient. content is SendGrid's list of
+    {'type', 'value'}, text/plain first and text/html next if present.
+    """
+    now = _now()
+    return {
+        'kind': kind,
+        'to': to,
+        'from_name': from_name,
+        'subject': subject,
+        'content': content,
+        'group_key': group_key(from_name, subject, content),
+        'idempotency_key': key or str(uuid.uuid4()),
+        'status': QUEUED,
+        'attempts': 0,
+        'run_at': now,
+        'created_at': now
+    }
+
+
+def enqueue(db, messages):
+    """Insert messages, skipping idempotency keys already queued or sent. Returns how many are new."""
+    if not messages:
+        return 0
+    try:
+        inserted = len(db.email_outbox.insert_many(messages, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # 11000: a message with this idempotency key already exists
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        inserted = e.details['nInserted']
+    metrics.inc('emails_queued_total', value=inserted, kind=messages[0]['kind'])
+    return inserted
+
+
+def claim_batch(db, worker_id, now=None):
+    """
+    Mark the oldest due message and up to OUTBOX_BATCH_SIZE - 1 due
+    messages with the same content as one sending batch. Returns the
+    batch's messages, or [] if nothing is due.
+    """
+    now = now or _now()
+    batch_id = uuid.uuid4().hex
+    claim = {
+        '$set': {'status': SENDING, 'started_at': now, 'batch': batch_id, 'worker': worker_id},
+        '$inc': {'attempts': 1}
+    }
+    due = {'status': QUEUED, 'run_at': {'$lte': now}}
+    first = db.email_outbox.find_one_and_update(
+        due, claim, sort=[('run_at', ASCENDING)], return_document=ReturnDocument.AFTER
+    )
+    if first is None:
+        return []
+    same = dict(due, group_key=first['group_key'])
+    ids = [doc['_id'] for doc in db.email_outbox.find(same, {'_id': 1}).limit(OUTBOX_BATCH_SIZE - 1)]
+    if ids:
+        db.email_outbox.update_many(dict(same, _id={'$in': ids}), claim)
+    return list(db.email_outbox.find({'batch': batch_id}))
+
+
+def sendgrid_payload(batch):
+    """One mail send request for a batch of messages sharing their content."""
+    first = batch[0]
+    return {
+        'personalizations': [
+            # One personalization per recipient, so recipients don't see each other
+            {'to': [{'email': msg['to']}], 'custom_args': {'outbox_id': str(msg['_id'])}}
+            for msg in batch
+        ],
+        'from': {'email': FROM_EMAIL, 'name': first['from_name']},
+        'subject': first['subject'],
+        'content': first['content']
+    }
+
+
+def _sendgrid():
+    global _client
+    if _client is None:
+        from sendgrid import SendGridAPIClient
+        _client = SendGridAPIClient(os.environ['SENDGRID_API_KEY'])
+    return _client
+
+
+def send_batch(db, batch, send=None):
+    """
+    Send a claimed batch and record the outcome: sent, retried with
+    backoff, split into single messages (rejected batch) or failed.
+    send(payload) returns SendGrid's message id; it defaults to SendGrid's
+    mail send API.
+    """
+    send = send or _send
+    ids = [msg['_id'] for msg in batch]
+    now = _now()
+    try:
+        message_id = send(sendgrid_payload(batch))
+    except Exception as e:
+        status = getattr(e, 'status_code', None)
+        error = f"SendGrid error {status}: {getattr(e, 'body', e)}"
+        print(f"Could not send {len(batch)} {batch[0]['kind']} emails: {error}")
+        if status is not None and 400 <= status < 500 and status != 429:
+            if len(batch) > 1:
+                # Try each message on its own so one bad address only fails itself
+                for msg in batch:
+                    db.email_outbox.update_one({'_id': msg['_id']}, {
+                        '$set': {'status': QUEUED, 'group_key': f"{msg['group_key']}:{msg['_id']}",
+                                 'last_error': error},
+                        '$inc': {'attempts': -1}
+                    })
+                return 0
+            _finish(db, ids, FAILED, batch[0]['kind'], last_error=error)
+            return 0
+        attempts = max(msg['attempts'] for msg in batch)
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            _finish(db, ids, FAILED, batch[0]['kind'], last_error=error)
+            return 0
+        db.email_outbox.update_many({'_id': {'$in': ids}}, {'$set': {
+            'status': QUEUED,
+            'run_at': now + timedelta(seconds=retry_delay(attempts)),
+            'last_error': error
+        }})
+        metrics.inc('emails_total', kind=batch[0]['kind'], result='retried', value=len(batch))
+        return 0
+    _finish(db, ids, SENT, batch[0]['kind'], sg_message_id=message_id)
+    return len(batch)
+
+
+def _finish(db, ids, status, kind, **fields):
+    db.email_outbox.update_many(
+        {'_id': {'$in': ids}},
+        {'$set': dict(fields, status=status, finished_at=_now())}
+    )
+    metrics.inc('emails_total', kind=kind, result=status, value=len(ids))
+
+
+def _send(payload):
+    with metrics.timer('sendgrid_request_seconds'):
+        response = _sendgrid().client.mail.send.post(request_body=payload)
+    return response.headers.get('X-Message-Id')
+
+
+def requeue_stale(db):
+    """Requeue batches left sending by a worker that died. Returns how many messages."""
+    cutoff = _now() - timedelta(seconds=OUTBOX_STALE_SECONDS)
+    return db.email_outbox.update_many(
+        {'status': SENDING, 'started_at': {'$lt': cutoff}},
+        {'$set': {'status': QUEUED, 'last_error': 'worker did not finish sending'}}
+    ).modified_count
+
+
+def send_due(db, worker_id, max_batches=10):
+    """Send up to max_batches due batches. Returns how many messages were sent."""
+    if not os.environ.get('SENDGRID_API_KEY'):
+        return 0
+    sent = 0
+    for _ in range(max_batches):
+        batch = claim_batch(db, worker_id)
+        if not batch:
+            break
+        sent += send_batch(db, batch)
+    return sent
+
+
+def record_events(db, events):
+    """
+    Store delivery status from SendGrid event webhook events. Only events
+    for outbox messages (custom arg outbox_id) are used; each message keeps
+    its latest. Returns how many messages were updated.
+    """
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    updated = 0
+    for event in events:
+        if event.get('event') not in DELIVERY_EVENTS or not event.get('outbox_id'):
+            continue
+        try:
+            outbox_id = ObjectId(event['outbox_id'])
+        except (InvalidId, TypeError):
+            continue
+        at = datetime.fromtimestamp(event.get('timestamp', 0), timezone.utc)
+        updated += db.email_outbox.update_one(
+            {'_id': outbox_id, '$or': [{'delivery_at': {'$exists': False}}, {'delivery_at': {'$lte': at}}]},
+            {'$set': {'delivery': event['event'], 'delivery_at': at}}
+        ).modified_count
+    return updated
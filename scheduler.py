@@ -0,0 +1,150 @@
+"""
+Staleness-based re-sync scheduler for Calstack.
+
+Synced busy data only covers the window fetched at the last sync
+(covered_until on the availability document), so without new syncs it
+drifts out of date and eventually leaves an empty future. Every
+RESYNC_INTERVAL seconds one worker (holding the 'resync_scheduler'
+lease in the `locks` collection) queues syncs for Google and Outlook
+users whose data is older than RESYNC_TTL_MINUTES or covers less than
+RESYNC_HORIZON_DAYS ahead. Slot searches stop where members' data ends,
+so RESYNC_HORIZON_DAYS defaults to the default search horizon: a default
+search never runs out of data.
+
+Members of teams that searched for slots within RESYNC_PRIORITY_HOURS
+are due first, within RESYNC_PRIORITY_SPREAD seconds; everyone else is
+spread over RESYNC_SPREAD seconds so syncs don't arrive in bursts.
+Per-provider concurrency and rate limits are applied when workers claim
+the jobs (jobs.PROVIDER_LIMITS).
+"""
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+from pymongo.errors import DuplicateKeyError
+
+import jobs
+import token_store
+from calendar_sync import SYNC_DAYS
+from scheduling import DEFAULT_HORIZON_DAYS
+
+RESYNC_INTERVAL = int(os.environ.get('RESYNC_INTERVAL', 300))
+RESYNC_TTL_MINUTES = int(os.environ.get('RESYNC_TTL_MINUTES', 360))
+RESYNC_HORIZON_DAYS = int(os.environ.get('RESYNC_HORIZON_DAYS', min(DEFAULT_HORIZON_DAYS, SYNC_DAYS - 1)))
+RESYNC_PRIORITY_HOURS = int(os.environ.get('RESYNC_PRIORITY_HOURS', 24))
+RESYNC_PRIORITY_SPREAD = int(os.environ.get('RESYNC_PRIORITY_SPREAD', 60))
+RESYNC_SPREAD = int(os.environ.get('RESYNC_SPREAD', 900))
+RESYNC_BATCH = int(os.environ.get('RESYNC_BATCH', 500))
+
+PROVIDERS = ('google', 'outlook')
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def acquire_lease(db, name, seconds, now=None):
+    """Take a named lease unless another holder's is still valid."""
+    now = now or _now()
+    try:
+        db.locks.update_one(
+            {'_id': name, 'until': {'$lt': now}},
+            {'$set': {'until': now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease document exists and is still held
+        return False
+    return True
+
+
+def stale_query(now, emails=None):
+    query = {
+        'provider': {'$in': list(PROVIDERS)},
+        '$or': [
+            {'synced_at': {'$lt': now - timedelta(minutes=RESYNC_TTL_MINUTES)}},
+            {'covered_until': {'$lt': now + timedelta(days=RESYNC_HORIZON_DAYS)}},
+            {'covered_until': None},
+        ]
+    }
+    if emails is not None:
+        query['user_email'] = {'$in': emails}
+    return query
+
+
+def add_stale_users(db, stale, now, emails=None):
+    """
+    Add stale users (email -> provider), optionally only among emails, to
+    stale until it holds RESYNC_BATCH. Only users we hold credentials for
+    can be synced without a request; stale documents are read a page at a
+    time and only that page's users are looked up in the token store.
+    """
+    docs = db.availability.find(stale_query(now, emails), {'user_email': 1, 'provider': 1})
+    docs = iter(docs.batch_size(RESYNC_BATCH))
+    while len(stale) < RESYNC_BATCH:
+        page = [doc for doc in islice(docs, RESYNC_BATCH) if doc['user_email'] not in stale]
+        if not page:
+            break
+        syncable = token_store.users_with_tokens(db, [doc['user_email'] for doc in page])
+        for doc in page:
+            if doc['user_email'] in syncable and len(stale) < RESYNC_BATCH:
+                stale[doc['user_email']] = doc['provider']
+
+
+def recently_searched_members(db, now):
+    """Members of teams that searched within RESYNC_PRIORITY_HOURS, most recent team first."""
+    members = {}
+    teams = db.teams.find(
+        {'last_search_at': {'$gte': now - timedelta(hours=RESYNC_PRIORITY_HOURS)}},
+        {'members': 1}
+    ).sort('last_search_at', -1)
+    for team in teams:
+        for email in team.get('members', []):
+            members.setdefault(email, None)
+    return list(members)
+
+
+def plan_resyncs(stale, priority, rng=random):
+    """
+    Order stale users (email -> provider) and give each a delay: priority
+    members first in their given order, spread over RESYNC_PRIORITY_SPREAD,
+    then the rest spread over RESYNC_SPREAD. Returns [(email, provider, delay)].
+    """
+    plan = []
+    first = [email for email in priority if email in stale]
+    for i, email in enumerate(first):
+        # Keep the priority order while jittering within each member's share
+        share = RESYNC_PRIORITY_SPREAD / len(first)
+        plan.append((email, stale[email], i * share + rng.uniform(0, share)))
+    planned = set(first)
+    for email, provider in stale.items():
+        if email not in planned:
+            plan.append((email, provider, RESYNC_PRIORITY_SPREAD + rng.uniform(0, RESYNC_SPREAD)))
+    return plan
+
+
+def schedule_resyncs(db, now=None):
+    """Queue syncs for up to RESYNC_BATCH stale users. Returns how many were queued."""
+    now = now or _now()
+    priority = recently_searched_members(db, now)
+    stale = {}
+    # Stale priority members first, so a full batch never crowds them out
+    add_stale_users(db, stale, now, priority)
+    add_stale_users(db, stale, now)
+    # Users already queued or running are on their way
+    for email in jobs.pending_syncs(db, stale):
+        del stale[email]
+    if not stale:
+        return 0
+    plan = plan_resyncs(stale, priority)
+    for email, provider, delay in plan:
+        jobs.enqueue_sync(db, email, provider, delay=delay)
+    return len(plan)
+
+
+def run_due(db):
+    """Called from each worker's loop; only the lease holder schedules."""
+    if not acquire_lease(db, 'resync_scheduler', RESYNC_INTERVAL):
+        return 0
+    return schedule_resyncs(db)
@@ -0,0 +1,344 @@
+"""
+Scheduling engine for Calstack.
+
+Finds free meeting slots from participants' busy intervals. Both slot
+endpoints (/api/propose_slots and /team/<team_id>/suggest_slots) call into
+this module. It has no Flask or MongoDB dependency, so it can be profiled
+and benchmarked on its own.
+"""
+import heapq
+import random
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone, time as dt_time
+from itertools import chain, islice
+from operator import itemgetter
+
+UTC = timezone.utc
+
+# Limits for request-supplied search parameters
+MAX_HORIZON_DAYS = 90
+DEFAULT_HORIZON_DAYS = 7
+GRANULARITIES = (5, 10, 15, 30, 60)
+
+
+@dataclass
+class SearchSpec:
+    """Parameters for a slot search, in the requesting user's timezone."""
+    tz: object                   # pytz timezone used for day boundaries
+    now: datetime                # aware datetime the search starts from
+    duration: int                # meeting length in minutes
+    start_hour: int              # earliest start hour of each day
+    end_hour: int                # end of the daily window
+    days_of_week: list           # allowed Python weekdays (0=Mon, ..., 6=Sun)
+    step: int = None             # start granularity in minutes, defaults to duration
+    avoid_hours: tuple = None    # (from_hour, to_hour) start hours skipped Mon-Fri
+    fit_window: bool = True      # slot must end by end_hour, not only start before it
+    algorithm: str = 'next'      # 'next', 'split' or 'random'
+    limit: int = 5
+    horizon_days: int = DEFAULT_HORIZON_DAYS
+    until: datetime = None       # no slot ends later, e.g. end of the members' synced data
+
+
+def to_utc(value):
+    """
+    Convert a stored timestamp to an aware UTC datetime. Accepts BSON
+    datetimes (aware or naive UTC) and, for documents written before busy
+    data was normalised, ISO strings. Naive values are UTC, which is what
+    the freebusy/getSchedule queries request and what the calendar view
+    assumes.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        return value.replace(tzinfo=UTC)
+    return value.astimezone(UTC)
+
+
+def normalize_busy(busy_list):
+    """
+    Normalise provider busy data ({start, end} in any supported format) to
+    the stored form: a sorted list of {start, end} UTC datetimes, which
+    MongoDB keeps as native BSON dates.
+    """
+    return [{'start': start, 'end': end} for start, end in parse_busy(busy_list)]
+
+
+def serialize_busy(busy_list):
+    """Format stored busy data as ISO 8601 UTC strings for JSON responses."""
+    return [{
+        'start': to_utc(busy['start']).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'end': to_utc(busy['end']).strftime('%Y-%m-%dT%H:%M:%SZ')
+    } for busy in busy_list]
+
+
+def parse_busy(busy_list):
+    """
+    Convert stored busy dicts to a sorted list of aware UTC (start, end)
+    tuples. Normalised documents hold aware datetimes already, so the hot
+    path is a plain tuple build without any string parsing.
+    """
+    intervals = []
+    for busy in busy_list:
+        start, end = busy['start'], busy['end']
+        if isinstance(start, str) or start.tzinfo is None:
+            start = to_utc(start)
+        if isinstance(end, str) or end.tzinfo is None:
+            end = to_utc(end)
+        if end > start:
+            intervals.append((start, end))
+    intervals.sort()
+    return intervals
+
+
+def merge_intervals(intervals):
+    """Merge (start, end) intervals into a sorted list of disjoint intervals."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def search_days(spec):
+    """Yield each date in the search horizon, starting today in spec.tz."""
+    last_day = spec.until.astimezone(spec.tz).date() if spec.until else None
+    for day_offset in range(spec.horizon_days):
+        day = (spec.now + timedelta(days=day_offset)).date()
+        if last_day and day > last_day:
+            return
+        yield day
+
+
+def filter_days(days, days_of_week):
+    """Keep the dates whose weekday is allowed."""
+    return (day for day in days if day.weekday() in days_of_week)
+
+
+def start_windows(day, spec):
+    """
+    Closed [lo, hi] ranges of allowed start times on day: the hour window,
+    minus avoid_hours on weekdays, ending so slots end by spec.until.
+    """
+    tz = spec.tz
+    day_start = tz.localize(datetime.combine(day, dt_time(hour=spec.start_hour)))
+    day_end = tz.localize(datetime.combine(day, dt_time(hour=spec.end_hour)))
+    if spec.fit_window:
+        last_start = day_end - timedelta(minutes=spec.duration)
+    else:
+        last_start = day_end - timedelta.resolution
+    windows = [(day_start, last_start)]
+    if spec.avoid_hours and day.weekday() < 5:
+        avoid_start = tz.localize(datetime.combine(day, dt_time(hour=spec.avoid_hours[0])))
+        avoid_end = tz.localize(datetime.combine(day, dt_time(hour=spec.avoid_hours[1])))
+        windows = [
+            (day_start, min(last_start, avoid_start - timedelta.resolution)),
+            (max(day_start, avoid_end), last_start)
+        ]
+    if spec.until:
+        latest = spec.until - timedelta(minutes=spec.duration)
+        windows = [(lo, min(hi, latest)) for lo, hi in windows]
+    return [(lo, hi) for lo, hi in windows if lo <= hi]
+
+
+def free_windows(lo, hi, busy, length):
+    """
+    Walk the gaps between busy intervals and yield the closed sub-ranges of
+    [lo, hi] where a slot of the given length can start without a conflict.
+    busy must be sorted and disjoint; a binary search skips to the first
+    interval that matters, so cost depends on the busy intervals inside
+    the range, not on the number of possible starts.
+    """
+    busy_idx = bisect_right(busy, lo, key=itemgetter(1))
+    current = lo
+    while current <= hi:
+        if busy_idx == len(busy):
+            yield (current, hi)
+            return
+        busy_start, busy_end = busy[busy_idx]
+        gap_end = busy_start - length
+        if gap_end >= current:
+            yield (current, min(gap_end, hi))
+        current = max(current, busy_end)
+        busy_idx += 1
+
+
+def grid_starts(lo, hi, anchor, step):
+    """Yield the starts in [lo, hi] that lie on anchor + k * step."""
+    start = anchor - ((anchor - lo) // step) * step
+    while start <= hi:
+        yield start
+        start += step
+
+
+def day_slots(day, spec, busy=()):
+    """Lazily yield the (start, end, day) slots on day that avoid busy."""
+    step = timedelta(minutes=spec.step or spec.duration)
+    length = timedelta(minutes=spec.duration)
+    anchor = spec.tz.localize(datetime.combine(day, dt_time(hour=spec.start_hour)))
+    for lo, hi in start_windows(day, spec):
+        for free_lo, free_hi in free_windows(lo, hi, busy, length):
+            for start in grid_starts(free_lo, free_hi, anchor, step):
+                yield (start, start + length, day)
+
+
+def slots_by_day(spec, busy=()):
+    """Yield one lazy slot iterator per allowed day, in order."""
+    for day in filter_days(search_days(spec), spec.days_of_week):
+        yield day_slots(day, spec, busy)
+
+
+def candidate_slots(spec, busy=()):
+    """
+    Lazily yield (start, end, day) tuples in chronological order. Without
+    busy this is every candidate; with a merged busy list, only free slots.
+    """
+    return chain.from_iterable(slots_by_day(spec, busy))
+
+
+def free_slots(candidates, busy):
+    """
+    Lazily keep the candidates that do not overlap any interval in busy.
+    busy must be sorted and disjoint (see merge_intervals) and candidates in
+    chronological order, so a single forward sweep is enough. The sweep
+    starts with a binary search, so per-day iterators do not rescan busy.
+    """
+    busy_idx = None
+    for slot in candidates:
+        slot_start, slot_end = slot[0], slot[1]
+        if busy_idx is None:
+            busy_idx = bisect_right(busy, slot_start, key=itemgetter(1))
+        while busy_idx < len(busy) and busy[busy_idx][1] <= slot_start:
+            busy_idx += 1
+        if busy_idx < len(busy) and busy[busy_idx][0] < slot_end:
+            continue
+        yield slot
+
+
+def select_next(slots, limit):
+    """Earliest slots first; stops pulling as soon as limit is reached."""
+    return list(islice(slots, limit))
+
+
+def select_split(day_iterators, limit):
+    """Round-robin across per-day iterators, pulling one slot at a time."""
+    active = list(day_iterators)
+    selected = []
+    while active and len(selected) < limit:
+        still_active = []
+        for slots in active:
+            if len(selected) >= limit:
+                break
+            slot = next(slots, None)
+            if slot is not None:
+                selected.append(slot)
+                still_active.append(slots)
+        active = still_active
+    return selected
+
+
+def select_random(slots, limit):
+    """Random sample; the only selection that needs every free slot."""
+    slots = list(slots)
+    return random.sample(slots, min(limit, len(slots))) if slots else []
+
+
+def find_slots(busy_by_member, spec):
+    """
+    Find slots where every member in busy_by_member is free.
+    busy_by_member maps email -> list of (start, end) as returned by parse_busy.
+    Returns a list of (start, end) tuples in spec.tz.
+
+    The search is a chain of generators (days -> start windows -> gaps
+    between busy intervals -> start grid -> selection). It never enumerates
+    starts that fall inside busy time, and 'next' and 'split' stop as soon
+    as enough free slots were found, so long horizons and fine granularity
+    stay cheap for teams of any size.
+    """
+    busy = merge_intervals(
+        interval for intervals in busy_by_member.values() for interval in intervals
+    )
+    free = candidate_slots(spec, busy)
+    day_iterators = slots_by_day(spec, busy)
+
+    if spec.algorithm == 'split':
+        selected = select_split(day_iterators, spec.limit)
+    elif spec.algorithm == 'random':
+        selected = select_random(free, spec.limit)
+    else:
+        selected = select_next(free, spec.limit)
+    return [(start, end) for start, end, _ in selected]
+
+
+def rank_by_attendance(busy_by_member, spec, top_n=5):
+    """
+    Rank candidate slots by how many members are free, for when no slot fits
+    everyone.
+
+    Each member's busy list is merged, also closing gaps shorter than the
+    meeting, so a candidate can overlap at most one interval per member.
+    The number of busy members for a slot [s, e) is then
+    #(interval starts < e) - #(interval ends <= s), which one sorted sweep
+    over all boundaries yields for every candidate in
+    O((members + intervals) log n + candidates).
+
+    Returns up to top_n (start, end, conflicts) tuples, fewest conflicts
+    first and earliest first on ties; conflicts lists the busy members.
+    """
+    length = timedelta(minutes=spec.duration)
+    member_busy = {}
+    for email, intervals in busy_by_member.items():
+        closed = []
+        for start, end in sorted(intervals):
+            if closed and start - closed[-1][1] < length:
+                if end > closed[-1][1]:
+                    closed[-1] = (closed[-1][0], end)
+            else:
+                closed.append((start, end))
+        member_busy[email] = (closed, [end for _, end in closed])
+    starts = sorted(start for closed, _ in member_busy.values() for start, _ in closed)
+    ends = sorted(end for _, member_ends in member_busy.values() for end in member_ends)
+
+    # Candidates share one length, so both their starts and ends are sorted
+    scored = []
+    started = finished = 0
+    for index, (slot_start, slot_end, _) in enumerate(candidate_slots(spec)):
+        while started < len(starts) and starts[started] < slot_end:
+            started += 1
+        while finished < len(ends) and ends[finished] <= slot_start:
+            finished += 1
+        scored.append((started - finished, index, slot_start, slot_end))
+
+    ranked = []
+    for _, _, slot_start, slot_end in heapq.nsmallest(top_n, scored):
+        conflicts = []
+        for email, (closed, member_ends) in member_busy.items():
+            # First interval ending after the slot starts is the only possible overlap
+            i = bisect_right(member_ends, slot_start)
+            if i < len(closed) and closed[i][0] < slot_end:
+                conflicts.append(email)
+        ranked.append((slot_start, slot_end, sorted(conflicts)))
+    return ranked
+
+
+def busy_histogram(busy_by_member, window_start, window_end, bucket_minutes=15):
+    """
+    Number of members busy in each bucket of [window_start, window_end).
+    A member counts once per bucket, however many of their intervals
+    touch it.
+    """
+    resolution = bucket_minutes * 60
+    n_buckets = max(0, int(-(-(window_end - window_start).total_seconds() // resolution)))
+    counts = [0] * n_buckets
+    for intervals in busy_by_member.values():
+        buckets = set()
+        for start, end in intervals:
+            first = max(0, int((start - window_start).total_seconds() // resolution))
+            last = min(n_buckets, int(-(-(end - window_start).total_seconds() // resolution)))
+            buckets.update(range(first, last))
+        for bucket in buckets:
+            counts[bucket] += 1
+    return counts
@@ -0,0 +1,91 @@
+"""
+Result cache for slot searches.
+
+Keys include the team's availability version, which is bumped on every
+availability write, so stale entries are never served; they simply stop
+being looked up and age out through LRU/TTL eviction.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import metrics
+
+
+class SlotCache:
+    """Bounded LRU cache with a per-entry time to live."""
+
+    def __init__(self, max_entries=1024, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value or None, counting the hit or miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.inc('slot_cache_hits_total')
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+                metrics.inc('slot_cache_evictions_total', reason='ttl')
+        metrics.inc('slot_cache_misses_total')
+        return None
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                metrics.inc('slot_cache_evictions_total', reason='lru')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def search_key(kind, team_id, participants, spec, version):
+    """
+    Normalised cache key for a slot search. The date in the user's timezone
+    is part of the key because the horizon starts today.
+    """
+    return (
+        kind,
+        team_id,
+        frozenset(participants),
+        str(spec.tz),
+        spec.now.date(),
+        spec.duration,
+        spec.start_hour,
+        spec.end_hour,
+        tuple(sorted(set(spec.days_of_week))),
+        spec.step,
+        spec.avoid_hours,
+        spec.fit_window,
+        spec.algorithm,
+        spec.limit,
+        spec.horizon_days,
+        until_key(spec),
+        version
+    )
+
+
+def until_key(spec):
+    """
+    The part of spec.until that can change a search's result. Every sync
+    restamps covered_until, even when nothing else changed, so it is only
+    keyed when it ends the search before the horizon does, and then only
+    to the hour.
+    """
+    if spec.until is None or spec.until >= spec.now + timedelta(days=spec.horizon_days):
+        return None
+    return spec.until.replace(minute=0, second=0, microsecond=0)
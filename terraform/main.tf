@@ -49,6 +49,7 @@ module "secrets" {
     ms_client_secret    = var.ms_client_secret
     azure_application_id = var.azure_application_id
     azure_directory_id  = var.azure_directory_id
+    token_encryption_key = var.token_encryption_key
   }
   
   tags = var.tags
@@ -91,6 +92,11 @@ module "ecs" {
   desired_count     = var.ecs_desired_count
   min_capacity      = var.ecs_min_capacity
   max_capacity      = var.ecs_max_capacity
+
+  # Background worker (worker.py)
+  worker_cpu           = var.ecs_worker_cpu
+  worker_memory        = var.ecs_worker_memory
+  worker_desired_count = var.ecs_worker_desired_count
   
   # Environment variables (non-sensitive)
   environment_variables = {
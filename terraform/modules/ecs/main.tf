@@ -10,6 +10,51 @@ resource "aws_ecs_cluster" "main" {
   tags = var.tags
 }
 
+# Shared by the web and worker containers
+locals {
+  container_environment = [
+    for key, value in var.environment_variables : {
+      name  = key
+      value = value
+    }
+  ]
+
+  container_secrets = [
+    {
+      name      = "FLASK_SECRET_KEY"
+      valueFrom = "${var.secrets_arn}:flask_secret_key::"
+    },
+    {
+      name      = "MONGO_URI"
+      valueFrom = "${var.secrets_arn}:mongo_uri::"
+    },
+    {
+      name      = "SENDGRID_API_KEY"
+      valueFrom = "${var.secrets_arn}:sendgrid_api_key::"
+    },
+    {
+      name      = "MS_CLIENT_ID"
+      valueFrom = "${var.secrets_arn}:ms_client_id::"
+    },
+    {
+      name      = "MS_CLIENT_SECRET"
+      valueFrom = "${var.secrets_arn}:ms_client_secret::"
+    },
+    {
+      name      = "AZURE_APPLICATION_ID"
+      valueFrom = "${var.secrets_arn}:azure_application_id::"
+    },
+    {
+      name      = "AZURE_DIRECTORY_ID"
+      valueFrom = "${var.secrets_arn}:azure_directory_id::"
+    },
+    {
+      name      = "TOKEN_ENCRYPTION_KEY"
+      valueFrom = "${var.secrets_arn}:token_encryption_key::"
+    }
+  ]
+}
+
 # ECS Task Definition
 resource "aws_ecs_task_definition" "app" {
   family                   = "${var.project_name}-${var.environment}"
@@ -32,43 +77,8 @@ resource "aws_ecs_task_definition" "app" {
         }
       ]
 
-      environment = [
-        for key, value in var.environment_variables : {
-          name  = key
-          value = value
-        }
-      ]
-
-      secrets = [
-        {
-          name      = "FLASK_SECRET_KEY"
-          valueFrom = "${var.secrets_arn}:flask_secret_key::"
-        },
-        {
-          name      = "MONGO_URI"
-          valueFrom = "${var.secrets_arn}:mongo_uri::"
-        },
-        {
-          name      = "SENDGRID_API_KEY"
-          valueFrom = "${var.secrets_arn}:sendgrid_api_key::"
-        },
-        {
-          name      = "MS_CLIENT_ID"
-          valueFrom = "${var.secrets_arn}:ms_client_id::"
-        },
-        {
-          name      = "MS_CLIENT_SECRET"
-          valueFrom = "${var.secrets_arn}:ms_client_secret::"
-        },
-        {
-          name      = "AZURE_APPLICATION_ID"
-          valueFrom = "${var.secrets_arn}:azure_application_id::"
-        },
-        {
-          name      = "AZURE_DIRECTORY_ID"
-          valueFrom = "${var.secrets_arn}:azure_directory_id::"
-        }
-      ]
+      environment = local.container_environment
+      secrets     = local.container_secrets
 
       logConfiguration = {
         logDriver = "awslogs"
@@ -117,6 +127,57 @@ resource "aws_ecs_service" "app" {
   tags = var.tags
 }
 
+# Worker Task Definition: runs worker.py, which performs calendar syncs,
+# token refreshes, push channel renewals and outbox emails queued by the app
+resource "aws_ecs_task_definition" "worker" {
+  family                   = "${var.project_name}-${var.environment}-worker"
+  network_mode             = "awsvpc"
+  requires_compatibilities = ["FARGATE"]
+  cpu                      = var.worker_cpu
+  memory                   = var.worker_memory
+  execution_role_arn       = aws_iam_role.ecs_execution_role.arn
+  task_role_arn           = aws_iam_role.ecs_task_role.arn
+
+  container_definitions = jsonencode([
+    {
+      name    = "${var.project_name}-worker"
+      image   = var.container_image
+      command = ["python", "worker.py"]
+
+      environment = local.container_environment
+      secrets     = local.container_secrets
+
+      logConfiguration = {
+        logDriver = "awslogs"
+        options = {
+          awslogs-group         = aws_cloudwatch_log_group.app.name
+          awslogs-region        = data.aws_region.current.name
+          awslogs-stream-prefix = "worker"
+        }
+      }
+    }
+  ])
+
+  tags = var.tags
+}
+
+# Worker Service (no load balancer: workers only talk to MongoDB and the calendar/email APIs)
+resource "aws_ecs_service" "worker" {
+  name            = "${var.project_name}-${var.environment}-worker"
+  cluster         = aws_ecs_cluster.main.id
+  task_definition = aws_ecs_task_definition.worker.arn
+  desired_count   = var.worker_desired_count
+  launch_type     = "FARGATE"
+
+  network_configuration {
+    security_groups  = var.security_group_ids
+    subnets          = var.private_subnet_ids
+    assign_public_ip = false
+  }
+
+  tags = var.tags
+}
+
 # Auto Scaling
 resource "aws_appautoscaling_target" "ecs_target" {
   max_capacity       = var.max_capacity
@@ -76,6 +76,24 @@ variable "max_capacity" {
   default     = 10
 }
 
+variable "worker_cpu" {
+  description = "CPU units for the worker task"
+  type        = number
+  default     = 256
+}
+
+variable "worker_memory" {
+  description = "Memory for the worker task in MB"
+  type        = number
+  default     = 512
+}
+
+variable "worker_desired_count" {
+  description = "Number of worker tasks processing background jobs"
+  type        = number
+  default     = 1
+}
+
 variable "environment_variables" {
   description = "Environment variables for the container"
   type        = map(string)
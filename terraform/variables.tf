@@ -79,6 +79,24 @@ variable "ecs_max_capacity" {
   default     = 10
 }
 
+variable "ecs_worker_cpu" {
+  description = "CPU units for the background worker task"
+  type        = number
+  default     = 256
+}
+
+variable "ecs_worker_memory" {
+  description = "Memory for the background worker task in MB"
+  type        = number
+  default     = 512
+}
+
+variable "ecs_worker_desired_count" {
+  description = "Number of background worker tasks (calendar syncs, token refresh, emails)"
+  type        = number
+  default     = 1
+}
+
 # Secrets (sensitive variables)
 variable "flask_secret_key" {
   description = "Flask secret key"
@@ -128,6 +146,12 @@ variable "azure_directory_id" {
   sensitive   = true
 }
 
+variable "token_encryption_key" {
+  description = "Fernet key encrypting stored Google/Outlook tokens (comma-separate several to rotate; the first encrypts)"
+  type        = string
+  sensitive   = true
+}
+
 # Optional features
 variable "enable_cloudfront" {
   description = "Enable CloudFront CDN"
@@ -88,7 +88,8 @@ def mock_database():
     with patch('app.users_col') as mock_users, \
          patch('app.teams_col') as mock_teams, \
          patch('app.polls_col') as mock_polls, \
-         patch('app.availability_col') as mock_availability:
+         patch('app.availability_col') as mock_availability, \
+         patch('app.db') as mock_db:
         
         # Configure mock collections
         mock_users.find_one.return_value = None
@@ -102,17 +103,28 @@ def mock_database():
         
         mock_availability.find_one.return_value = None
         
+        # Collections reached through app.db: queued emails and sync jobs
+        mock_outbox = mock_db.email_outbox
+        mock_outbox.insert_many.side_effect = lambda docs, **kwargs: MagicMock(
+            inserted_ids=[ObjectId() for _ in docs]
+        )
+        mock_jobs = mock_db.jobs
+        mock_jobs.find_one.return_value = None
+        mock_jobs.insert_one.return_value = MagicMock(inserted_id=ObjectId())
+        
         yield {
             'users': mock_users,
             'teams': mock_teams,
             'polls': mock_polls,
-            'availability': mock_availability
+            'availability': mock_availability,
+            'email_outbox': mock_outbox,
+            'jobs': mock_jobs
         }
 
 @pytest.fixture
 def mock_external_services():
     """Mock external services (SendGrid, Google Calendar, etc.)"""
-    with patch('app.SendGridAPIClient') as mock_sendgrid, \
+    with patch('outbox._send') as mock_sendgrid, \
          patch('os.environ.get') as mock_env:
         
         # Mock environment variables
@@ -129,10 +141,8 @@ def mock_external_services():
         
         mock_env.side_effect = mock_get_env
         
-        # Mock SendGrid
-        mock_sg_instance = MagicMock()
-        mock_sendgrid.return_value = mock_sg_instance
-        mock_sg_instance.send.return_value = MagicMock(status_code=202)
+        # Mock SendGrid; the worker sends outbox emails through outbox._send
+        mock_sendgrid.return_value = 'test-message-id'
         
         yield {
             'sendgrid': mock_sendgrid,
@@ -0,0 +1,127 @@
+"""
+Calendar Push Tests
+
+Tests for push channel bookkeeping, using a stand-in notifier instead of
+Google watch channels or Graph subscriptions.
+"""
+
+import pytest
+from datetime import datetime, timedelta, timezone
+
+import calendar_push
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeNotifier:
+    """Records subscriptions instead of calling a provider"""
+
+    def __init__(self):
+        self.subscribed = []
+        self.renewed = []
+        self.stopped = []
+
+    def subscribe(self, email, credentials, address, token, calendar_id=None):
+        self.subscribed.append((email, address, token))
+        return {'channel_id': f'channel-{len(self.subscribed)}', 'expires_at': NOW + timedelta(days=7)}
+
+    def renew(self, channel, credentials, address):
+        self.renewed.append(channel['channel_id'])
+        return {'expires_at': NOW + timedelta(days=14)}
+
+    def unsubscribe(self, channel, credentials):
+        self.stopped.append(channel['channel_id'])
+
+
+class FakeChannels:
+    """The few calendar_channels operations ensure_channels uses"""
+
+    def __init__(self, channels=()):
+        self.channels = list(channels)
+
+    def _matches(self, channel, query):
+        for field, value in query.items():
+            if isinstance(value, dict):
+                if channel.get(field) in value['$nin']:
+                    return False
+            elif channel.get(field) != value:
+                return False
+        return True
+
+    def find_one(self, query):
+        return next((c for c in self.channels if self._matches(c, query)), None)
+
+    def find(self, query):
+        return [c for c in self.channels if self._matches(c, query)]
+
+    def update_one(self, query, update, upsert=False):
+        channel = self.find_one(query)
+        if channel is None:
+            channel = dict(query)
+            self.channels.append(channel)
+        channel.update(update['$set'])
+
+    def delete_one(self, query):
+        self.channels = [c for c in self.channels if c.get('_id') != query['_id']]
+
+
+class FakeDb:
+    def __init__(self, secondary, channels=()):
+        self.calendar_channels = FakeChannels(channels)
+        self.user = {'email': 'a@example.com', 'secondary_calendars': {'outlook': secondary}}
+
+    @property
+    def users(self):
+        user = self.user
+
+        class Users:
+            def find_one(self, query, projection=None):
+                return user
+        return Users()
+
+
+@pytest.mark.core
+class TestPushChannels:
+    """Test opening, verifying and renewing push channels"""
+
+    def test_open_channel(self):
+        """Test a channel is subscribed at the provider's webhook with a fresh secret"""
+        notifier = FakeNotifier()
+        channel = calendar_push.open_channel(notifier, 'a@example.com', 'outlook', {'access_token': 't'})
+        email, address, token = notifier.subscribed[0]
+        assert address.endswith('/webhooks/outlook')
+        assert channel['token'] == token
+        assert channel['channel_id'] == 'channel-1'
+        # Credentials live in the token store, not with the channel
+        assert 'credentials' not in channel
+
+        other = calendar_push.open_channel(notifier, 'b@example.com', 'outlook', {'access_token': 't'})
+        assert other['token'] != channel['token']
+
+    def test_check_token(self):
+        """Test notifications are only accepted with the channel's secret"""
+        channel = calendar_push.open_channel(FakeNotifier(), 'a@example.com', 'google', {})
+        assert calendar_push.check_token(channel, channel['token'])
+        assert not calendar_push.check_token(channel, 'forged')
+        assert not calendar_push.check_token(channel, None)
+        assert not calendar_push.check_token(None, channel['token'])
+
+    def test_needs_renewal(self):
+        """Test channels are renewed within the renewal margin of expiry"""
+        margin = timedelta(hours=calendar_push.CHANNEL_RENEW_HOURS)
+        assert calendar_push.needs_renewal({'expires_at': NOW + margin - timedelta(minutes=1)}, NOW)
+        assert not calendar_push.needs_renewal({'expires_at': NOW + margin + timedelta(minutes=1)}, NOW)
+
+    def test_channel_per_synced_calendar(self):
+        """Test every synced calendar is watched and calendars no longer synced stop being watched"""
+        notifier = FakeNotifier()
+        removed = {'_id': 1, 'user_email': 'a@example.com', 'provider': 'outlook',
+                   'calendar_id': 'gone', 'channel_id': 'old', 'expires_at': NOW + timedelta(days=7)}
+        db = FakeDb(['work', 'family'], [removed])
+        calendar_push.ensure_channels(db, 'a@example.com', 'outlook', {}, {'outlook': notifier}, NOW)
+
+        assert sorted(str(c['calendar_id']) for c in db.calendar_channels.channels) == ['None', 'family', 'work']
+        assert notifier.stopped == ['old']
+        # Live channels are kept on the next sync
+        calendar_push.ensure_channels(db, 'a@example.com', 'outlook', {}, {'outlook': notifier}, NOW)
+        assert len(notifier.subscribed) == 3
@@ -27,6 +27,9 @@ class TestTeamManagement:
         
         # Verify team creation was attempted
         mock_database['teams'].insert_one.assert_called_once()
+        # Invites are queued for the worker, one per address
+        queued = mock_database['email_outbox'].insert_many.call_args[0][0]
+        assert [msg['to'] for msg in queued] == ['alice@example.com', 'bob@example.com']
     
     def test_team_join(self, authenticated_client, mock_database):
         """Test user can join a team with valid code"""
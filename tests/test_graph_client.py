@@ -0,0 +1,136 @@
+"""
+Graph Client Tests
+
+Tests for the retry waits and JSON batches of the pooled Microsoft Graph
+client.
+"""
+
+import pytest
+from email.utils import formatdate
+
+import graph_client
+
+
+class FakeResponse:
+    """Just the headers, status and body of a response"""
+
+    def __init__(self, headers=None, status_code=200, body=None):
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+@pytest.mark.core
+class TestRetryAfter:
+    """Test how long throttled Graph calls wait before retrying"""
+
+    def test_seconds_header_honoured(self):
+        """Test a Retry-After in seconds is used as given"""
+        assert graph_client.retry_after(FakeResponse({'Retry-After': '7'}), 0) == 7
+
+    def test_date_header_honoured(self):
+        """Test a Retry-After HTTP date waits until that time"""
+        now = 1700000000
+        resp = FakeResponse({'Retry-After': formatdate(now + 12, usegmt=True)})
+        assert graph_client.retry_after(resp, 0, now=now) == 12
+        past = FakeResponse({'Retry-After': formatdate(now - 60, usegmt=True)})
+        assert graph_client.retry_after(past, 0, now=now) == 0
+
+    def test_backoff_without_header(self):
+        """Test waits double without a Retry-After and are capped"""
+        for attempt in range(3):
+            wait = graph_client.retry_after(FakeResponse(), attempt)
+            assert 2 ** attempt <= wait <= 2 ** attempt + 1
+        assert graph_client.retry_after(FakeResponse(), 20) == graph_client.RETRY_MAX_WAIT
+        assert graph_client.retry_after(FakeResponse({'Retry-After': '3600'}), 0) == graph_client.RETRY_MAX_WAIT
+
+
+@pytest.mark.core
+class TestRetryBudget:
+    """Test throttled calls give up when their time budget runs out"""
+
+    def test_wait_past_budget_not_made(self, monkeypatch):
+        """Test a Retry-After longer than the budget returns the throttled response"""
+        calls, sleeps = [], []
+
+        class FakeSession:
+            def request(self, method, url, **kwargs):
+                calls.append(kwargs['timeout'])
+                return FakeResponse({'Retry-After': '20'}, status_code=429)
+
+        monkeypatch.setattr(graph_client, 'session', FakeSession)
+        monkeypatch.setattr(graph_client.time, 'sleep', sleeps.append)
+        resp = graph_client.get('/me', 'me', budget=graph_client.INTERACTIVE_BUDGET)
+        assert resp.status_code == 429
+        assert sleeps == []
+        assert calls[0] <= graph_client.INTERACTIVE_BUDGET
+
+    def test_retries_within_budget(self, monkeypatch):
+        """Test short waits are still retried"""
+        responses = [FakeResponse({'Retry-After': '1'}, status_code=503), FakeResponse(body={})]
+        sleeps = []
+
+        class FakeSession:
+            def request(self, method, url, **kwargs):
+                return responses.pop(0)
+
+        monkeypatch.setattr(graph_client, 'session', FakeSession)
+        monkeypatch.setattr(graph_client.time, 'sleep', sleeps.append)
+        assert graph_client.get('/me', 'me', budget=10).status_code == 200
+        assert sleeps == [1]
+
+
+@pytest.mark.core
+class TestBatch:
+    """Test splitting Graph JSON batch responses"""
+
+    def test_responses_in_request_order(self, monkeypatch):
+        """Test each path gets its own status and body, whatever order Graph answers in"""
+        sent = []
+
+        def post(url, name, **kwargs):
+            sent.append(kwargs['json']['requests'])
+            return FakeResponse(body={'responses': [
+                {'id': '1', 'status': 403, 'body': {'error': {'code': 'ErrorAccessDenied'}}},
+                {'id': '0', 'status': 200, 'body': {'mail': 'a@example.com'}},
+            ]})
+
+        monkeypatch.setattr(graph_client, 'post', post)
+        me, mailbox = graph_client.batch('token', ['/me', '/me/mailboxSettings'], 'login')
+        assert [r['url'] for r in sent[0]] == ['/me', '/me/mailboxSettings']
+        assert (me.status_code, me.json()) == (200, {'mail': 'a@example.com'})
+        assert mailbox.status_code == 403
+        assert 'ErrorAccessDenied' in mailbox.text
+
+    def test_failed_batch_fails_every_request(self, monkeypatch):
+        """Test a rejected batch request is reported for each path"""
+        monkeypatch.setattr(graph_client, 'post', lambda url, name, **kwargs: FakeResponse(status_code=401, body='expired'))
+        responses = graph_client.batch('token', ['/me', '/me/mailboxSettings'], 'login')
+        assert [(r.status_code, r.text) for r in responses] == [(401, 'expired'), (401, 'expired')]
+
+    def test_throttled_items_retried(self, monkeypatch):
+        """Test only the paths throttled inside a batch are sent again, after their Retry-After"""
+        sent, sleeps = [], []
+        answers = [
+            {'responses': [
+                {'id': '0', 'status': 200, 'body': {'mail': 'a@example.com'}},
+                {'id': '1', 'status': 429, 'headers': {'Retry-After': '2'}, 'body': {}},
+            ]},
+            {'responses': [{'id': '1', 'status': 200, 'body': {'timeZone': 'UTC'}}]},
+        ]
+
+        def post(url, name, **kwargs):
+            sent.append([r['url'] for r in kwargs['json']['requests']])
+            return FakeResponse(body=answers.pop(0))
+
+        monkeypatch.setattr(graph_client, 'post', post)
+        monkeypatch.setattr(graph_client.time, 'sleep', sleeps.append)
+        me, mailbox = graph_client.batch('token', ['/me', '/me/mailboxSettings'], 'login', budget=15)
+        assert sent == [['/me', '/me/mailboxSettings'], ['/me/mailboxSettings']]
+        assert sleeps == [2]
+        assert (me.status_code, mailbox.status_code) == (200, 200)
+        assert mailbox.json() == {'timeZone': 'UTC'}
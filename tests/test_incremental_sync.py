@@ -0,0 +1,170 @@
+"""
+Incremental Sync Tests
+
+Tests for cursor-based calendar sync against a local fake provider, and
+for the Google/Graph event conversion.
+"""
+
+import pytest
+import pytz
+from datetime import datetime, timedelta
+
+from incremental_sync import CursorExpired, busy_in_window, pull_changes
+
+UTC = pytz.UTC
+NOW = datetime(2024, 1, 1, 8, tzinfo=UTC)
+
+
+class FakeProvider:
+    """In-memory calendar that hands out changes since a numeric cursor"""
+    name = 'fake'
+
+    def __init__(self):
+        self.events = {}
+        self.log = []
+        self.expired_before = 0
+        self.full_listings = 0
+
+    def put(self, event_id, start_hour, hours=1, busy=True):
+        start = NOW.replace(hour=0) + timedelta(hours=start_hour)
+        self.events[event_id] = (start, start + timedelta(hours=hours), busy)
+        self.log.append(event_id)
+
+    def delete(self, event_id):
+        self.events.pop(event_id)
+        self.log.append(event_id)
+
+    def _change(self, event_id):
+        if event_id not in self.events or not self.events[event_id][2]:
+            return {'id': event_id, 'busy': False}
+        start, end, _ = self.events[event_id]
+        return {'id': event_id, 'busy': True, 'start': start, 'end': end}
+
+    def changes(self, cursor, window_start=None, window_end=None):
+        if cursor is None:
+            self.full_listings += 1
+            changes = [
+                self._change(event_id) for event_id, (start, end, _) in self.events.items()
+                if start < window_end and end > window_start
+            ]
+        else:
+            if int(cursor) < self.expired_before:
+                raise CursorExpired(cursor)
+            changes = [self._change(event_id) for event_id in dict.fromkeys(self.log[int(cursor):])]
+        return changes, str(len(self.log))
+
+
+def busy_hours(state, now=NOW):
+    events = {e['id']: (e['start'], e['end']) for e in state['events']}
+    return sorted(b['start'].hour for b in busy_in_window(events, now, now + timedelta(days=7)))
+
+
+@pytest.mark.core
+class TestIncrementalSync:
+    """Test cursor-based sync patches stored events"""
+
+    def test_changes_patch_state(self):
+        """Test added, moved, freed and deleted events update the busy list"""
+        provider = FakeProvider()
+        provider.put('a', 9)
+        provider.put('b', 11)
+        state = pull_changes(provider, None, NOW)
+        assert state['full'] and busy_hours(state) == [9, 11]
+
+        provider.put('a', 10)
+        provider.put('b', 11, busy=False)
+        provider.put('c', 14)
+        provider.put('d', 15)
+        provider.delete('d')
+        state = pull_changes(provider, state, NOW)
+        assert not state['full']
+        assert busy_hours(state) == [10, 14]
+        assert provider.full_listings == 1
+
+    def test_expired_cursor_lists_again(self):
+        """Test an expired cursor falls back to listing the window"""
+        provider = FakeProvider()
+        provider.put('a', 9)
+        state = pull_changes(provider, None, NOW)
+        provider.put('b', 12)
+        provider.expired_before = len(provider.log)
+        state = pull_changes(provider, state, NOW)
+        assert state['full'] and busy_hours(state) == [9, 12]
+
+    def test_window_rolls_over(self):
+        """Test a cursor whose window no longer covers the sync horizon is replaced"""
+        provider = FakeProvider()
+        provider.put('a', 9)
+        state = pull_changes(provider, None, NOW)
+        later = NOW + timedelta(days=10)
+        state = pull_changes(provider, state, later)
+        assert state['full']
+        assert state['window_end'] > later + timedelta(days=7)
+        # Event 'a' ended long before the new window and was dropped
+        assert state['events'] == []
+
+
+@pytest.mark.core
+class TestProviderEvents:
+    """Test provider event items convert to changes"""
+
+    def test_google_items(self):
+        """Test timed, all-day, free and declined Google events"""
+        from incremental_sync import google_change
+
+        timed = google_change({'id': '1', 'start': {'dateTime': '2024-01-01T10:00:00+01:00'},
+                               'end': {'dateTime': '2024-01-01T11:00:00+01:00'}})
+        assert timed['start'] == datetime(2024, 1, 1, 9, tzinfo=UTC)
+        all_day = google_change({'id': '2', 'start': {'date': '2024-01-02'}, 'end': {'date': '2024-01-03'}},
+                                'America/New_York')
+        assert all_day['start'] == datetime(2024, 1, 2, 5, tzinfo=UTC)
+        assert not google_change({'id': '3', 'transparency': 'transparent'})['busy']
+        assert not google_change({'id': '4', 'attendees': [{'self': True, 'responseStatus': 'declined'}],
+                                  'start': {'date': '2024-01-02'}, 'end': {'date': '2024-01-03'}})['busy']
+
+    def test_outlook_items(self):
+        """Test busy, tentative and removed Graph delta items"""
+        from incremental_sync import outlook_change
+
+        busy = outlook_change({'id': '1', 'showAs': 'busy',
+                               'start': {'dateTime': '2024-01-01T09:00:00.0000000'},
+                               'end': {'dateTime': '2024-01-01T10:00:00.0000000'}})
+        assert busy['end'] == datetime(2024, 1, 1, 10, tzinfo=UTC)
+        assert not outlook_change({'id': '2', 'showAs': 'tentative'})['busy']
+        assert not outlook_change({'id': '3', '@removed': {'reason': 'deleted'}})['busy']
+
+
+class FakeUsers:
+    def update_one(self, query, update):
+        pass
+
+
+class FakeDb:
+    def __init__(self):
+        self.users = FakeUsers()
+
+
+@pytest.mark.core
+class TestSecondaryCalendars:
+    """Test incremental sync is only used for users with just a default calendar"""
+
+    def sync(self, monkeypatch, calendar_ids):
+        import calendar_sync
+        import incremental_sync
+
+        calls = []
+        monkeypatch.setattr(calendar_sync, 'INCREMENTAL_SYNC', True)
+        monkeypatch.setattr(calendar_sync, 'outlook_calendar_ids', lambda token, email: calendar_ids)
+        monkeypatch.setattr(calendar_sync, 'fetch_outlook_calendars_busy', lambda *args: [])
+        monkeypatch.setattr(calendar_sync, 'store_busy', lambda *args: calls.append('full'))
+        monkeypatch.setattr(incremental_sync, 'sync_events', lambda *args: calls.append('incremental'))
+        calendar_sync.sync_user(FakeDb(), 'a@example.com', 'outlook', {'access_token': 't'})
+        return calls
+
+    def test_default_calendar_only_incremental(self, monkeypatch):
+        """Test a user with one calendar is synced from its delta cursor"""
+        assert self.sync(monkeypatch, []) == ['incremental']
+
+    def test_secondary_calendars_full_sync(self, monkeypatch):
+        """Test secondary calendars aren't dropped by the default-calendar cursor"""
+        assert self.sync(monkeypatch, ['cal-2']) == ['full']
@@ -0,0 +1,116 @@
+"""
+Background Job Tests
+
+Tests for the calendar sync job queue and the provider response parsing
+used by the worker.
+"""
+
+import pytest
+
+
+@pytest.mark.core
+class TestRetryBackoff:
+    """Test retry delays for failed jobs"""
+
+    def test_delay_doubles_and_is_capped(self):
+        """Test each retry waits about twice as long, up to the cap"""
+        import jobs
+
+        for attempts in range(1, 12):
+            expected = min(jobs.RETRY_MAX_SECONDS, jobs.RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            delay = jobs.retry_delay(attempts)
+            assert expected / 2 <= delay <= expected
+
+
+@pytest.mark.core
+class TestGraphSchedule:
+    """Test Microsoft Graph getSchedule parsing"""
+
+    def test_only_busy_items_kept(self):
+        """Test free and tentative items are dropped"""
+        from calendar_sync import parse_graph_schedule
+
+        data = {'value': [{'scheduleItems': [
+            {'status': 'busy', 'start': {'dateTime': '2024-01-01T09:00:00.0000000'},
+             'end': {'dateTime': '2024-01-01T10:00:00.0000000'}},
+            {'status': 'tentative', 'start': {'dateTime': '2024-01-01T11:00:00.0000000'},
+             'end': {'dateTime': '2024-01-01T12:00:00.0000000'}},
+        ]}]}
+        assert parse_graph_schedule(data) == [
+            {'start': '2024-01-01T09:00:00.0000000', 'end': '2024-01-01T10:00:00.0000000'}
+        ]
+        assert parse_graph_schedule({}) == []
+
+    def test_schedules_split_by_mailbox(self):
+        """Test a batched response is split per mailbox and failed mailboxes are left out"""
+        from calendar_sync import parse_graph_schedules
+
+        busy = {'status': 'busy', 'start': {'dateTime': '2024-01-01T09:00:00.0000000'},
+                'end': {'dateTime': '2024-01-01T10:00:00.0000000'}}
+        data = {'value': [
+            {'scheduleId': 'Ann@Example.com', 'scheduleItems': [busy]},
+            {'scheduleId': 'bob@example.com', 'scheduleItems': []},
+            {'scheduleId': 'gone@example.com', 'error': {'message': 'mailbox not found'}},
+        ]}
+        assert parse_graph_schedules(data) == {
+            'ann@example.com': [{'start': '2024-01-01T09:00:00.0000000', 'end': '2024-01-01T10:00:00.0000000'}],
+            'bob@example.com': [],
+        }
+
+
+@pytest.mark.core
+class TestBusyHash:
+    """Test change detection for synced busy lists"""
+
+    def test_same_busy_in_any_format_hashes_equal(self):
+        """Test provider formats of the same busy list give one hash"""
+        from calendar_sync import busy_hash
+        from scheduling import normalize_busy
+
+        google = normalize_busy([
+            {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:00:00Z'},
+            {'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T09:30:00Z'},
+        ])
+        outlook = normalize_busy([
+            {'start': '2024-01-01T09:00:00.0000000', 'end': '2024-01-01T09:30:00.0000000'},
+            {'start': '2024-01-01T10:00:00.0000000', 'end': '2024-01-01T11:00:00.0000000'},
+        ])
+        moved = normalize_busy([
+            {'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T09:30:00Z'},
+            {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:30:00Z'},
+        ])
+        assert busy_hash(google) == busy_hash(outlook)
+        assert busy_hash(google) != busy_hash(moved)
+
+
+@pytest.mark.core
+class TestMultiCalendarBusy:
+    """Test combining busy periods fetched from several calendars"""
+
+    def test_calendars_merged_without_overlaps(self):
+        """Test overlapping busy periods of different calendars become one"""
+        from datetime import datetime, timezone
+        from calendar_sync import merge_busy
+
+        primary = [{'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T10:00:00Z'}]
+        work = [
+            {'start': '2024-01-01T09:30:00.0000000', 'end': '2024-01-01T11:00:00.0000000'},
+            {'start': '2024-01-01T13:00:00.0000000', 'end': '2024-01-01T14:00:00.0000000'},
+        ]
+        at = lambda hour: datetime(2024, 1, 1, hour, tzinfo=timezone.utc)
+        assert merge_busy([primary, work]) == [
+            {'start': at(9), 'end': at(11)},
+            {'start': at(13), 'end': at(14)},
+        ]
+        assert merge_busy([]) == []
+
+    def test_gather_keeps_call_order(self):
+        """Test concurrent fetches return results in the order requested"""
+        import time
+        from calendar_sync import gather
+
+        def call(i):
+            time.sleep(0.01 * (3 - i))
+            return i
+
+        assert gather([lambda i=i: call(i) for i in range(4)]) == [0, 1, 2, 3]
@@ -0,0 +1,113 @@
+"""
+Email Outbox Tests
+
+Tests for grouping queued emails into SendGrid requests and recording
+how a send went.
+"""
+
+import pytest
+
+import outbox
+
+
+class FakeCollection:
+    """Records update calls on the email_outbox collection"""
+
+    def __init__(self):
+        self.updates = []
+
+    def update_one(self, query, update):
+        self.updates.append((query, update))
+
+    def update_many(self, query, update):
+        self.updates.append((query, update))
+
+
+class FakeDb:
+    def __init__(self):
+        self.email_outbox = FakeCollection()
+
+
+class SendGridError(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.body = 'error'
+
+
+def claimed(to, subject='Invite', content=None, attempts=1, index=0):
+    msg = outbox.message(to, subject, content or [{'type': 'text/html', 'value': '<p>Join</p>'}], key=to)
+    return dict(msg, _id=f'id{index}', status=outbox.SENDING, attempts=attempts)
+
+
+@pytest.mark.core
+class TestGrouping:
+    """Test which emails can share one SendGrid request"""
+
+    def test_identical_content_shares_group(self):
+        """Test recipients only differ in their address"""
+        assert claimed('a@example.com')['group_key'] == claimed('b@example.com')['group_key']
+
+    def test_different_content_separate_groups(self):
+        """Test a different subject or body is never merged"""
+        base = claimed('a@example.com')['group_key']
+        assert claimed('a@example.com', subject='Other')['group_key'] != base
+        assert claimed('a@example.com', content=[{'type': 'text/plain', 'value': 'x'}])['group_key'] != base
+
+    def test_payload_personalization_per_recipient(self):
+        """Test each recipient gets its own personalization tagged with its outbox id"""
+        batch = [claimed('a@example.com', index=0), claimed('b@example.com', index=1)]
+        payload = outbox.sendgrid_payload(batch)
+        assert [p['to'] for p in payload['personalizations']] == [[{'email': 'a@example.com'}], [{'email': 'b@example.com'}]]
+        assert [p['custom_args']['outbox_id'] for p in payload['personalizations']] == ['id0', 'id1']
+        assert payload['subject'] == 'Invite'
+
+
+@pytest.mark.core
+class TestSendBatch:
+    """Test the outcome recorded for a sent batch"""
+
+    def test_success_marks_sent(self):
+        """Test a sent batch records SendGrid's message id"""
+        db = FakeDb()
+        batch = [claimed('a@example.com', index=0), claimed('b@example.com', index=1)]
+        assert outbox.send_batch(db, batch, send=lambda payload: 'msg-1') == 2
+        query, update = db.email_outbox.updates[0]
+        assert query == {'_id': {'$in': ['id0', 'id1']}}
+        assert update['$set']['status'] == outbox.SENT
+        assert update['$set']['sg_message_id'] == 'msg-1'
+
+    def test_server_error_retried(self):
+        """Test a 5xx queues the batch again with backoff"""
+        db = FakeDb()
+
+        def send(payload):
+            raise SendGridError(503)
+
+        outbox.send_batch(db, [claimed('a@example.com')], send=send)
+        update = db.email_outbox.updates[0][1]
+        assert update['$set']['status'] == outbox.QUEUED
+        assert 'run_at' in update['$set']
+
+    def test_rejected_batch_split(self):
+        """Test a 4xx on several emails requeues each on its own"""
+        db = FakeDb()
+        batch = [claimed('a@example.com', index=0), claimed('bad', index=1)]
+
+        def send(payload):
+            raise SendGridError(400)
+
+        outbox.send_batch(db, batch, send=send)
+        keys = {update['$set']['group_key'] for _, update in db.email_outbox.updates}
+        assert len(keys) == 2
+        assert all(update['$set']['status'] == outbox.QUEUED for _, update in db.email_outbox.updates)
+
+    def test_last_attempt_fails(self):
+        """Test a batch out of attempts is marked failed"""
+        db = FakeDb()
+
+        def send(payload):
+            raise SendGridError(503)
+
+        outbox.send_batch(db, [claimed('a@example.com', attempts=outbox.OUTBOX_MAX_ATTEMPTS)], send=send)
+        assert db.email_outbox.updates[0][1]['$set']['status'] == outbox.FAILED
@@ -0,0 +1,74 @@
+"""
+Re-sync Scheduler Tests
+
+Tests for ordering and spreading scheduled re-syncs.
+"""
+
+import random
+
+import pytest
+
+import scheduler
+
+
+@pytest.mark.core
+class TestResyncPlan:
+    """Test priority ordering and jitter of planned re-syncs"""
+
+    def test_priority_members_first(self):
+        """Test recently searched teams' members are due before everyone else"""
+        stale = {f'user{i}@example.com': 'google' for i in range(20)}
+        priority = ['user7@example.com', 'nobody@example.com', 'user3@example.com']
+        plan = scheduler.plan_resyncs(stale, priority, rng=random.Random(1))
+
+        assert [email for email, _, _ in plan[:2]] == ['user7@example.com', 'user3@example.com']
+        assert len(plan) == len(stale)
+        delays = {email: delay for email, _, delay in plan}
+        assert delays['user7@example.com'] < delays['user3@example.com'] <= scheduler.RESYNC_PRIORITY_SPREAD
+        others = [delay for email, _, delay in plan[2:]]
+        assert all(scheduler.RESYNC_PRIORITY_SPREAD <= d <= scheduler.RESYNC_PRIORITY_SPREAD + scheduler.RESYNC_SPREAD
+                   for d in others)
+        # Jitter spreads the rest rather than queueing them at one instant
+        assert len(set(others)) == len(others)
+
+
+class FakeCursor(list):
+    def batch_size(self, size):
+        return self
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection=None):
+        emails = query.get('user_email', {}).get('$in')
+        return FakeCursor(doc for doc in self.docs if emails is None or doc['user_email'] in emails)
+
+    def distinct(self, field, query):
+        self.queries.append(query)
+        return [doc[field] for doc in self.docs if doc[field] in query['user_email']['$in']]
+
+
+class FakeDb:
+    def __init__(self, stale, holders):
+        self.availability = FakeCollection([{'user_email': e, 'provider': 'google'} for e in stale])
+        self.oauth_tokens = FakeCollection([{'user_email': e} for e in holders])
+
+
+@pytest.mark.core
+class TestStaleUsers:
+    """Test choosing stale users that can be re-synced"""
+
+    def test_tokens_checked_per_page(self, monkeypatch):
+        """Test only stale users are looked up in the token store, a page at a time"""
+        monkeypatch.setattr(scheduler, 'RESYNC_BATCH', 3)
+        stale_emails = [f'user{i}@example.com' for i in range(8)]
+        # user0-3 revoked access; they must not crowd out later pages
+        db = FakeDb(stale_emails, stale_emails[4:] + ['fresh@example.com'])
+        stale = {}
+        scheduler.add_stale_users(db, stale, scheduler._now())
+
+        assert list(stale) == ['user4@example.com', 'user5@example.com', 'user6@example.com']
+        assert all(len(q['user_email']['$in']) <= 3 for q in db.oauth_tokens.queries)
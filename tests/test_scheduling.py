@@ -0,0 +1,242 @@
+"""
+Scheduling Engine Tests
+
+Tests for the slot search engine shared by /api/propose_slots and
+/team/<team_id>/suggest_slots. The engine has no Flask or MongoDB
+dependency, so these tests run against plain data.
+"""
+
+import pytest
+import pytz
+from datetime import datetime
+
+from scheduling import SearchSpec, parse_busy, merge_intervals, find_slots
+
+UTC = pytz.UTC
+
+
+def make_spec(**overrides):
+    """Monday 2024-01-01 00:00 UTC, 9:00-17:00 window, one-hour slots"""
+    params = dict(
+        tz=UTC,
+        now=datetime(2024, 1, 1, tzinfo=UTC),
+        duration=60,
+        start_hour=9,
+        end_hour=17,
+        days_of_week=list(range(7)),
+        horizon_days=1
+    )
+    params.update(overrides)
+    return SearchSpec(**params)
+
+
+@pytest.mark.core
+class TestBusyParsing:
+    """Test busy interval parsing and merging"""
+
+    def test_parse_mixed_formats(self):
+        """Test Z-suffixed, offset and naive timestamps all parse to UTC"""
+        busy = parse_busy([
+            {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:00:00Z'},
+            {'start': '2024-01-01T08:00:00-01:00', 'end': '2024-01-01T09:30:00-01:00'},
+            {'start': '2024-01-01T12:00:00', 'end': '2024-01-01T13:00:00'},
+        ])
+        assert busy[0] == (datetime(2024, 1, 1, 9, tzinfo=UTC), datetime(2024, 1, 1, 10, 30, tzinfo=UTC))
+        assert busy[2] == (datetime(2024, 1, 1, 12, tzinfo=UTC), datetime(2024, 1, 1, 13, tzinfo=UTC))
+
+    def test_normalize_for_storage(self):
+        """Test provider formats normalise to sorted UTC datetimes and back"""
+        from scheduling import normalize_busy, serialize_busy
+
+        stored = normalize_busy([
+            {'start': '2024-01-01T12:00:00', 'end': '2024-01-01T13:00:00'},
+            {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:00:00Z'},
+            {'start': datetime(2024, 1, 1, 14), 'end': datetime(2024, 1, 1, 15)},
+        ])
+        assert all(b['start'].tzinfo is not None for b in stored)
+        assert serialize_busy(stored) == [
+            {'start': '2024-01-01T10:00:00Z', 'end': '2024-01-01T11:00:00Z'},
+            {'start': '2024-01-01T12:00:00Z', 'end': '2024-01-01T13:00:00Z'},
+            {'start': '2024-01-01T14:00:00Z', 'end': '2024-01-01T15:00:00Z'},
+        ]
+        assert parse_busy(stored)[0] == (stored[0]['start'], stored[0]['end'])
+
+    def test_merge_overlapping(self):
+        """Test overlapping and touching intervals collapse into one"""
+        merged = merge_intervals([(1, 3), (2, 4), (4, 5), (7, 8)])
+        assert merged == [(1, 5), (7, 8)]
+
+
+@pytest.mark.core
+class TestFindSlots:
+    """Test free slot search"""
+
+    def test_all_free(self):
+        """Test an empty calendar returns the first slots of the day"""
+        slots = find_slots({}, make_spec())
+        assert [s.hour for s, _ in slots] == [9, 10, 11, 12, 13]
+
+    def test_conflicts_removed(self):
+        """Test a slot overlapping any participant's busy time is skipped"""
+        busy_by_member = {
+            'a@example.com': parse_busy([{'start': '2024-01-01T09:30:00Z', 'end': '2024-01-01T10:00:00Z'}]),
+            'b@example.com': parse_busy([{'start': '2024-01-01T11:00:00Z', 'end': '2024-01-01T12:00:00Z'}]),
+        }
+        slots = find_slots(busy_by_member, make_spec())
+        assert [s.hour for s, _ in slots] == [10, 12, 13, 14, 15]
+
+    def test_avoid_work_hours(self):
+        """Test work hours are skipped on weekdays"""
+        spec = make_spec(start_hour=8, end_hour=20, step=60, avoid_hours=(8, 17), fit_window=False)
+        slots = find_slots({}, spec)
+        assert [s.hour for s, _ in slots] == [17, 18, 19]
+
+    def test_split_spreads_days(self):
+        """Test the split algorithm takes one slot per day in turn"""
+        spec = make_spec(horizon_days=3, algorithm='split', limit=3)
+        slots = find_slots({}, spec)
+        assert [s.day for s, _ in slots] == [1, 2, 3]
+
+    def test_stops_at_synced_window(self):
+        """Test no slot ends after the members' calendars were fetched up to"""
+        spec = make_spec(horizon_days=90, limit=100, until=datetime(2024, 1, 3, 12, tzinfo=UTC))
+        slots = find_slots({}, spec)
+        assert len(slots) == 8 + 8 + 3
+        assert slots[-1][1] == datetime(2024, 1, 3, 12, tzinfo=UTC)
+
+
+@pytest.mark.core
+class TestAttendanceRanking:
+    """Test best-attendance ranking when no slot fits everyone"""
+
+    def test_counts_conflicting_members(self):
+        """Test slots are ordered by conflicts and report who is busy"""
+        from scheduling import rank_by_attendance
+
+        busy_by_member = {
+            # Two short meetings with a gap too small for a slot count once
+            'a@example.com': parse_busy([
+                {'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T09:20:00Z'},
+                {'start': '2024-01-01T09:40:00Z', 'end': '2024-01-01T11:00:00Z'},
+            ]),
+            'b@example.com': parse_busy([{'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T17:00:00Z'}]),
+        }
+        ranked = rank_by_attendance(busy_by_member, make_spec(), top_n=3)
+        assert [(s.hour, conflicts) for s, _, conflicts in ranked] == [
+            (11, ['b@example.com']),
+            (12, ['b@example.com']),
+            (13, ['b@example.com']),
+        ]
+
+    def test_matches_brute_force(self):
+        """Test sweep conflict counts match a direct overlap check"""
+        import random
+        from datetime import timedelta
+        from scheduling import candidate_slots, rank_by_attendance
+
+        rng = random.Random(7)
+        origin = datetime(2024, 1, 1, tzinfo=UTC)
+        busy_by_member = {}
+        for member in range(15):
+            intervals = []
+            for _ in range(rng.randint(0, 12)):
+                start = origin + timedelta(minutes=rng.randint(0, 3 * 24 * 60))
+                intervals.append((start, start + timedelta(minutes=rng.randint(5, 120))))
+            busy_by_member[f'user{member}@example.com'] = sorted(intervals)
+
+        spec = make_spec(duration=30, step=15, horizon_days=3)
+        candidates = list(candidate_slots(spec))
+        ranked = rank_by_attendance(busy_by_member, spec, top_n=len(candidates))
+        for slot_start, slot_end, conflicts in ranked:
+            expected = sorted(
+                email for email, intervals in busy_by_member.items()
+                if any(s < slot_end and e > slot_start for s, e in intervals)
+            )
+            assert conflicts == expected
+        counts = [len(conflicts) for _, _, conflicts in ranked]
+        assert counts == sorted(counts)
+
+
+@pytest.mark.core
+class TestLazyPipeline:
+    """Test the generator pipeline stops early"""
+
+    def test_next_stops_early(self):
+        """Test 'next' only generates candidates until it has enough slots"""
+        from scheduling import free_slots, candidate_slots, select_next
+
+        spec = make_spec(horizon_days=90)
+        pulled = []
+
+        def counting(slots):
+            for slot in slots:
+                pulled.append(slot)
+                yield slot
+
+        selected = select_next(free_slots(counting(candidate_slots(spec)), []), 5)
+        assert len(selected) == 5
+        assert len(pulled) == 5
+
+    def test_split_matches_eager(self):
+        """Test round-robin over per-day iterators matches grouping all slots first"""
+        spec = make_spec(horizon_days=4, algorithm='split', limit=7)
+        busy_by_member = {
+            'a@example.com': parse_busy([{'start': '2024-01-02T09:00:00Z', 'end': '2024-01-02T16:00:00Z'}]),
+        }
+        slots = find_slots(busy_by_member, spec)
+        assert [(s.day, s.hour) for s, _ in slots] == [
+            (1, 9), (2, 16), (3, 9), (4, 9), (1, 10), (3, 10), (4, 10)
+        ]
+
+
+@pytest.mark.core
+class TestGapWalk:
+    """Test the gap-walking search against brute-force enumeration"""
+
+    @pytest.mark.parametrize('step,avoid_hours,fit_window', [
+        (5, None, True),
+        (15, (8, 17), False),
+        (30, (0, 17), True),
+        (60, None, False),
+    ])
+    def test_matches_enumeration(self, step, avoid_hours, fit_window):
+        """Test walking gaps yields exactly the free grid starts"""
+        import random
+        from datetime import timedelta
+        from scheduling import candidate_slots, free_slots
+
+        rng = random.Random(step)
+        tz = pytz.timezone('America/New_York')
+        origin = datetime(2024, 3, 8, tzinfo=UTC)  # spans the DST change
+        intervals = []
+        for _ in range(40):
+            start = origin + timedelta(minutes=rng.randint(0, 5 * 24 * 60))
+            intervals.append((start, start + timedelta(minutes=rng.randint(5, 240))))
+        busy = merge_intervals(intervals)
+
+        spec = make_spec(tz=tz, now=origin, duration=45, step=step, horizon_days=5,
+                         start_hour=7, end_hour=21, avoid_hours=avoid_hours, fit_window=fit_window)
+        enumerated = list(free_slots(candidate_slots(spec), busy))
+        walked = list(candidate_slots(spec, busy))
+        assert walked == enumerated
+        assert walked
+
+
+@pytest.mark.core
+class TestBusyHistogram:
+    """Test per-bucket busy counts for the heatmap"""
+
+    def test_counts_members_once_per_bucket(self):
+        """Test overlapping intervals of one member count once"""
+        from scheduling import busy_histogram
+
+        busy_by_member = {
+            'a@example.com': parse_busy([
+                {'start': '2024-01-01T09:00:00Z', 'end': '2024-01-01T09:20:00Z'},
+                {'start': '2024-01-01T09:10:00Z', 'end': '2024-01-01T09:25:00Z'},
+            ]),
+            'b@example.com': parse_busy([{'start': '2024-01-01T08:50:00Z', 'end': '2024-01-01T09:15:00Z'}]),
+        }
+        window = (datetime(2024, 1, 1, 9, tzinfo=UTC), datetime(2024, 1, 1, 10, tzinfo=UTC))
+        expected = [2, 1, 0, 0]
+        assert busy_histogram(busy_by_member, *window, bucket_minutes=15) == expected
@@ -0,0 +1,80 @@
+"""
+Slot Cache Tests
+
+Tests for the slot search result cache and its metrics.
+"""
+
+import pytest
+import pytz
+from datetime import datetime, timedelta
+
+import metrics
+from scheduling import SearchSpec
+from slot_cache import SlotCache, search_key
+
+
+@pytest.mark.core
+class TestSlotCache:
+    """Test LRU/TTL eviction and hit/miss counting"""
+
+    def test_hit_and_miss_counted(self):
+        """Test lookups are counted as hits or misses"""
+        cache = SlotCache(max_entries=10, ttl_seconds=60)
+        hits = metrics.value('slot_cache_hits_total')
+        misses = metrics.value('slot_cache_misses_total')
+
+        assert cache.get('key') is None
+        cache.set('key', ['slot'])
+        assert cache.get('key') == ['slot']
+
+        assert metrics.value('slot_cache_hits_total') == hits + 1
+        assert metrics.value('slot_cache_misses_total') == misses + 1
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted when full"""
+        cache = SlotCache(max_entries=2, ttl_seconds=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert len(cache) == 2
+
+    def test_ttl_expiry(self):
+        """Test expired entries are not served"""
+        cache = SlotCache(max_entries=2, ttl_seconds=0)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def test_metrics_rendered(self):
+        """Test counters appear in the Prometheus output"""
+        metrics.inc('slot_cache_hits_total')
+        assert 'calstack_slot_cache_hits_total' in metrics.render()
+
+
+@pytest.mark.core
+class TestSearchKey:
+    """Test re-syncs that only restamp covered_until keep the cache key"""
+
+    def spec(self, until):
+        now = pytz.UTC.localize(datetime(2026, 3, 2, 9))
+        return SearchSpec(
+            tz=pytz.UTC, now=now, duration=30, start_hour=9, end_hour=17,
+            days_of_week=[0, 1, 2, 3, 4], until=until, horizon_days=14
+        )
+
+    def key(self, until):
+        return search_key('team', 't1', ['a@example.com'], self.spec(until), 1)
+
+    def test_until_past_horizon_ignored(self):
+        """Test coverage beyond the horizon doesn't change the key"""
+        now = self.spec(None).now
+        assert self.key(now + timedelta(days=30)) == self.key(now + timedelta(days=30, minutes=5)) == self.key(None)
+
+    def test_until_within_horizon_rounded(self):
+        """Test coverage inside the horizon is keyed to the hour"""
+        now = self.spec(None).now
+        assert self.key(now + timedelta(days=3, minutes=5)) == self.key(now + timedelta(days=3, minutes=50))
+        assert self.key(now + timedelta(days=3)) != self.key(now + timedelta(days=4))
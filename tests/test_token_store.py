@@ -0,0 +1,69 @@
+"""
+Token Store Tests
+
+Tests for encrypting stored OAuth credentials and reading Microsoft
+token responses.
+"""
+
+import pytest
+from datetime import datetime, timedelta, timezone
+
+import token_store
+
+
+@pytest.mark.core
+class TestTokenEncryption:
+    """Test credentials are only stored encrypted"""
+
+    def test_round_trip(self, monkeypatch):
+        """Test encrypted credentials decrypt to the original and don't contain the token"""
+        from cryptography.fernet import Fernet
+
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', Fernet.generate_key().decode())
+        credentials = {'access_token': 'secret-access', 'refresh_token': 'secret-refresh', 'scopes': ['a']}
+        ciphertext = token_store.encrypt(credentials)
+        assert 'secret' not in ciphertext
+        assert token_store.decrypt(ciphertext) == credentials
+
+    def test_key_rotation(self, monkeypatch):
+        """Test tokens encrypted under an old key still decrypt after a new key is added"""
+        from cryptography.fernet import Fernet
+
+        old, new = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', old)
+        ciphertext = token_store.encrypt({'token': 't'})
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', f'{new},{old}')
+        assert token_store.decrypt(ciphertext) == {'token': 't'}
+
+    def test_missing_key(self, monkeypatch):
+        """Test tokens are never stored without a key"""
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', '')
+        with pytest.raises(RuntimeError):
+            token_store.encrypt({'token': 't'})
+
+    def test_check_key_missing(self, monkeypatch):
+        """Test startup fails without a key instead of the first login"""
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', '')
+        with pytest.raises(RuntimeError):
+            token_store.check_key()
+
+    def test_check_key_malformed(self, monkeypatch):
+        """Test a key that isn't a Fernet key fails startup"""
+        pytest.importorskip('cryptography')
+        monkeypatch.setattr(token_store, 'TOKEN_ENCRYPTION_KEY', 'not-a-key')
+        with pytest.raises(RuntimeError):
+            token_store.check_key()
+
+
+@pytest.mark.core
+class TestOutlookCredentials:
+    """Test Microsoft token responses become stored credentials"""
+
+    def test_expiry_from_expires_in(self):
+        """Test the access token expiry is taken from expires_in"""
+        before = datetime.now(timezone.utc)
+        credentials, expires_at = token_store.outlook_credentials(
+            {'access_token': 'a', 'refresh_token': 'r', 'expires_in': 3599}, ['Calendars.Read']
+        )
+        assert credentials == {'access_token': 'a', 'refresh_token': 'r', 'scopes': ['Calendars.Read']}
+        assert before + timedelta(seconds=3599) <= expires_at <= datetime.now(timezone.utc) + timedelta(seconds=3599)
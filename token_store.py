@@ -0,0 +1,214 @@
+"""
+Server-side OAuth token store for Calstack.
+
+Google and Outlook credentials are kept in the `oauth_tokens` collection,
+one document per (user_email, provider), encrypted with Fernet under
+TOKEN_ENCRYPTION_KEY. The session only records which provider the user
+logged in with. Background syncs (worker.py, scheduler.py, push
+notifications) read credentials with get(), so any member's calendar
+can be refreshed without them logging in again.
+
+Access tokens last about an hour. Workers call refresh_due() to renew
+those expiring within TOKEN_REFRESH_MARGIN_MINUTES; get() also renews an
+already expired token itself. A refresh token the provider rejects
+(revoked access, password change) marks the document revoked until the
+user logs in again.
+
+TOKEN_ENCRYPTION_KEY is a Fernet key, e.g. from
+`python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`.
+Several comma-separated keys may be given to rotate keys: the first
+encrypts, all decrypt.
+
+A document holds user_email, provider, token (ciphertext), expires_at,
+updated_at and, while refreshing or after a failure, refresh_lease,
+refresh_error and revoked_at.
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import graph_client
+import metrics
+from scheduling import to_utc
+
+TOKEN_ENCRYPTION_KEY = os.environ.get('TOKEN_ENCRYPTION_KEY', '')
+TOKEN_REFRESH_MARGIN_MINUTES = int(os.environ.get('TOKEN_REFRESH_MARGIN_MINUTES', 10))
+TOKEN_REFRESH_BATCH = int(os.environ.get('TOKEN_REFRESH_BATCH', 200))
+# How long one worker holds a token while refreshing it
+REFRESH_LEASE = timedelta(minutes=2)
+MS_TOKEN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+
+
+class TokenRevoked(Exception):
+    """The provider rejected the refresh token; the user must log in again."""
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _fernet():
+    keys = [key.strip() for key in TOKEN_ENCRYPTION_KEY.split(',') if key.strip()]
+    if not keys:
+        raise RuntimeError("TOKEN_ENCRYPTION_KEY is not set; Google/Outlook tokens cannot be stored")
+    from cryptography.fernet import Fernet, MultiFernet
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def check_key():
+    """
+    Fail at startup, not on the first login, unless TOKEN_ENCRYPTION_KEY
+    holds valid Fernet keys. Raises RuntimeError.
+    """
+    try:
+        _fernet()
+    except ValueError as e:
+        # Fernet rejects keys that aren't 32 url-safe base64-encoded bytes
+        raise RuntimeError(f"TOKEN_ENCRYPTION_KEY is not a valid Fernet key: {e}")
+
+
+def encrypt(credentials):
+    return _fernet().encrypt(json.dumps(credentials).encode()).decode()
+
+
+def decrypt(token):
+    return json.loads(_fernet().decrypt(token.encode()))
+
+
+def save(db, email, provider, credentials, expires_at=None):
+    """
+    Store email's credentials for provider. A refresh token missing from
+    credentials (providers only send one on consent) is kept from the
+    stored credentials.
+    """
+    query = {'user_email': email, 'provider': provider}
+    if not credentials.get('refresh_token'):
+        current = db.oauth_tokens.find_one(query, {'token': 1})
+        if current:
+            refresh_token = decrypt(current['token']).get('refresh_token')
+            credentials = dict(credentials, refresh_token=refresh_token)
+    db.oauth_tokens.update_one(query, {
+        '$set': {'token': encrypt(credentials), 'expires_at': expires_at, 'updated_at': _now()},
+        '$unset': {'refresh_lease': '', 'refresh_error': '', 'revoked_at': ''}
+    }, upsert=True)
+
+
+def get(db, email, provider, now=None):
+    """
+    email's credentials for provider, renewed first if already expired,
+    or None if none are stored or they were revoked.
+    """
+    doc = db.oauth_tokens.find_one({'user_email': email, 'provider': provider, 'revoked_at': None})
+    if not doc:
+        return None
+    credentials = decrypt(doc['token'])
+    if doc.get('expires_at') and to_utc(doc['expires_at']) <= (now or _now()):
+        try:
+            credentials = _refresh(db, doc, credentials)
+        except TokenRevoked:
+            return None
+    return credentials
+
+
+def users_with_tokens(db, emails):
+    """Those of emails with usable stored credentials for some provider."""
+    return set(db.oauth_tokens.distinct('user_email', {'user_email': {'$in': emails}, 'revoked_at': None}))
+
+
+def refresh_due(db, now=None):
+    """
+    Renew up to TOKEN_REFRESH_BATCH access tokens expiring within the
+    margin. Each is leased first so concurrent workers don't refresh it
+    twice; a failed refresh is retried once the lease lapses. Returns how
+    many were renewed.
+    """
+    now = now or _now()
+    refreshed = 0
+    for _ in range(TOKEN_REFRESH_BATCH):
+        doc = db.oauth_tokens.find_one_and_update(
+            {
+                'expires_at': {'$lt': now + timedelta(minutes=TOKEN_REFRESH_MARGIN_MINUTES)},
+                'revoked_at': None,
+                '$or': [{'refresh_lease': {'$exists': False}}, {'refresh_lease': {'$lt': now}}]
+            },
+            {'$set': {'refresh_lease': now + REFRESH_LEASE}}
+        )
+        if doc is None:
+            break
+        try:
+            _refresh(db, doc, decrypt(doc['token']))
+        except Exception as e:
+            print(f"Could not refresh {doc['provider']} token for {doc['user_email']}: {e}")
+            continue
+        refreshed += 1
+    return refreshed
+
+
+def _refresh(db, doc, credentials):
+    """Renew credentials' access token with the provider and store the result."""
+    provider = doc['provider']
+    query = {'_id': doc['_id']}
+    try:
+        credentials, expires_at = REFRESHERS[provider](credentials)
+    except TokenRevoked as e:
+        db.oauth_tokens.update_one(query, {'$set': {'revoked_at': _now(), 'refresh_error': str(e)}})
+        metrics.inc('token_refreshes_total', provider=provider, result='revoked')
+        raise
+    except Exception as e:
+        db.oauth_tokens.update_one(query, {'$set': {'refresh_error': str(e)}})
+        metrics.inc('token_refreshes_total', provider=provider, result='failed')
+        raise
+    save(db, doc['user_email'], provider, credentials, expires_at)
+    metrics.inc('token_refreshes_total', provider=provider, result='refreshed')
+    return credentials
+
+
+def refresh_google(credentials):
+    """New Google access token; returns (credentials, expires_at)."""
+    from google.auth.exceptions import RefreshError
+    from google.auth.transport.requests import Request
+    from calendar_sync import google_credentials
+    creds = google_credentials(credentials)
+    try:
+        creds.refresh(Request())
+    except RefreshError as e:
+        if 'invalid_grant' in str(e):
+            raise TokenRevoked(str(e))
+        raise
+    # google-auth keeps expiry as naive UTC
+    expires_at = creds.expiry.replace(tzinfo=timezone.utc) if creds.expiry else None
+    return dict(credentials, token=creds.token, refresh_token=creds.refresh_token), expires_at
+
+
+def refresh_outlook(credentials):
+    """New Microsoft access (and refresh) token; returns (credentials, expires_at)."""
+    if not credentials.get('refresh_token'):
+        raise TokenRevoked("no refresh token stored")
+    resp = graph_client.post(MS_TOKEN_URL, 'token_refresh', data={
+        'client_id': os.environ.get('MS_CLIENT_ID'),
+        'client_secret': os.environ.get('MS_CLIENT_SECRET'),
+        'grant_type': 'refresh_token',
+        'refresh_token': credentials['refresh_token'],
+        'scope': ' '.join(credentials.get('scopes') or [])
+    })
+    if resp.status_code == 400 and resp.json().get('error') == 'invalid_grant':
+        raise TokenRevoked(resp.text)
+    if resp.status_code != 200:
+        raise RuntimeError(f"Microsoft token refresh failed ({resp.status_code}): {resp.text}")
+    return outlook_credentials(resp.json(), credentials.get('scopes'))
+
+
+def outlook_credentials(token_data, scopes):
+    """(credentials, expires_at) from a Microsoft token endpoint response."""
+    expires_at = _now() + timedelta(seconds=int(token_data.get('expires_in', 3600)))
+    return {
+        'access_token': token_data['access_token'],
+        'refresh_token': token_data.get('refresh_token'),
+        'scopes': scopes
+    }, expires_at
+
+
+REFRESHERS = {
+    'google': refresh_google,
+    'outlook': refresh_outlook,
+}
@@ -0,0 +1,192 @@
+"""
+Calstack background worker.
+
+Runs jobs queued in the `jobs` collection (see jobs.py):
+
+    python worker.py
+
+Start one or more next to the web app. Jobs are claimed atomically, so
+several workers never run the same job. SIGTERM/SIGINT finish the
+current job and exit. With CALENDAR_WEBHOOK_URL set, workers also
+open push channels for synced calendars and renew them before they
+expire (see calendar_push.py). One worker at a time also queues
+re-syncs for stale calendars (see scheduler.py), and workers renew
+stored access tokens before they expire (see token_store.py) and send
+queued invite and meeting emails (see outbox.py). Set WORKER_METRICS_PORT
+to expose this worker's metrics (job outcomes, unchanged syncs) at
+/metrics on that port.
+"""
+import os
+import signal
+import socket
+import time
+
+import calendar_push
+import calendar_sync
+import jobs
+import metrics
+import mongo
+import outbox
+import scheduler
+import token_store
+
+POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 2))
+METRICS_PORT = os.environ.get('WORKER_METRICS_PORT')
+STALE_CHECK_INTERVAL = 60
+TOKEN_REFRESH_INTERVAL = 60
+CHANNEL_CHECK_INTERVAL = 600
+# getSchedule calls one Outlook sync may make for colleagues in its tenant
+SCHEDULE_BATCH_CALLS = int(os.environ.get('SCHEDULE_BATCH_CALLS', 5))
+
+
+def claim_schedule_peers(db, job):
+    """Queued Outlook syncs of job's tenant colleagues, to be read with job's token."""
+    if job['provider'] != 'outlook' or calendar_sync.INCREMENTAL_SYNC:
+        return []
+    peers = calendar_sync.schedule_peers(db, job['email'])
+    return jobs.claim_peers(db, job, peers, calendar_sync.GRAPH_SCHEDULES_PER_CALL * SCHEDULE_BATCH_CALLS)
+
+
+def run_schedule_peers(db, job, peers):
+    """Sync peers with batched getSchedule calls; those Graph could not read are retried alone."""
+    error = "mailbox not readable from a colleague's account"
+    try:
+        credentials = job.get('credentials') or token_store.get(db, job['email'], 'outlook')
+        synced = set(calendar_sync.sync_outlook_schedules(
+            db, [peer['email'] for peer in peers], credentials['access_token']
+        ))
+    except Exception as e:
+        synced, error = set(), str(e)
+    for peer in peers:
+        if peer['email'] in synced:
+            calendar_push.clear_dirty(db, peer['email'], peer['started_at'])
+            metrics.inc('jobs_total', type=peer['type'], result='done')
+            jobs.complete(db, peer)
+        else:
+            metrics.inc('jobs_total', type=peer['type'], result='failed')
+            jobs.fail(db, peer, error)
+    print(f"Synced {len(synced)} of {len(peers)} Outlook colleagues of {job['email']} in one batch")
+
+
+def run_sync(db, job):
+    peers = claim_schedule_peers(db, job)
+    try:
+        count = calendar_sync.sync_user(db, job['email'], job['provider'], credentials=job.get('credentials'))
+    except Exception as e:
+        for peer in peers:
+            jobs.fail(db, peer, f"batched with {job['email']}, whose sync failed: {e}")
+        raise
+    print(f"Synced {job['provider']} availability for {job['email']}: {count} busy periods")
+    calendar_push.clear_dirty(db, job['email'], job['started_at'])
+    if calendar_push.PUSH_ENABLED and job['provider'] in calendar_push.NOTIFIERS:
+        try:
+            credentials = job.get('credentials') or token_store.get(db, job['email'], job['provider'])
+            calendar_push.ensure_channels(db, job['email'], job['provider'], credentials)
+        except Exception as e:
+            # The sync itself succeeded; without a channel the user is only synced on login
+            print(f"Could not open {job['provider']} push channel for {job['email']}: {e}")
+    if peers:
+        run_schedule_peers(db, job, peers)
+
+
+HANDLERS = {
+    jobs.SYNC_AVAILABILITY: run_sync,
+}
+
+
+def run_job(db, job):
+    """Run one claimed job and record whether it succeeded."""
+    try:
+        handler = HANDLERS.get(job['type'])
+        if handler is None:
+            raise ValueError(f"Unknown job type {job['type']}")
+        with metrics.timer('job_duration_seconds', type=job['type']):
+            handler(db, job)
+    except Exception as e:
+        print(f"Job {job['_id']} ({job['type']} for {job.get('email')}) failed on attempt {job['attempts']}: {e}")
+        metrics.inc('jobs_total', type=job['type'], result='failed')
+        jobs.fail(db, job, str(e))
+    else:
+        metrics.inc('jobs_total', type=job['type'], result='done')
+        jobs.complete(db, job)
+
+
+def serve_metrics(port):
+    """Serve metrics.render() at /metrics from a background thread."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def main():
+    token_store.check_key()
+    client = mongo.create_client()
+    db = client.calstack
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT))
+    print(f"Worker {worker_id} started")
+    last_stale_check = 0
+    last_token_refresh = 0
+    last_channel_check = 0
+    last_schedule = 0
+    try:
+        while not stopping:
+            if time.monotonic() - last_stale_check > STALE_CHECK_INTERVAL:
+                requeued = jobs.requeue_stale(db)
+                if requeued:
+                    print(f"Requeued {requeued} stale jobs")
+                requeued = outbox.requeue_stale(db)
+                if requeued:
+                    print(f"Requeued {requeued} emails left sending")
+                last_stale_check = time.monotonic()
+            if time.monotonic() - last_token_refresh > TOKEN_REFRESH_INTERVAL:
+                refreshed = token_store.refresh_due(db)
+                if refreshed:
+                    print(f"Refreshed {refreshed} access tokens")
+                last_token_refresh = time.monotonic()
+            if calendar_push.PUSH_ENABLED and time.monotonic() - last_channel_check > CHANNEL_CHECK_INTERVAL:
+                renewed = calendar_push.renew_channels(db)
+                if renewed:
+                    print(f"Renewed {renewed} push channels")
+                last_channel_check = time.monotonic()
+            if time.monotonic() - last_schedule > scheduler.RESYNC_INTERVAL:
+                queued = scheduler.run_due(db)
+                if queued:
+                    print(f"Queued {queued} re-syncs for stale calendars")
+                last_schedule = time.monotonic()
+            sent = outbox.send_due(db, worker_id)
+            if sent:
+                print(f"Sent {sent} queued emails")
+            job = jobs.claim_next(db, worker_id)
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            run_job(db, job)
+    finally:
+        client.close()
+    print(f"Worker {worker_id} stopped")
+
+
+if __name__ == '__main__':
+    main()